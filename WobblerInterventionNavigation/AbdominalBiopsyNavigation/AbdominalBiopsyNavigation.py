@@ -1,8 +1,12 @@
-import os, time, math
+import os, shutil, tempfile, time, math
 import unittest
 import logging
+import numpy as np
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from WobblerNavigationLib import (NavigationMetrics, PlusConnection, PoseBuffer, ScanConversion, SessionRecording,
+                                  StreamStatistics, TemporalCalibration, VolumeReconstruction, WorkerProcess)
+from WobblerNavigationLogic.NavigationLogic import NavigationLogic
 from slicer.util import VTKObservationMixin
 
 #
@@ -44,9 +48,24 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     VTKObservationMixin.__init__(self)  # needed for parameter node observation
     self.logic = None
     self._parameterNode = None
+    self._observedToCTToReferenceFiducialNode = None
 
     # Class Parameters
     self.calibrationErrorThresholdMm = 0.9
+    # Fiducial pairs farther apart than this after the CT registration are considered misplaced
+    self.fiducialInlierThresholdMm = 5.0
+    self.spinCalibrationErrorThresholdDeg = 1.0
+    self.toolCalibrationMaximumDurationSec = 30
+    self.reconstructionSpacingMm = 0.5
+    self.reconstructionSweepMarginMm = 40.0
+    self.reconstructionCompoundingMode = VolumeReconstruction.AVERAGE
+    # The calibrated time offset is only used if the probe motion shows this clearly in the images
+    self.temporalCalibrationMinimumCorrelation = 0.8
+    self.temporalCalibrationDirectory = None
+    self.cineDurationSec = 10.0
+    self.cineFrameRateHz = 30.0
+    self.latencyReadoutSliceViewName = 'Red'
+    self.maximumUpdateRateHz = 30.0
     self.PIVOT_CALIBRATION = 0
     self.SPIN_CALIBRATION = 1
 
@@ -78,6 +97,10 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.parameterNodeSelector.addAttribute("vtkMRMLScriptedModuleNode", "ModuleName", self.moduleName)
     self.setParameterNode(self.logic.getParameterNode())
 
+    # Cache the composed transforms of the tree built in setupScene, tool tip positions are polled at tracker rate
+    self.logic.setupTransformTreeCache([self.ImageToMRI, self.StylusTipToStylus, self.NeedleTipToNeedle,
+                                        self.CTToReference, self.USToProbe])
+
     # Dependencies
     self.markupsLogic = slicer.modules.markups.logic()
 
@@ -85,6 +108,7 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.parameterNodeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.setParameterNode)
 
     self.ui.saveButton.connect('clicked(bool)', self.onSaveScene)
+    self.ui.recordSessionButton.connect('toggled(bool)', self.onRecordSession)
     self.ui.connectPLUSButton.connect('clicked(bool)', self.onConnectPLUS)
     self.ui.layoutComboBox.connect('activated(const QString &)', self.onChangeLayout)
     self.ui.needleSpinCalibrationButton.connect('clicked(bool)', self.needleSpinCalibration)
@@ -92,15 +116,33 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.stylusSpinCalibrationButton.connect('clicked(bool)', self.stylusSpinCalibration)
     self.ui.stylusPivotCalibrationButton.connect('clicked(bool)', self.stylusPivotCalibration)
     self.ui.USCalibrationButton.connect('clicked(bool)', self.USCalibration)
+    self.ui.temporalCalibrationButton.connect('toggled(bool)', self.onTemporalCalibration)
     self.ui.initialCTRegistrationButton.connect('clicked(bool)', self.initialCTRegistration)
     self.ui.placeToCTToReferenceFiducialButton.connect('clicked(bool)', self.placeToCTToReferenceFiducial)
     self.ui.freezeUltrasoundButton.connect('clicked(bool)', self.onFreezeUltrasound)
+    self.ui.cineFrameSlider.connect('valueChanged(double)', self.onCineFrameChanged)
+    self.ui.reconstructVolumeButton.connect('toggled(bool)', self.onReconstructVolume)
+    self.ui.reconstructSessionButton.connect('clicked(bool)', self.onReconstructSession)
+
+    # Keep a cine loop of the live ultrasound as soon as the image node exists, e.g. after connecting to PLUS
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded)
+    self.startCineRecording()
 
     # Default widget settings
     self.toolCalibrationTimer = qt.QTimer()
-    self.toolCalibrationTimer.setInterval(500)
+    self.toolCalibrationTimer.setInterval(200)
     self.toolCalibrationTimer.connect('timeout()', self.toolCalibrationTimeout)
 
+    # The reconstruction runs on a worker thread, the displayed volume is refreshed from the main thread
+    self.volumeReconstructionTimer = qt.QTimer()
+    self.volumeReconstructionTimer.setInterval(500)
+    self.volumeReconstructionTimer.connect('timeout()', self.updateReconstructedVolume)
+
+    # The connector receives on its own thread, its state and message rates are polled from the main thread
+    self.plusConnectionTimer = qt.QTimer()
+    self.plusConnectionTimer.setInterval(500)
+    self.plusConnectionTimer.connect('timeout()', self.updatePlusConnectionStatus)
+
     self.ui.fromProbeToUSFiducialWidget.setCurrentNode(slicer.util.getFirstNodeByName('FromProbeToUSFiducialNode', className='vtkMRMLMarkupsFiducialNode'))
     self.ui.fromProbeToUSFiducialWidget.setNodeColor(qt.QColor(207, 26, 0, 255))
     self.ui.toProbeToUSFiducialWidget.setCurrentNode(slicer.util.getFirstNodeByName('ToProbeToUSFiducialNode', className='vtkMRMLMarkupsFiducialNode'))
@@ -118,6 +160,11 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.fromProbeToUSFiducialWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.toProbeToUSFiducialWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
 
+    # Registration error is re-evaluated whenever a reference fiducial is placed, moved or removed
+    self.ui.fromCTToReferenceFiducialWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.updateCTRegistrationErrorPreview)
+    self.ui.toCTToReferenceFiducialWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.observeToCTToReferenceFiducialNode)
+    self.observeToCTToReferenceFiducialNode(self.ui.toCTToReferenceFiducialWidget.currentNode())
+
     # Initial GUI update
     self.updateGUIFromParameterNode()
 
@@ -185,6 +232,10 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.FromCTToReferenceFiducialNode = self.createVTKMRMLElement('FromCTToReferenceFiducialNode', 'vtkMRMLMarkupsFiducialNode')
     self.ToCTToReferenceFiducialNode = self.createVTKMRMLElement('ToCTToReferenceFiducialNode', 'vtkMRMLMarkupsFiducialNode')
 
+    # Biopsy plan, targets and their skin entry points in the same order
+    self.NeedleTargetFiducialNode = self.createVTKMRMLElement('NeedleTargetFiducialNode', 'vtkMRMLMarkupsFiducialNode')
+    self.NeedleEntryFiducialNode = self.createVTKMRMLElement('NeedleEntryFiducialNode', 'vtkMRMLMarkupsFiducialNode')
+
     # Build Transform Tree
 
     # US Calibration Austria Names
@@ -220,11 +271,41 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
 
     return vtkMRMLElement
 
+  def enter(self):
+    """
+    Called each time the user opens this module.
+    """
+    # Tracker updates can arrive much faster than the display refreshes
+    self.logic.startCoalescedUpdates([self.StylusToReference, self.NeedleToReference, self.ProbeToReference],
+                                     self.maximumUpdateRateHz, self.logic.getLayoutViews())
+    self.startNeedleGuidance()
+    self.setupNeedleReslice()
+
+  def exit(self):
+    """
+    Called each time the user opens a different module.
+    """
+    self.logic.stopNeedleGuidance()
+    self.logic.stopNeedleReslice()
+    self.logic.stopCoalescedUpdates()
+
   def cleanup(self):
     """
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if self.logic:
+      self.logic.stopNeedleGuidance()
+      self.logic.stopNeedleReslice()
+      self.logic.stopCoalescedUpdates()
+      self.plusConnectionTimer.stop()
+      self.logic.disconnectPlus()
+      self.volumeReconstructionTimer.stop()
+      self.logic.stopVolumeReconstruction()
+      self.logic.stopCineRecording()
+      self.logic.stopSessionRecording()
+      self.logic.removeTransformTreeCache()
+      self.logic.stopWorkerProcess()
 
   def setParameterNode(self, inputParameterNode):
     """
@@ -356,13 +437,62 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
       " </item>"
       "</layout>")
 
-    RGBO3DLayoutID = 400
+    self.RGBO3DLayoutID = 400
 
     layoutManager = slicer.app.layoutManager()
-    layoutManager.layoutLogic().GetLayoutNode().AddLayoutDescription(RGBO3DLayoutID, RGBO3DLayout)
+    layoutManager.layoutLogic().GetLayoutNode().AddLayoutDescription(self.RGBO3DLayoutID, RGBO3DLayout)
 
   def onConnectPLUS(self):
-    pass
+    logging.debug('onConnectPLUS')
+
+    if self.ui.connectPLUSButton.text == 'Connect to PLUS':
+      try:
+        self.logic.connectPlus(self.ui.plusHostandPort.text)
+      except ValueError as error:
+        slicer.util.errorDisplay("Invalid PLUS server address: {0}".format(error))
+        return
+      except RuntimeError as error:
+        slicer.util.errorDisplay(str(error))
+        return
+      self.plusConnectionTimer.start()
+      self.ui.connectPLUSButton.setText('Disconnect from PLUS')
+    else:
+      self.plusConnectionTimer.stop()
+      self.logic.disconnectPlus()
+      self.ui.connectPLUSButton.setText('Connect to PLUS')
+    self.updatePlusConnectionStatus()
+
+  def updatePlusConnectionStatus(self):
+    state, streamRates = self.logic.pollPlusConnection()
+    stateTexts = {
+      PlusConnection.OFF: 'Not connected',
+      PlusConnection.CONNECTING: 'Connecting',
+      PlusConnection.CONNECTED: 'Connected',
+      PlusConnection.WAITING: 'Connection lost, retrying',
+      }
+    rateTexts = ['{0}: {1:.1f} Hz'.format(name, rate) for name, rate in sorted(streamRates.items())]
+    self.ui.plusConnectionStatusLabel.text = '\n'.join([stateTexts[state]] + rateTexts)
+    self.updateLatencyReadout()
+
+  def updateLatencyReadout(self):
+    """
+    Show rate, jitter, latency and age of each incoming stream in a corner of a slice view, so a
+    degrading tracker or network is noticed during navigation.
+    """
+    sliceWidget = slicer.app.layoutManager().sliceWidget(self.latencyReadoutSliceViewName)
+    if sliceWidget is None:
+      return
+    readoutLines = []
+    for streamName, summary in sorted(self.logic.getStreamStatistics().items()):
+      readoutLine = '{0}: {1:.0f} Hz, jitter {2:.1f} ms, age {3:.0f} ms'.format(
+        streamName, summary.updateRateHz, summary.jitterSec * 1000.0, summary.ageSec * 1000.0)
+      if not math.isnan(summary.latencyMeanSec):
+        readoutLine += ', latency {0:.1f} ms (95% {1:.1f} ms)'.format(
+          summary.latencyMeanSec * 1000.0, summary.latency95thPercentileSec * 1000.0)
+      readoutLines.append(readoutLine)
+    sliceView = sliceWidget.sliceView()
+    sliceView.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperRight, '\n'.join(readoutLines))
+    sliceView.scheduleRender()
 
   def onSaveScene(self):
     logging.debug('onSaveScene')
@@ -381,6 +511,28 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     else:
       print("Invalid Input Value")
 
+  def onRecordSession(self, toggled):
+    logging.debug('onRecordSession')
+
+    if toggled:
+      if not self.ui.PathLineEdit.currentPath:
+        slicer.util.errorDisplay("Select a save location for the session recording")
+        self.ui.recordSessionButton.setChecked(False)
+        return
+      if self.ui.temporalCalibrationButton.checked:
+        slicer.util.errorDisplay("Stop the temporal calibration first")
+        self.ui.recordSessionButton.setChecked(False)
+        return
+      sessionDirectory = os.path.join(self.ui.PathLineEdit.currentPath, "Session-" + time.strftime("%Y%m%d-%H%M%S"))
+      ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+      self.logic.startSessionRecording(sessionDirectory, ultrasoundVolumeNode,
+                                       [self.StylusToReference, self.NeedleToReference, self.ProbeToReference])
+      logging.info("Recording session to: {0}".format(sessionDirectory))
+      self.ui.recordSessionButton.setText('Stop Recording')
+    else:
+      self.logic.stopSessionRecording()
+      self.ui.recordSessionButton.setText('Record Session')
+
   def onChangeLayout(self):
     logging.debug('onChangeLayout')
 
@@ -392,12 +544,24 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     elif (view == "Red Slice View"):
       requestedID = 6
     elif (view == "RGBO3D View"):
-      requestedID = 400
+      requestedID = self.RGBO3DLayoutID
     else:
       print("Invalid Input Value")
 
     layoutManager = slicer.app.layoutManager()
     layoutManager.setLayout(requestedID)
+    self.logic.setCoalescedRenderViews(self.logic.getLayoutViews())
+    self.setupNeedleReslice()
+
+  def setupNeedleReslice(self):
+    """
+    The Orange view of the RGBO3D layout shows the slice through the needle shaft.
+    """
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager.layout != self.RGBO3DLayoutID:
+      self.logic.stopNeedleReslice()
+      return
+    self.logic.startNeedleReslice(layoutManager.sliceWidget('Orange').mrmlSliceNode(), self.NeedleTipToNeedle)
 
   def stylusPivotCalibration(self):
     logging.debug('stylusPivotCalibration')
@@ -426,8 +590,7 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.stylusPivotCalibrationButton.setEnabled(False)
     self.ui.stylusSpinCalibrationButton.setEnabled(False)
 
-    self.toolCalibrationStopTime = time.time() + float(5)
-    self.logic.toolCalibration(self.toolToReferenceNode, self.toolCalibrationTimer)
+    self.startToolCalibration()
 
   def needleSpinCalibration(self):
     logging.debug('needleSpinCalibration')
@@ -456,22 +619,38 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.stylusPivotCalibrationButton.setEnabled(False)
     self.ui.stylusSpinCalibrationButton.setEnabled(False)
 
-    self.toolCalibrationStopTime = time.time() + float(5)
+    self.startToolCalibration()
+
+  def startToolCalibration(self):
+    logging.debug('startToolCalibration')
+
+    # Calibration stops as soon as the estimate converges, the duration is only an upper limit
+    self.toolCalibrationStopTime = time.time() + float(self.toolCalibrationMaximumDurationSec)
     self.logic.toolCalibration(self.toolToReferenceNode, self.toolCalibrationTimer)
 
   def toolCalibrationTimeout(self):
     logging.debug('toolCalibrationTimeout')
 
+    calibrationFinished = time.time() >= self.toolCalibrationStopTime
+    if self.toolCalibrationMode == self.PIVOT_CALIBRATION:
+      pivotCalibrationSolver = self.logic.pivotCalibrationSolver
+      calibrationFinished = calibrationFinished or pivotCalibrationSolver.converged
+      calibrationProgress = "Pivoting: {0} poses, error = {1:.2f} mm".format(
+        pivotCalibrationSolver.numberOfPoses, pivotCalibrationSolver.rootMeanSquareError)
+    else:
+      spinCalibrationSolver = self.logic.spinCalibrationSolver
+      calibrationFinished = calibrationFinished or spinCalibrationSolver.converged
+      calibrationProgress = "Spinning: {0:.0f} deg covered, error = {1:.2f} deg".format(
+        spinCalibrationSolver.coverageDeg, spinCalibrationSolver.rootMeanSquareErrorDeg)
+
     if self.toolBeingCalibrated == 'Needle':
       self.ui.needleCalibrationErrorLabel.setText("")
-      self.ui.needleCalibrationCountdownLabel.setText(
-        "Calibrating for {0:.0f} more seconds".format(self.toolCalibrationStopTime - time.time()))
+      self.ui.needleCalibrationCountdownLabel.setText(calibrationProgress)
     elif self.toolBeingCalibrated == 'Stylus':
       self.ui.stylusCalibrationErrorLabel.setText("")
-      self.ui.stylusCalibrationCountdownLabel.setText(
-        "Calibrating for {0:.0f} more seconds".format(self.toolCalibrationStopTime - time.time()))
+      self.ui.stylusCalibrationCountdownLabel.setText(calibrationProgress)
 
-    if (time.time() >= self.toolCalibrationStopTime):
+    if calibrationFinished:
       self.toolCalibrationTimer.stop()
 
       self.ui.needlePivotCalibrationButton.setEnabled(True)
@@ -493,7 +672,7 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
           self.ui.stylusCalibrationErrorLabel.setText(calibrationError)
           self.ui.stylusCalibrationCountdownLabel.setText(calibrationStatus)
       else:
-        calibrationStatus, calibrationError = self.logic.spinCalibration(self.calibrationErrorThresholdMm, self.toolCalibrationResultNode)
+        calibrationStatus, calibrationError = self.logic.spinCalibration(self.spinCalibrationErrorThresholdDeg, self.toolCalibrationResultNode)
 
         if self.toolBeingCalibrated == 'Needle':
           self.ui.needleCalibrationErrorLabel.setText(calibrationError)
@@ -509,19 +688,15 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
 
   def returnPointAtStylusTip(self):  # Coordinate returned is in the reference coordinate system
     logging.debug('returnPointAtStylusTip')
-    StylusTipToReference = vtk.vtkMatrix4x4()
+    StylusTipToReference = self.logic.getMatrixToWorld(self.StylusTipToStylus)
 
-    self.StylusTipToStylus.GetMatrixTransformToWorld(StylusTipToReference)
-    return [StylusTipToReference.GetElement(0, 3), StylusTipToReference.GetElement(1, 3),
-            StylusTipToReference.GetElement(2, 3)]
+    return [StylusTipToReference[0, 3], StylusTipToReference[1, 3], StylusTipToReference[2, 3]]
 
   def returnTransformedPointAtStylusTip(self, TargetTransform):  # Coordinate returned is in target coordinate system
     logging.debug('returnTransformedPointAtStylusTip')
-    StylusTipToTarget = vtk.vtkMatrix4x4()
+    StylusTipToTarget = self.logic.getMatrixToNode(self.StylusTipToStylus, TargetTransform)
 
-    self.StylusTipToStylus.GetMatrixTransformToNode(TargetTransform, StylusTipToTarget)
-
-    return [StylusTipToTarget.GetElement(0, 3), StylusTipToTarget.GetElement(1, 3), StylusTipToTarget.GetElement(2, 3)]
+    return [StylusTipToTarget[0, 3], StylusTipToTarget[1, 3], StylusTipToTarget[2, 3]]
 
   def USCalibration(self):
     logging.debug("USCalibration")
@@ -535,8 +710,52 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.USToProbe.SetMatrixTransformToParent(self.ProbeToUS.GetMatrixTransformFromParent())
     self.USToProbe.Inverse()
 
+    # Scan conversion depends on the calibration, rebuild it now instead of at the next sweep.
+    # There is nothing to rebuild until the geometry of the connected probe is configured.
+    if self.logic.setWobblerProbeGeometryFromParameterNode(self._parameterNode, self.reconstructionSpacingMm):
+      self.logic.updateScanConversionTable(self.USToProbe)
+
     self.ui.USCalibrationErrorLabel.setText(calibrationMessage.format(RMSE))
 
+  def onTemporalCalibration(self, toggled):
+    logging.debug('onTemporalCalibration')
+
+    if toggled:
+      ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+      if ultrasoundVolumeNode is None:
+        slicer.util.errorDisplay("Ultrasound_Ultrasound image is not available, connect to PLUS first")
+        self.ui.temporalCalibrationButton.setChecked(False)
+        return
+      if self.logic.sessionRecorder is not None:
+        slicer.util.errorDisplay("Stop the session recording first")
+        self.ui.temporalCalibrationButton.setChecked(False)
+        return
+      self.temporalCalibrationDirectory = tempfile.mkdtemp(prefix='TemporalCalibration-')
+      self.logic.startSessionRecording(self.temporalCalibrationDirectory, ultrasoundVolumeNode, [self.ProbeToReference])
+      self.ui.temporalCalibrationLabel.setText('Move the probe up and down')
+      self.ui.temporalCalibrationButton.setText('Stop and Calibrate')
+      return
+
+    self.logic.stopSessionRecording()
+    self.ui.temporalCalibrationButton.setText('Record Temporal Calibration')
+    session = self.logic.loadSessionWindow(self.temporalCalibrationDirectory, 0.0, float('inf'))
+    shutil.rmtree(self.temporalCalibrationDirectory, ignore_errors=True)
+    if 'Ultrasound_Ultrasound' not in session:
+      self.ui.temporalCalibrationLabel.setText('No ultrasound frames were recorded')
+      return
+    try:
+      offsetSec, correlation = self.logic.calibrateTemporalOffset(
+        session, 'Ultrasound_Ultrasound', 'ProbeToReference', minimumCorrelation=self.temporalCalibrationMinimumCorrelation)
+    except ValueError as error:
+      self.ui.temporalCalibrationLabel.setText('Calibration failed: {0}'.format(error))
+      return
+    if correlation < self.temporalCalibrationMinimumCorrelation:
+      self.ui.temporalCalibrationLabel.setText(
+        'Motion not found in the images (correlation {0:.2f}), offset not changed'.format(correlation))
+    else:
+      self.ui.temporalCalibrationLabel.setText(
+        'Time offset = {0:.1f} ms (correlation {1:.2f})'.format(offsetSec * 1000.0, correlation))
+
   def placeToCTToReferenceFiducial(self):
     logging.debug("placeToCTToReferenceFiducial")
 
@@ -547,6 +766,53 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
 
     currentNode.AddFiducialFromArray(newFiducial)
 
+  def observeToCTToReferenceFiducialNode(self, toMarkupsNode):
+    logging.debug("observeToCTToReferenceFiducialNode")
+
+    markupsEvents = [slicer.vtkMRMLMarkupsNode.PointAddedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent,
+                     slicer.vtkMRMLMarkupsNode.PointRemovedEvent]
+
+    if self._observedToCTToReferenceFiducialNode is not None:
+      for event in markupsEvents:
+        self.removeObserver(self._observedToCTToReferenceFiducialNode, event, self.updateCTRegistrationErrorPreview)
+    if toMarkupsNode is not None:
+      for event in markupsEvents:
+        self.addObserver(toMarkupsNode, event, self.updateCTRegistrationErrorPreview)
+    self._observedToCTToReferenceFiducialNode = toMarkupsNode
+
+    self.updateCTRegistrationErrorPreview()
+
+  def updateCTRegistrationErrorPreview(self, caller=None, event=None):
+    """
+    Evaluate the CT to reference registration for the fiducials placed so far, without
+    modifying CTToReference, and show the error statistics.
+    """
+    fromMarkupsNode = self.ui.fromCTToReferenceFiducialWidget.currentNode()
+    toMarkupsNode = self.ui.toCTToReferenceFiducialWidget.currentNode()
+    if fromMarkupsNode is None or toMarkupsNode is None:
+      return
+
+    nFromPoints = fromMarkupsNode.GetNumberOfFiducials()
+    nToPoints = toMarkupsNode.GetNumberOfFiducials()
+    if nToPoints < nFromPoints:
+      self.ui.initialCTRegistrationErrorLabel.setText("Placed {0} of {1} fiducials".format(nToPoints, nFromPoints))
+      return
+
+    calibrationMessage, RMSE = self.logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, None,
+                                                               inlierThresholdMm=self.fiducialInlierThresholdMm)
+    if not calibrationMessage.startswith('Success'):
+      self.ui.initialCTRegistrationErrorLabel.setText(calibrationMessage.format(RMSE))
+      return
+
+    errorStatistics = self.logic.registrationErrorStatistics
+    previewMessage = "Preview: RMSE = {0:.2f} mm, max = {1:.2f} mm, 95% = {2:.2f} mm, leave-one-out = {3:.2f} mm".format(
+      errorStatistics.rootMeanSquareError, errorStatistics.maximumError, errorStatistics.percentileErrors[95],
+      errorStatistics.leaveOneOutRootMeanSquareError)
+    if self.logic.rejectedFiducialIndices:
+      previewMessage += ", rejected " + ', '.join(
+        toMarkupsNode.GetNthFiducialLabel(index) for index in self.logic.rejectedFiducialIndices)
+    self.ui.initialCTRegistrationErrorLabel.setText(previewMessage)
+
   def initialCTRegistration(self):
     logging.debug("initialCTRegistration")
 
@@ -554,7 +820,8 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     toMarkupsNode = self.ui.toCTToReferenceFiducialWidget.currentNode()
     outputTransformNode = self.CTToReference
 
-    calibrationMessage, RMSE = self.logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, outputTransformNode)
+    calibrationMessage, RMSE = self.logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, outputTransformNode,
+                                                               inlierThresholdMm=self.fiducialInlierThresholdMm)
 
     self.ui.initialCTRegistrationErrorLabel.setText(calibrationMessage.format(RMSE))
 
@@ -567,35 +834,192 @@ class AbdominalBiopsyNavigationWidget(ScriptedLoadableModuleWidget, VTKObservati
     slicer.util.saveNode(self.CTToReference, os.path.join(self.moduleTransformsPath, 'CTToReference' + ".h5"))
     slicer.util.saveNode(self.ProbeToUS, os.path.join(self.moduleTransformsPath, 'ProbeToUS' + ".h5"))
 
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    if isinstance(node, slicer.vtkMRMLScalarVolumeNode) and node.GetName() == 'Ultrasound_Ultrasound':
+      self.startCineRecording()
+      if self.logic.needleNavigation is not None:
+        # Intersect the needle with the image plane from now on
+        self.startNeedleGuidance()
+
+  def startCineRecording(self):
+    ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+    if ultrasoundVolumeNode is None or self.logic.cineUltrasoundVolumeNode is ultrasoundVolumeNode:
+      return
+    self.logic.startCineRecording(ultrasoundVolumeNode, int(round(self.cineDurationSec * self.cineFrameRateHz)))
+
+  def startNeedleGuidance(self):
+    ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+    self.logic.startNeedleGuidance(self.NeedleTargetFiducialNode, self.NeedleTipToNeedle, self.ReferenceToRas,
+                                   ultrasoundVolumeNode, self.NeedleEntryFiducialNode, self.updateNeedleGuidanceReadout)
+
+  def updateNeedleGuidanceReadout(self, guidance):
+    if guidance.tipToTargetDistancesMm.size == 0:
+      self.ui.needleGuidanceLabel.setText('No target')
+      return
+    # Guidance to the closest target, the one the needle is presumably aimed at
+    target = int(np.argmin(guidance.tipToTargetDistancesMm))
+    text = 'Target {0}: {1:.1f} mm, depth {2:.1f} mm, off axis {3:.1f} mm'.format(
+      target + 1, guidance.tipToTargetDistancesMm[target], guidance.depthsToTargetsMm[target],
+      guidance.lateralDeviationsMm[target])
+    if not np.isnan(guidance.angularDeviationsDeg[target]):
+      text += ', angle {0:.1f} deg'.format(guidance.angularDeviationsDeg[target])
+    if guidance.imagePlaneIntersectionPixel is not None:
+      text += '\nCrosses image at ({0:.0f}, {1:.0f}), {2:.1f} mm from tip'.format(
+        guidance.imagePlaneIntersectionPixel[0], guidance.imagePlaneIntersectionPixel[1], guidance.tipToImagePlaneDistanceMm)
+    self.ui.needleGuidanceLabel.setText(text)
+
   def onFreezeUltrasound(self):
     logging.debug("onFreezeUltrasound")
 
     buttonLabel = self.ui.freezeUltrasoundButton.text
     if buttonLabel == 'Freeze Ultrasound':
+      frozenVolumeNode = slicer.util.getFirstNodeByName('FrozenUltrasound', className='vtkMRMLScalarVolumeNode')
+      if frozenVolumeNode is None:
+        frozenVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'FrozenUltrasound')
+      numberOfFrames = self.logic.freezeUltrasound(frozenVolumeNode)
+      if numberOfFrames == 0:
+        slicer.util.errorDisplay("No ultrasound frames have been received yet")
+        return
       self.ui.freezeUltrasoundButton.setText('Unfreeze Ultrasound')
+      self.ui.cineFrameSlider.blockSignals(True)
+      self.ui.cineFrameSlider.minimum = 1 - numberOfFrames
+      self.ui.cineFrameSlider.value = 0
+      self.ui.cineFrameSlider.blockSignals(False)
+      self.ui.cineFrameSlider.enabled = True
+      slicer.util.setSliceViewerLayers(background=frozenVolumeNode)
+    else:
+      self.logic.unfreezeUltrasound()
+      self.ui.freezeUltrasoundButton.setText('Freeze Ultrasound')
+      self.ui.cineFrameSlider.enabled = False
+      if self.logic.cineUltrasoundVolumeNode is not None:
+        slicer.util.setSliceViewerLayers(background=self.logic.cineUltrasoundVolumeNode)
+
+  def onCineFrameChanged(self, value):
+    self.logic.showCineFrame(-int(round(value)))
+
+  def onReconstructVolume(self, toggled):
+    logging.debug("onReconstructVolume")
+
+    if toggled:
+      ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+      if ultrasoundVolumeNode is None:
+        slicer.util.errorDisplay("Ultrasound_Ultrasound image is not available, connect to PLUS first")
+        self.ui.reconstructVolumeButton.setChecked(False)
+        return
+      reconstructedVolumeNode = slicer.util.getFirstNodeByName('ReconstructedUltrasound', className='vtkMRMLScalarVolumeNode')
+      if reconstructedVolumeNode is None:
+        reconstructedVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ReconstructedUltrasound')
+      self.logic.startVolumeReconstruction(ultrasoundVolumeNode, reconstructedVolumeNode, self.reconstructionSpacingMm,
+                                           self.reconstructionSweepMarginMm, self.reconstructionCompoundingMode,
+                                           trackedTransformNode=self.ProbeToReference)
+      self.volumeReconstructionTimer.start()
+      self.ui.reconstructVolumeButton.setText('Stop Volume Reconstruction')
+    else:
+      self.volumeReconstructionTimer.stop()
+      self.logic.stopVolumeReconstruction()
+      self.ui.reconstructVolumeButton.setText('Reconstruct Volume')
 
-      self.UltrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound')
-      self.FrozenUS = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeDisplayNode', 'FrozenUltrasound')
+  def updateReconstructedVolume(self):
+    self.logic.updateReconstructedVolume()
 
+  def onReconstructSession(self):
+    logging.debug("onReconstructSession")
 
-    else:
-      self.ui.freezeUltrasoundButton.setText('Freeze Ultrasound')
+    ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+    if ultrasoundVolumeNode is None:
+      slicer.util.errorDisplay("Ultrasound_Ultrasound image is not available, connect to PLUS first")
+      return
+    sessionDirectory = qt.QFileDialog.getExistingDirectory(slicer.util.mainWindow(), "Select recorded session",
+                                                           self.ui.PathLineEdit.currentPath)
+    if not sessionDirectory:
+      return
+    session = self.logic.loadSessionWindow(sessionDirectory, 0.0, float('inf'))
+    if 'Ultrasound_Ultrasound' not in session or 'ProbeToReference' not in session:
+      slicer.util.errorDisplay("The session has no tracked ultrasound frames")
+      return
+
+    # Recorded poses are ProbeToReference, the image geometry and the calibration are taken as they are now
+    pixelToProbeMatrix = np.linalg.solve(self.logic.getMatrixToWorld(self.ProbeToReference),
+                                         self.logic.getImageToWorldMatrix(ultrasoundVolumeNode))
+    referenceTransformNode = self.ProbeToReference.GetParentTransformNode()
+    referenceToWorldMatrix = None
+    if referenceTransformNode is not None:
+      referenceToWorldMatrix = self.logic.getMatrixToWorld(referenceTransformNode)
+    reconstructedVolumeNode = slicer.util.getFirstNodeByName('ReconstructedSession', className='vtkMRMLScalarVolumeNode')
+    if reconstructedVolumeNode is None:
+      reconstructedVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ReconstructedSession')
+
+    def onSessionReconstructed(numberOfFrames, errorMessage):
+      self.ui.reconstructSessionButton.enabled = True
+      self.ui.reconstructSessionButton.setText('Reconstruct Recorded Session')
+      if errorMessage is not None:
+        slicer.util.errorDisplay("Session reconstruction failed, see the log for details")
+        return
+      logging.info("Reconstructed {0} frames of {1}".format(numberOfFrames, sessionDirectory))
+      slicer.util.setSliceViewerLayers(background=reconstructedVolumeNode)
+
+    try:
+      self.logic.reconstructSessionInBackground(session, 'Ultrasound_Ultrasound', 'ProbeToReference', reconstructedVolumeNode,
+                                                pixelToProbeMatrix, referenceToWorldMatrix, self.reconstructionSpacingMm,
+                                                self.reconstructionSweepMarginMm, self.reconstructionCompoundingMode,
+                                                finishedCallback=onSessionReconstructed)
+    except ValueError as error:
+      slicer.util.errorDisplay(str(error))
+      return
+    self.ui.reconstructSessionButton.enabled = False
+    self.ui.reconstructSessionButton.setText('Reconstructing...')
 
 
 #
 # AbdominalBiopsyNavigationLogic
 #
 
-class AbdominalBiopsyNavigationLogic(ScriptedLoadableModuleLogic):
+class AbdominalBiopsyNavigationLogic(NavigationLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
   should be such that other python code can import
   this class and make use of the functionality without
   requiring an instance of the Widget.
-  Uses ScriptedLoadableModuleLogic base class, available at:
-  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  The transform tree cache, registration, tool calibration, PLUS connection and cine loop are
+  inherited from WobblerNavigationLogic.NavigationLogic, shared with the LiverBiopsy module.
   """
 
+  def __init__(self):
+    NavigationLogic.__init__(self)
+    self.ultrasoundVolumeNode = None
+    self.ultrasoundObserverTag = None
+    self.reconstructedVolumeNode = None
+    self.reconstructionThread = None
+    self.reconstructionSpacingMm = 0.5
+    self.reconstructionSweepMarginMm = 40.0
+    self.reconstructionCompoundingMode = VolumeReconstruction.AVERAGE
+    self.trackedPoseNode = None
+    self.trackedPoseObserverTag = None
+    self.trackedPoseBuffer = None
+    self.maximumPoseGapSec = 0.1
+    # Frames waiting for the next tracked pose, the oldest are dropped if the tracker stops
+    self.pendingReconstructionFrames = []
+    self.maximumPendingReconstructionFrames = 30
+    self.sessionRecorder = None
+    self.sessionRecordingObservations = []
+    self.streamStatistics = StreamStatistics.StreamStatistics()
+    # Node attribute holding the device timestamp of the last message in seconds, overrides the message header timestamp
+    self.deviceTimestampAttributeName = None
+    # The image acquired at time t shows the tracker state at t + this offset, see calibrateTemporalOffset
+    self.frameToPoseTimeOffsetSec = 0.0
+    self.workerProcess = None
+    self.workerTimer = None
+    self.needleNavigation = None
+    self.needleGuidanceNodes = None
+    self.needleGuidanceObservations = []
+    self.needleGuidanceCallback = None
+    self.needleGuidance = None
+    self.needleResliceNodes = None
+    self.needleResliceLateralDirection = (1.0, 0.0, 0.0)
+    self.needleResliceMatrix = None
+    self.scanConversionCache = None
+
   def setDefaultParameters(self, parameterNode):
     """
     Initialize parameter node with default settings.
@@ -609,128 +1033,548 @@ class AbdominalBiopsyNavigationLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("ToProbeToUSFiducialNode"):
       parameterNode.SetParameter("ToProbeToUSFiducialNode", "ToProbeToUSFiducialNode")
 
-  def toolCalibration(self, transformNodeToolToReference, qtTimer):
-    logging.debug('toolCalibration')
-
-    self.pivotCalibrationLogic = slicer.modules.pivotcalibration.logic()
-    self.pivotCalibrationLogic.SetAndObserveTransformNode(transformNodeToolToReference)
-
-    qtTimer.start()
-    self.pivotCalibrationLogic.SetRecordingState(True)
+  def startVolumeReconstruction(self, ultrasoundVolumeNode, reconstructedVolumeNode, spacingMm=0.5, sweepMarginMm=40.0,
+                                compoundingMode=VolumeReconstruction.AVERAGE, trackedTransformNode=None,
+                                maximumPoseGapSec=0.1, poseBufferCapacity=1024):
+    """
+    Compound every tracked frame of ultrasoundVolumeNode into reconstructedVolumeNode.
+    Frames are scattered into the voxel grid on a worker thread, call updateReconstructedVolume
+    periodically from the main thread to copy the bricks of the grid that changed into the node.
+    The pose of a frame is the image IJKToRAS composed with the transforms above the image node,
+    e.g. USToProbe, ProbeToReference and ReferenceToRas.
+    :param spacingMm: voxel size of the reconstruction
+    :param sweepMarginMm: the grid is placed around the first frame, grown by this margin to contain the sweep
+    :param compoundingMode: VolumeReconstruction.AVERAGE or MAXIMUM of overlapping frames
+    :param trackedTransformNode: tracked transform above the image node, e.g. ProbeToReference. Its poses
+      are buffered as they arrive and each frame gets the pose interpolated at the arrival time of the
+      frame, corrected by the calibrated frameToPoseTimeOffsetSec, instead of the pose of the last
+      tracker message. If None the current transforms are used.
+    :param maximumPoseGapSec: frames between tracked poses further apart than this are not reconstructed
+    :param poseBufferCapacity: number of tracked poses kept for the interpolation
+    """
+    logging.debug('startVolumeReconstruction')
+
+    self.stopVolumeReconstruction()
+    self.ultrasoundVolumeNode = ultrasoundVolumeNode
+    self.reconstructedVolumeNode = reconstructedVolumeNode
+    self.reconstructionSpacingMm = spacingMm
+    self.reconstructionSweepMarginMm = sweepMarginMm
+    self.reconstructionCompoundingMode = compoundingMode
+    if trackedTransformNode is not None:
+      self.trackedPoseNode = trackedTransformNode
+      self.trackedPoseBuffer = PoseBuffer.PoseBuffer(poseBufferCapacity)
+      self.maximumPoseGapSec = maximumPoseGapSec
+      self.trackedPoseObserverTag = trackedTransformNode.AddObserver(
+        slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTrackedPoseModified)
+      self.onTrackedPoseModified(trackedTransformNode, None)
+    self.ultrasoundObserverTag = ultrasoundVolumeNode.AddObserver(
+      slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onUltrasoundImageModified)
+
+  def onTrackedPoseModified(self, caller, event):
+    self.trackedPoseBuffer.addPose(time.time(), slicer.util.arrayFromTransformMatrix(caller))
+    self.reconstructPendingFrames()
+
+  def onUltrasoundImageModified(self, caller, event):
+    arrivalTime = time.time()
+    frame = slicer.util.arrayFromVolume(caller)
+    if frame.shape[0] != 1:
+      logging.warning('Volume reconstruction expects 2D frames, got {0} slices'.format(frame.shape[0]))
+      return
+    pixelToWorldMatrix = self.getImageToWorldMatrix(caller)
+    if self.trackedPoseBuffer is None:
+      self.addReconstructionFrame(frame[0], pixelToWorldMatrix)
+      return
 
-  def pivotCalibration(self, calibrationErrorThresholdMm, toolCalibrationResultNode):
-    logging.debug('pivotCalibration')
+    # The tracked pose at the corrected arrival time is only known once a later pose has arrived, the
+    # frame waits until then. The transforms above and below the tracked transform are taken as they are now.
+    poseTime = arrivalTime + self.frameToPoseTimeOffsetSec
+    trackedToWorldMatrix = self.getMatrixToWorld(self.trackedPoseNode)
+    pixelToTrackedMatrix = np.linalg.solve(trackedToWorldMatrix, pixelToWorldMatrix)
+    trackedParentNode = self.trackedPoseNode.GetParentTransformNode()
+    trackedParentToWorldMatrix = np.eye(4) if trackedParentNode is None else self.getMatrixToWorld(trackedParentNode)
+    # The image buffer is reused for the next frame
+    self.pendingReconstructionFrames.append((poseTime, frame[0].copy(), pixelToTrackedMatrix, trackedParentToWorldMatrix))
+    if len(self.pendingReconstructionFrames) > self.maximumPendingReconstructionFrames:
+      del self.pendingReconstructionFrames[0]
+    self.reconstructPendingFrames()
+
+  def reconstructPendingFrames(self):
+    """
+    Pose the waiting frames that the buffered tracked poses cover and reconstruct them.
+    """
+    if not self.pendingReconstructionFrames or self.trackedPoseBuffer.numberOfPoses == 0:
+      return
+    _, newestPoseTime = self.trackedPoseBuffer.timeRange()
+    # Frames are queued in arrival order, the time offset is the same for all of them
+    numberOfPosedFrames = 0
+    while (numberOfPosedFrames < len(self.pendingReconstructionFrames)
+           and self.pendingReconstructionFrames[numberOfPosedFrames][0] <= newestPoseTime):
+      numberOfPosedFrames += 1
+    if numberOfPosedFrames == 0:
+      return
+    posedFrames = self.pendingReconstructionFrames[:numberOfPosedFrames]
+    self.pendingReconstructionFrames = self.pendingReconstructionFrames[numberOfPosedFrames:]
+
+    trackedPoseMatrices, valid = self.trackedPoseBuffer.posesAtTimes(
+      [poseTime for poseTime, _, _, _ in posedFrames], self.maximumPoseGapSec)
+    for (_, frame, pixelToTrackedMatrix, trackedParentToWorldMatrix), trackedPoseMatrix, isValid in zip(
+        posedFrames, trackedPoseMatrices, valid):
+      if not isValid:
+        # Tracking was lost around the frame
+        continue
+      self.addReconstructionFrame(frame, np.linalg.multi_dot([trackedParentToWorldMatrix, trackedPoseMatrix, pixelToTrackedMatrix]))
+
+  def addReconstructionFrame(self, frame, pixelToWorldMatrix):
+    """
+    :param frame: (rows, columns) image, copied before it is reconstructed
+    :param pixelToWorldMatrix: (4, 4) pose of the frame
+    """
+    if self.reconstructionThread is None:
+      dimensions, voxelToWorldMatrix = VolumeReconstruction.volumeGeometryAroundFrame(
+        frame.shape, pixelToWorldMatrix, self.reconstructionSpacingMm, self.reconstructionSweepMarginMm)
+      self.reconstructionThread = VolumeReconstruction.ReconstructionThread(
+        VolumeReconstruction.VolumeReconstructor(dimensions, voxelToWorldMatrix, self.reconstructionCompoundingMode))
+      self.initializeReconstructedVolume(dimensions, voxelToWorldMatrix)
+      self.reconstructionThread.start()
 
-    self.pivotCalibrationLogic.SetRecordingState(False)
+    self.reconstructionThread.addFrame(frame, pixelToWorldMatrix)
 
-    calibrationSuccess = self.pivotCalibrationLogic.ComputePivotCalibration()
-    if not calibrationSuccess:
-      self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-      return "Calibration failed: ", self.pivotCalibrationLogic.GetErrorText(), 0
-    else:
-      if (self.pivotCalibrationLogic.GetPivotRMSE() >= float(calibrationErrorThresholdMm)):
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        return "Calibration failed:", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetPivotRMSE()), 0
-      else:
-        toolTipToToolMatrix = vtk.vtkMatrix4x4()
-        self.pivotCalibrationLogic.GetToolTipToToolMatrix(toolTipToToolMatrix)
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        toolCalibrationResultNode.SetMatrixTransformToParent(toolTipToToolMatrix)
+  def initializeReconstructedVolume(self, dimensions, voxelToWorldMatrix):
+    """
+    Allocate the image of the reconstructed volume node once, updates only write into it.
+    """
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(ijkToRasMatrix, voxelToWorldMatrix)
+    self.reconstructedVolumeNode.SetIJKToRASMatrix(ijkToRasMatrix)
+    slicer.util.updateVolumeFromArray(self.reconstructedVolumeNode, np.zeros(dimensions, dtype=np.float32))
 
-        return "Calibration completed", "Error = {0:.2f} mm".format(
-          self.pivotCalibrationLogic.GetPivotRMSE()), toolLength
+  def updateReconstructedVolume(self):
+    """
+    Copy the bricks that the reconstruction worker has updated since the last call into the
+    reconstructed volume node, the rest of the volume is not touched.
+    """
+    if self.reconstructionThread is None or self.reconstructedVolumeNode is None:
+      return
+    updatedBricks = self.reconstructionThread.takeUpdatedBricks()
+    if not updatedBricks:
+      return
 
-  def spinCalibration(self, calibrationErrorThresholdMm, toolCalibrationResultNode):
-    logging.debug('spinCalibration')
+    reconstructor = self.reconstructionThread.reconstructor
+    volumeArray = slicer.util.arrayFromVolume(self.reconstructedVolumeNode)
+    for brick, values in updatedBricks.items():
+      volumeArray[reconstructor.brickRegion(brick)] = values
+    slicer.util.arrayFromVolumeModified(self.reconstructedVolumeNode)
+
+  def stopVolumeReconstruction(self):
+    if self.ultrasoundObserverTag is not None:
+      self.ultrasoundVolumeNode.RemoveObserver(self.ultrasoundObserverTag)
+    self.ultrasoundVolumeNode = None
+    self.ultrasoundObserverTag = None
+    if self.trackedPoseObserverTag is not None:
+      self.trackedPoseNode.RemoveObserver(self.trackedPoseObserverTag)
+    self.trackedPoseNode = None
+    self.trackedPoseObserverTag = None
+    self.trackedPoseBuffer = None
+    self.pendingReconstructionFrames = []
+    if self.reconstructionThread is not None:
+      self.reconstructionThread.stop()
+      self.updateReconstructedVolume()
+      self.reconstructionThread = None
+
+  def startSessionRecording(self, sessionDirectory, ultrasoundVolumeNode, transformNodes, chunkSize=256):
+    """
+    Append every frame of ultrasoundVolumeNode and every update of transformNodes, timestamped at
+    arrival, to memory-mapped chunk files in sessionDirectory. Streams are named after the nodes,
+    transforms are recorded as their matrix to parent, e.g. the tracker pose of ProbeToReference.
+    :param ultrasoundVolumeNode: image stream to record, None to record only transforms
+    :param chunkSize: number of frames or poses per chunk file
+    """
+    logging.debug('startSessionRecording')
+
+    self.stopSessionRecording()
+    self.sessionRecorder = SessionRecording.SessionRecorder(sessionDirectory, chunkSize)
+    for transformNode in transformNodes:
+      self.sessionRecorder.addStream(transformNode.GetName(), (4, 4), np.float64)
+      self.sessionRecordingObservations.append((transformNode, transformNode.AddObserver(
+        slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onRecordedTransformModified)))
+      self.onRecordedTransformModified(transformNode, None)
+    if ultrasoundVolumeNode is not None:
+      self.sessionRecordingObservations.append((ultrasoundVolumeNode, ultrasoundVolumeNode.AddObserver(
+        slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onRecordedImageModified)))
+
+  def onRecordedTransformModified(self, caller, event):
+    self.sessionRecorder.append(caller.GetName(), slicer.util.arrayFromTransformMatrix(caller), time.time())
+
+  def onRecordedImageModified(self, caller, event):
+    frame = slicer.util.arrayFromVolume(caller)
+    if frame.shape[0] != 1:
+      return
+    name = caller.GetName()
+    if not self.sessionRecorder.hasStream(name):
+      # Frame size is only known once the first frame has arrived
+      self.sessionRecorder.addStream(name, frame.shape[1:], frame.dtype)
+    try:
+      self.sessionRecorder.append(name, frame[0], time.time())
+    except ValueError:
+      logging.warning('Frame of {0} does not match the recorded image size, it is not recorded'.format(name))
+
+  def stopSessionRecording(self):
+    for node, tag in self.sessionRecordingObservations:
+      node.RemoveObserver(tag)
+    self.sessionRecordingObservations = []
+    if self.sessionRecorder is not None:
+      self.sessionRecorder.close()
+      self.sessionRecorder = None
+
+  def loadSessionWindow(self, sessionDirectory, startTime, stopTime, streamNames=None):
+    """
+    Load a time window of a recorded session, only the chunks that overlap the window are read.
+    :param startTime: start of the window in seconds since the first recorded item of the session
+    :param stopTime: end of the window in seconds since the first recorded item of the session
+    :param streamNames: streams to load, all of them if None
+    :return: dict of stream name to (K,) timestamps and (K, ...) array of frames or matrices
+    """
+    logging.debug('loadSessionWindow')
+
+    sessionReader = SessionRecording.SessionReader(sessionDirectory)
+    timeRanges = [sessionReader.timeRange(name) for name in sessionReader.streamNames()]
+    startTimes = [timeRange[0] for timeRange in timeRanges if timeRange is not None]
+    if not startTimes:
+      return {}
+    sessionStartTime = min(startTimes)
+    return {name: sessionReader.read(name, sessionStartTime + startTime, sessionStartTime + stopTime)
+            for name in (sessionReader.streamNames() if streamNames is None else streamNames)}
+
+  def posesAtFrameTimes(self, session, frameStreamName, poseStreamName, maximumGapSec=0.1):
+    """
+    Match every frame of a loaded session window to the tracked pose at its acquisition time,
+    interpolated between the poses recorded before and after the frame. Frame timestamps are
+    corrected by the calibrated frameToPoseTimeOffsetSec.
+    :param session: dict of stream name to timestamps and items, see loadSessionWindow
+    :param frameStreamName: image stream, e.g. the ultrasound volume node name
+    :param poseStreamName: transform stream, e.g. ProbeToReference
+    :param maximumGapSec: frames between poses further apart than this, e.g. while the probe was
+      not visible to the tracker, are marked invalid
+    :return: (K, 4, 4) pose of each frame and (K,) boolean array, True where the pose is valid
+    """
+    logging.debug('posesAtFrameTimes')
 
-    self.pivotCalibrationLogic.SetRecordingState(False)
+    frameTimestamps, _ = session[frameStreamName]
+    poseTimestamps, poseMatrices = session[poseStreamName]
+    if poseTimestamps.size == 0:
+      return np.tile(np.eye(4), (frameTimestamps.size, 1, 1)), np.zeros(frameTimestamps.size, dtype=bool)
+    poseBuffer = PoseBuffer.PoseBuffer(max(poseTimestamps.size, 2))
+    poseBuffer.addPoses(poseTimestamps, poseMatrices)
+    return poseBuffer.posesAtTimes(frameTimestamps + self.frameToPoseTimeOffsetSec, maximumGapSec)
 
-    calibrationSuccess = self.pivotCalibrationLogic.ComputeSpinCalibration()
-    if not calibrationSuccess:
-      self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-      return "Calibration failed: ", self.pivotCalibrationLogic.GetErrorText()
+  def calibrateTemporalOffset(self, session, frameStreamName, poseStreamName, maximumOffsetSec=0.5, minimumCorrelation=0.8):
+    """
+    Estimate the time offset between the image and the tracker stream from a recording of the probe
+    moved up and down, e.g. over the bottom of a water tank, and use it for matching frames to poses.
+    :param session: dict of stream name to timestamps and items, see loadSessionWindow
+    :param maximumOffsetSec: largest offset searched for, shorter than half the period of the motion
+    :param minimumCorrelation: the offset is only applied if the signals correlate at least this much
+    :return: offset in seconds and the correlation of the signals at the offset
+    """
+    logging.debug('calibrateTemporalOffset')
+
+    frameTimestamps, frames = session[frameStreamName]
+    poseTimestamps, poseMatrices = session[poseStreamName]
+    offsetSec, correlation = TemporalCalibration.estimateTimeOffset(
+      poseTimestamps, TemporalCalibration.positionSignal(poseMatrices),
+      frameTimestamps, TemporalCalibration.imageFeatureSignal(frames), maximumOffsetSec)
+    if correlation < minimumCorrelation:
+      logging.warning('Probe motion and image correlate only {0:.2f}, the temporal offset is not changed'.format(correlation))
     else:
-      if (self.pivotCalibrationLogic.GetSpinRMSE() >= float(calibrationErrorThresholdMm)):
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        return "Calibration failed:", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetSpinRMSE())
-      else:
-        toolTipToToolMatrix = vtk.vtkMatrix4x4()
-        self.pivotCalibrationLogic.GetToolTipToToolMatrix(toolTipToToolMatrix)
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        toolCalibrationResultNode.SetMatrixTransformToParent(toolTipToToolMatrix)
-
-        return "Calibration completed", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetSpinRMSE())
-
-  def landmarkRegistration(self, fromMarkupsNode, toMarkupsNode, outputTransformNode):
-    logging.debug('landmarkRegistration')
-
-    fromPoints = vtk.vtkPoints()
-    toPoints = vtk.vtkPoints()
-
-    nFromPoints = fromMarkupsNode.GetNumberOfFiducials()
-    nToPoints = toMarkupsNode.GetNumberOfFiducials()
-
-    if nFromPoints != nToPoints:
-      return 'Number of points in markups nodes are not equal. Error {0:.2f}', 1
+      self.frameToPoseTimeOffsetSec = offsetSec
+    return offsetSec, correlation
 
-    if nFromPoints < 3:
-      return 'Insufficient number of points in markups nodes. Error {0:.2f}', 2
-
-    for i in range(nFromPoints):
-      p = [0, 0, 0]
-      fromMarkupsNode.GetNthControlPointPositionWorld(i, p)
-      fromPoints.InsertNextPoint(p)
-      toMarkupsNode.GetNthControlPointPositionWorld(i, p)
-      toPoints.InsertNextPoint(p)
-
-    lt = vtk.vtkLandmarkTransform()
-    lt.SetSourceLandmarks(fromPoints)
-    lt.SetTargetLandmarks(toPoints)
-    lt.SetModeToSimilarity()
-    lt.Update()
-
-    resultsMatrix = vtk.vtkMatrix4x4()
-    lt.GetMatrix(resultsMatrix)
+  def startWorkerProcess(self, pollIntervalMs=50):
+    """
+    Start a Python process for heavy processing, so the navigation views keep updating at full
+    rate while it runs. Finished results are collected on the main thread every pollIntervalMs.
+    """
+    logging.debug('startWorkerProcess')
 
-    det = resultsMatrix.Determinant()
-    if det < 1e-8:
-      return 'Unstable registration. Check input for collinear points. Error {0:.2f}', 3
+    if self.workerProcess is not None:
+      return
+    # Inside Slicer sys.executable is the application, the worker runs in the bundled Python interpreter
+    pythonSlicerExecutable = shutil.which('PythonSlicer')
+    if pythonSlicerExecutable is None:
+      raise ValueError('PythonSlicer executable not found, the worker process can not be started')
+    self.workerProcess = WorkerProcess.WorkerProcess(pythonSlicerExecutable)
+    self.workerProcess.start()
+    self.workerTimer = qt.QTimer()
+    self.workerTimer.setInterval(pollIntervalMs)
+    self.workerTimer.connect('timeout()', self.workerProcess.poll)
+    self.workerTimer.start()
+
+  def stopWorkerProcess(self):
+    """
+    Stop the worker process. Callbacks of unfinished tasks are called with an error message.
+    """
+    if self.workerTimer is not None:
+      self.workerTimer.stop()
+      self.workerTimer = None
+    if self.workerProcess is not None:
+      self.workerProcess.stop()
+      self.workerProcess = None
+
+  def reconstructSessionInBackground(self, session, frameStreamName, poseStreamName, reconstructedVolumeNode,
+                                     pixelToPoseMatrix, poseToWorldMatrix=None, spacingMm=0.5, sweepMarginMm=40.0,
+                                     compoundingMode=VolumeReconstruction.AVERAGE, finishedCallback=None):
+    """
+    Compound the frames of a loaded session window in the worker process. Frames and their poses
+    are copied to shared memory once, the worker writes the volume into shared memory, and the
+    volume node is updated on the main thread when it is done.
+    :param session: dict of stream name to timestamps and items, see loadSessionWindow
+    :param pixelToPoseMatrix: (4, 4) matrix from (column, row, 0) pixel indices to the tracked tool,
+      e.g. the image IJKToRAS composed with ImageToProbe
+    :param poseToWorldMatrix: (4, 4) matrix from the tracker reference to world, identity if None
+    :param finishedCallback: called with the number of compounded frames and the error message,
+      None if the reconstruction succeeded
+    """
+    logging.debug('reconstructSessionInBackground')
+
+    _, frames = session[frameStreamName]
+    framePoses, valid = self.posesAtFrameTimes(session, frameStreamName, poseStreamName)
+    if not np.any(valid):
+      raise ValueError('No frame of {0} has a valid {1} pose'.format(frameStreamName, poseStreamName))
+    poseToWorldMatrix = np.eye(4) if poseToWorldMatrix is None else poseToWorldMatrix
+    pixelToWorldMatrices = np.matmul(np.matmul(poseToWorldMatrix, framePoses[valid]), pixelToPoseMatrix)
+    dimensions, voxelToWorldMatrix = VolumeReconstruction.volumeGeometryAroundFrame(
+      frames.shape[1:], pixelToWorldMatrices[0], spacingMm, sweepMarginMm)
+
+    self.startWorkerProcess()
+    sharedArrays = {
+      'frames': WorkerProcess.SharedArray.fromArray(frames[valid]),
+      'pixelToWorldMatrices': WorkerProcess.SharedArray.fromArray(pixelToWorldMatrices),
+      'volume': WorkerProcess.SharedArray(dimensions, np.float32),
+      }
+
+    def onReconstructionFinished(numberOfFrames, errorMessage):
+      if errorMessage is None:
+        ijkToRasMatrix = vtk.vtkMatrix4x4()
+        slicer.util.updateVTKMatrixFromArray(ijkToRasMatrix, voxelToWorldMatrix)
+        reconstructedVolumeNode.SetIJKToRASMatrix(ijkToRasMatrix)
+        slicer.util.updateVolumeFromArray(reconstructedVolumeNode, sharedArrays['volume'].array)
+      else:
+        logging.error('Background reconstruction failed:\n{0}'.format(errorMessage))
+      for sharedArray in sharedArrays.values():
+        sharedArray.close()
+      if finishedCallback is not None:
+        finishedCallback(numberOfFrames, errorMessage)
 
-    outputTransformNode.SetMatrixTransformToParent(resultsMatrix)
+    self.workerProcess.submit(VolumeReconstruction.reconstructFrames,
+                              keywordArguments={'voxelToWorldMatrix': voxelToWorldMatrix, 'compoundingMode': compoundingMode},
+                              sharedArrays=sharedArrays, callback=onReconstructionFinished)
 
-    return self.calculateRMSE(nFromPoints, fromPoints, toPoints, resultsMatrix)
+  def connectPlus(self, hostAndPort):
+    """
+    Connect to PLUS like NavigationLogic.connectPlus.
+    :raises RuntimeError: if the connector can not report the device timestamps used for the latency
+    """
+    if self.deviceTimestampAttributeName is None and not hasattr(slicer.vtkMRMLIGTLConnectorNode, 'GetIGTLTimeStamp'):
+      raise RuntimeError("This OpenIGTLinkIF version does not provide vtkMRMLIGTLConnectorNode.GetIGTLTimeStamp, "
+                         "update the SlicerOpenIGTLink extension to measure the stream latency")
+    NavigationLogic.connectPlus(self, hostAndPort)
+    self.streamStatistics.reset()
 
-  def calculateRMSE(self, nPoints, fromPoints, toPoints, transformMatrix):
-    logging.debug('calculateRMSE')
-    sumSquareError = 0
+  def plusMessageReceived(self, node, arrivalTime):
+    NavigationLogic.plusMessageReceived(self, node, arrivalTime)
+    self.streamStatistics.addSample(node.GetName(), arrivalTime, self.getDeviceTimestamp(node))
 
-    for i in range(nPoints):
-      pFrom = fromPoints.GetPoint(i)
-      pTo = toPoints.GetPoint(i)
+  def getDeviceTimestamp(self, node):
+    """
+    PLUS stamps each OpenIGTLink message header with the acquisition time of the item, as seconds
+    since the epoch. Latencies are only meaningful if the PLUS and Slicer computer clocks are synchronized.
+    The header timestamp is read with vtkMRMLIGTLConnectorNode.GetIGTLTimeStamp, which the
+    SlicerOpenIGTLink extension builds for Slicer 5.0 and later provide. connectPlus refuses older
+    connectors unless deviceTimestampAttributeName is set.
+    :return: device timestamp of the last message of node in seconds, None if not available
+    """
+    if self.deviceTimestampAttributeName is not None:
+      try:
+        return float(node.GetAttribute(self.deviceTimestampAttributeName))
+      except (TypeError, ValueError):
+        return None
+
+    if self.plusConnectionSupervisor is None:
+      return None
+    connectorNode = self.plusConnectionSupervisor.connector
+    second = vtk.reference(0)
+    nanosecond = vtk.reference(0)
+    if not connectorNode.GetIGTLTimeStamp(node, second, nanosecond):
+      return None
+    return int(second) + int(nanosecond) * 1e-9
+
+  def getStreamStatistics(self):
+    """
+    :return: dict of incoming stream name to StreamStatistics.StreamSummary with the rolling update
+      rate, jitter, latency and the time since the last message
+    """
+    return self.streamStatistics.summaries(time.time())
 
-      pFrom = [pFrom[0], pFrom[1], pFrom[2], 1]
-      transformMatrix.MultiplyPoint(pFrom, pFrom)
+  def getStreamHistogram(self, streamName, quantity=StreamStatistics.LATENCY, binEdges=np.linspace(0.0, 0.2, 21)):
+    """
+    :param quantity: StreamStatistics.LATENCY or StreamStatistics.INTERVAL between arrivals
+    :param binEdges: bin edges in seconds
+    :return: number of recent messages of the stream in each bin
+    """
+    return self.streamStatistics.histogram(streamName, quantity, binEdges)
 
-      dist = (pTo[0] - pFrom[0]) ** 2 + (pTo[1] - pFrom[1]) ** 2 + (pTo[2] - pFrom[2]) ** 2
-      sumSquareError += dist
+  def startNeedleGuidance(self, targetMarkupsNode, needleTipNode, referenceNode, imageVolumeNode=None,
+                          entryMarkupsNode=None, guidanceCallback=None):
+    """
+    Compute the needle guidance metrics on every coalesced update after a tracked transform has changed.
+    The targets are converted to Reference coordinates only when they are edited, see startCoalescedUpdates.
+    :param targetMarkupsNode: markups node of the biopsy targets
+    :param needleTipNode: NeedleTipToNeedle, its Z axis points from the tip towards the needle hub
+    :param referenceNode: ReferenceToRas, the metrics are computed in its coordinate system
+    :param imageVolumeNode: live ultrasound image the needle is intersected with, None to skip it
+    :param entryMarkupsNode: planned skin entry point of each target, in the same order as the targets
+    :param guidanceCallback: called with the NavigationMetrics.NeedleGuidance of every update
+    """
+    logging.debug('startNeedleGuidance')
+
+    self.stopNeedleGuidance()
+    self.needleNavigation = NavigationMetrics.NeedleNavigation()
+    self.needleGuidanceNodes = (targetMarkupsNode, entryMarkupsNode, needleTipNode, referenceNode, imageVolumeNode)
+    self.needleGuidanceCallback = guidanceCallback
+    for markupsNode in (targetMarkupsNode, entryMarkupsNode):
+      if markupsNode is None:
+        continue
+      for event in (slicer.vtkMRMLMarkupsNode.PointAddedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent,
+                    slicer.vtkMRMLMarkupsNode.PointRemovedEvent, slicer.vtkMRMLTransformableNode.TransformModifiedEvent):
+        self.needleGuidanceObservations.append((markupsNode, markupsNode.AddObserver(event, self.onNeedleTargetsModified)))
+    # The targets are placed in RAS, their Reference coordinates change with ReferenceToRas
+    self.needleGuidanceObservations.append((referenceNode, referenceNode.AddObserver(
+      slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onNeedleTargetsModified)))
+    self.registerTrackedUpdate('needleGuidance', self.updateNeedleGuidance)
+    self.onNeedleTargetsModified()
+
+  def onNeedleTargetsModified(self, caller=None, event=None):
+    targetMarkupsNode, entryMarkupsNode, _, referenceNode, _ = self.needleGuidanceNodes
+    worldTargets = slicer.util.arrayFromMarkupsControlPoints(targetMarkupsNode, world=True).reshape(-1, 3)
+    targets, _ = self.transformPointsBetweenNodes(worldTargets, None, referenceNode)
+    entries = None
+    if entryMarkupsNode is not None and entryMarkupsNode.GetNumberOfControlPoints() == targets.shape[0]:
+      worldEntries = slicer.util.arrayFromMarkupsControlPoints(entryMarkupsNode, world=True).reshape(-1, 3)
+      entries, _ = self.transformPointsBetweenNodes(worldEntries, None, referenceNode)
+    self.needleNavigation.setTargets(targets, entries)
+    self.updateScheduler.requestUpdate('needleGuidance')
+
+  def updateNeedleGuidance(self):
+    """
+    :return: NavigationMetrics.NeedleGuidance for the current needle pose
+    """
+    _, _, needleTipNode, referenceNode, imageVolumeNode = self.needleGuidanceNodes
+    if imageVolumeNode is not None and imageVolumeNode.GetImageData() is not None:
+      worldToReferenceMatrix = np.linalg.inv(self.getMatrixToWorld(referenceNode))
+      self.needleNavigation.setImagePlane(np.dot(worldToReferenceMatrix, self.getImageToWorldMatrix(imageVolumeNode)))
+    self.needleGuidance = self.needleNavigation.update(self.getMatrixToNode(needleTipNode, referenceNode))
+    if self.needleGuidanceCallback is not None:
+      self.needleGuidanceCallback(self.needleGuidance)
+    return self.needleGuidance
+
+  def stopNeedleGuidance(self):
+    for node, observerTag in self.needleGuidanceObservations:
+      node.RemoveObserver(observerTag)
+    self.needleGuidanceObservations = []
+    if self.needleNavigation is not None:
+      self.unregisterTrackedUpdate('needleGuidance')
+    self.needleNavigation = None
+    self.needleGuidanceNodes = None
+    self.needleGuidanceCallback = None
+
+  def startNeedleReslice(self, sliceNode, needleTipNode, lateralDirection=(1.0, 0.0, 0.0)):
+    """
+    Reslice along the needle on every coalesced update after a tracked transform has changed, see
+    startCoalescedUpdates. Only the SliceToRAS matrix of sliceNode is modified in place, the slice
+    view keeps its reslice filters and output images and only gets new reslice axes.
+    :param sliceNode: slice node of the view that follows the needle, e.g. Orange
+    :param needleTipNode: NeedleTipToNeedle, its Z axis points from the tip towards the needle hub
+    :param lateralDirection: RAS direction the slice columns follow as closely as possible
+    """
+    logging.debug('startNeedleReslice')
+
+    self.stopNeedleReslice()
+    self.needleResliceNodes = (sliceNode, needleTipNode)
+    self.needleResliceLateralDirection = lateralDirection
+    self.needleResliceMatrix = None
+    self.registerTrackedUpdate('needleReslice', self.updateNeedleReslice)
+    self.updateNeedleReslice()
+
+  def updateNeedleReslice(self):
+    sliceNode, needleTipNode = self.needleResliceNodes
+    sliceToRasMatrix = NavigationMetrics.needleAlignedSliceMatrix(self.getMatrixToWorld(needleTipNode),
+                                                                  self.needleResliceLateralDirection)
+    # Other tracked tools also trigger updates, the slice is only re-rendered when the needle moved
+    if self.needleResliceMatrix is not None and np.array_equal(sliceToRasMatrix, self.needleResliceMatrix):
+      return
+    self.needleResliceMatrix = sliceToRasMatrix
+    slicer.util.updateVTKMatrixFromArray(sliceNode.GetSliceToRAS(), sliceToRasMatrix)
+    sliceNode.UpdateMatrices()
 
-    RMSE = math.sqrt(sumSquareError / nPoints)
+  def stopNeedleReslice(self):
+    if self.needleResliceNodes is not None:
+      self.unregisterTrackedUpdate('needleReslice')
+    self.needleResliceNodes = None
+    self.needleResliceMatrix = None
 
-    return "Success. Error = {0:.2f} mm", RMSE
+  def setWobblerProbeGeometry(self, wobblerProbeGeometry, spacingMm):
+    """
+    :param wobblerProbeGeometry: ScanConversion.WobblerProbeGeometry of the probe and its current depth setting
+    :param spacingMm: voxel size of scan converted sweeps
+    """
+    if self.scanConversionCache is None:
+      self.scanConversionCache = ScanConversion.ScanConversionCache(wobblerProbeGeometry, spacingMm)
+    else:
+      self.scanConversionCache.setGeometry(wobblerProbeGeometry)
+      self.scanConversionCache.setSpacing(spacingMm)
 
-  def calculateSubtransform(self, AToCTransformNode, BToCTransformNode, outputTransformNode):
-    logging.debug('calculateSubtransform')
-    # In a transform hierarchy with A -> B -> C
-    # This function calculates the transform A -> B given the transforms B -> C and A -> C
-    AToCMatrix = vtk.vtkMatrix4x4()
+  def setWobblerProbeGeometryFromParameterNode(self, parameterNode, spacingMm):
+    """
+    Configure scan conversion from the WobblerProbeGeometry parameter, a JSON string written by
+    ScanConversion.geometryToJSON. Scan conversion stays unset while the parameter is empty.
+    :param spacingMm: voxel size of scan converted sweeps
+    :return: True if a wobbler probe geometry is configured
+    """
+    geometryJSON = parameterNode.GetParameter("WobblerProbeGeometry")
+    if not geometryJSON:
+      self.scanConversionCache = None
+      return False
+    self.setWobblerProbeGeometry(ScanConversion.geometryFromJSON(geometryJSON), spacingMm)
+    return True
+
+  def updateScanConversionTable(self, usToProbeNode):
+    """
+    :return: scan conversion table for the current USToProbe calibration, only rebuilt if the
+      calibration or the probe geometry has changed since the last call
+    """
+    if self.scanConversionCache is None:
+      return None
+    probeToUSMatrix = np.linalg.inv(slicer.util.arrayFromTransformMatrix(usToProbeNode))
+    return self.scanConversionCache.lookupTable(probeToUSMatrix)
 
-    CToBMatrix = vtk.vtkMatrix4x4()
+  def scanConvertSweep(self, sweep, usToProbeNode, outputVolumeNode):
+    """
+    Scan convert one raw wobbler sweep into outputVolumeNode. The volume is placed in the tracked
+    probe coordinate system, under the parent of usToProbeNode.
+    :param sweep: (frames, lines, samples) array in increasing motor angle order
+    """
+    logging.debug('scanConvertSweep')
 
-    resultsMatrix = vtk.vtkMatrix4x4()
-    resultsMatrix.Multiply4x4(CToBMatrix, AToCMatrix)
+    scanConversionTable = self.updateScanConversionTable(usToProbeNode)
+    if scanConversionTable is None:
+      raise ValueError("Wobbler probe geometry is not set")
+    volume = scanConversionTable.convert(sweep)
 
-    outputTransformNode.SetMatrixTransformToParent(resultsMatrix)
-    return
+    ijkToProbeMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(ijkToProbeMatrix, scanConversionTable.voxelToProbeMatrix)
+    outputVolumeNode.SetIJKToRASMatrix(ijkToProbeMatrix)
+    outputVolumeNode.SetAndObserveTransformNodeID(usToProbeNode.GetTransformNodeID())
+    slicer.util.updateVolumeFromArray(outputVolumeNode, volume)
 
 #
 # AbdominalBiopsyNavigationTest
@@ -752,53 +1596,661 @@ class AbdominalBiopsyNavigationTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_AbdominalBiopsyNavigation1()
+    self.test_LandmarkRegistration()
+    self.test_TransformPointsBetweenNodes()
+    self.test_VolumeReconstruction()
+    self.test_ScanConversion()
+    self.test_CineFreeze()
+    self.test_SessionRecording()
+    self.test_LivePoseInterpolation()
+    self.test_TemporalCalibration()
+    self.test_BackgroundReconstruction()
+    self.test_PlusConnection()
+    self.test_StreamStatistics()
+    self.test_CoalescedUpdates()
+    self.test_NeedleGuidance()
+    self.test_NeedleReslice()
+    self.test_Benchmark()
+
+  def test_LandmarkRegistration(self):
+    """ Register two fiducial lists related by a known similarity transform and check that
+    the transform is recovered and that degenerate input is rejected.
+    """
+
+    self.delayDisplay("Starting the landmark registration test")
+
+    fromPoints = np.array([[0, 0, 0], [50, 0, 0], [0, 80, 0], [0, 0, 30], [20, 40, 60]], dtype=float)
+    expectedMatrix = np.array([[0, -2, 0, 10], [2, 0, 0, -5], [0, 0, 2, 3], [0, 0, 0, 1]], dtype=float)
+    toPoints = np.dot(fromPoints, expectedMatrix[:3, :3].T) + expectedMatrix[:3, 3]
 
-  def test_AbdominalBiopsyNavigation1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    fromMarkupsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    toMarkupsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    for fromPoint, toPoint in zip(fromPoints, toPoints):
+      fromMarkupsNode.AddFiducialFromArray(fromPoint)
+      toMarkupsNode.AddFiducialFromArray(toPoint)
+    outputTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+
+    logic = AbdominalBiopsyNavigationLogic()
+    calibrationMessage, RMSE = logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, outputTransformNode)
+    self.assertTrue(calibrationMessage.startswith('Success'))
+    self.assertAlmostEqual(RMSE, 0.0, places=6)
+    resultMatrix = slicer.util.arrayFromTransformMatrix(outputTransformNode)
+    self.assertTrue(np.allclose(resultMatrix, expectedMatrix, atol=1e-6))
+    errorStatistics = logic.registrationErrorStatistics
+    self.assertEqual(errorStatistics.residuals.shape, fromPoints.shape)
+    self.assertAlmostEqual(errorStatistics.maximumError, 0.0, places=6)
+    self.assertAlmostEqual(errorStatistics.leaveOneOutRootMeanSquareError, 0.0, places=6)
+
+    # Collinear points must not produce a transform
+    collinearMarkupsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    for i in range(fromPoints.shape[0]):
+      collinearMarkupsNode.AddFiducialFromArray([i * 10.0, i * 5.0, 0.0])
+    calibrationMessage, errorCode = logic.landmarkRegistration(collinearMarkupsNode, toMarkupsNode, outputTransformNode)
+    self.assertEqual(errorCode, 3)
+
+    # A misplaced reference fiducial is rejected by the robust registration
+    toMarkupsNode.SetNthFiducialPositionFromArray(2, toPoints[2] + [15.0, -10.0, 5.0])
+    calibrationMessage, RMSE = logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, outputTransformNode,
+                                                          inlierThresholdMm=3.0)
+    self.assertTrue(calibrationMessage.startswith('Success'))
+    self.assertEqual(logic.rejectedFiducialIndices, [2])
+    self.assertAlmostEqual(RMSE, 0.0, places=6)
+    self.assertTrue(np.allclose(slicer.util.arrayFromTransformMatrix(outputTransformNode), expectedMatrix, atol=1e-6))
+
+    self.delayDisplay('Landmark registration test passed')
+
+  def test_TransformPointsBetweenNodes(self):
+    """ Map points through a CT -> Reference <- Probe <- US hierarchy and compare the cached result
+    with the matrices computed by MRML, also after a transform of the path is modified.
     """
 
-    self.delayDisplay("Starting the test")
+    self.delayDisplay("Starting the point transform test")
 
-    # Get/create input data
+    referenceToRas = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ReferenceToRas')
+    ctToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'CTToReference')
+    probeToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ProbeToReference')
+    usToProbe = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'USToProbe')
+    ctToReference.SetAndObserveTransformNodeID(referenceToRas.GetID())
+    probeToReference.SetAndObserveTransformNodeID(referenceToRas.GetID())
+    usToProbe.SetAndObserveTransformNodeID(probeToReference.GetID())
 
-    import SampleData
-    inputVolume = SampleData.downloadFromURL(
-      nodeNames='MRHead',
-      fileNames='MR-Head.nrrd',
-      uris='https://github.com/Slicer/SlicerTestingData/releases/download/MD5/39b01631b7b38232a220007230624c8e',
-      checksums='MD5:39b01631b7b38232a220007230624c8e')[0]
-    self.delayDisplay('Finished with download and loading')
+    def setMatrix(transformNode, rotationAxis, angleDeg, translation):
+      transform = vtk.vtkTransform()
+      transform.Translate(translation)
+      transform.RotateWXYZ(angleDeg, rotationAxis)
+      transformNode.SetMatrixTransformToParent(transform.GetMatrix())
 
-    inputScalarRange = inputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(inputScalarRange[0], 0)
-    self.assertEqual(inputScalarRange[1], 279)
+    setMatrix(referenceToRas, [0, 0, 1], 90, [10, 0, 0])
+    setMatrix(ctToReference, [1, 0, 0], 30, [0, 20, 5])
+    setMatrix(probeToReference, [0, 1, 0], -45, [100, -30, 60])
+    setMatrix(usToProbe, [1, 1, 0], 12, [-20, 0, 15])
 
-    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
-    threshold = 50
+    logic = AbdominalBiopsyNavigationLogic()
+    logic.setupTransformTreeCache([ctToReference, usToProbe])
 
-    # Test the module logic
+    points = np.random.RandomState(0).uniform(-100, 100, (1000, 3))
+    for step in range(2):
+      ctToUSMatrix = vtk.vtkMatrix4x4()
+      ctToReference.GetMatrixTransformToNode(usToProbe, ctToUSMatrix)
+      expectedMatrix = slicer.util.arrayFromVTKMatrix(ctToUSMatrix)
 
+      pointsInUS, resultMatrix = logic.transformPointsBetweenNodes(points, ctToReference, usToProbe)
+      self.assertTrue(np.allclose(resultMatrix, expectedMatrix, atol=1e-9))
+      self.assertTrue(np.allclose(pointsInUS, np.dot(points, expectedMatrix[:3, :3].T) + expectedMatrix[:3, 3], atol=1e-9))
+
+      pointsInRas, resultMatrix = logic.transformPointsBetweenNodes(pointsInUS, usToProbe, None)
+      self.assertTrue(np.allclose(logic.transformPointsBetweenNodes(pointsInRas, None, ctToReference)[0], points, atol=1e-9))
+
+      # Tracker update of a transform in the middle of the path
+      setMatrix(probeToReference, [0, 1, 1], 20, [90, -25, 70])
+
+    logic.removeTransformTreeCache()
+    self.delayDisplay('Point transform test passed')
+
+  def test_VolumeReconstruction(self):
+    """ Sweep a tracked image plane through a sphere phantom and check the reconstructed volume.
+    """
+
+    self.delayDisplay("Starting the volume reconstruction test")
+
+    usToProbe = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'USToProbe')
+    ultrasoundVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Ultrasound_Ultrasound')
+    ultrasoundVolumeNode.SetSpacing(0.5, 0.5, 1.0)
+    ultrasoundVolumeNode.SetAndObserveTransformNodeID(usToProbe.GetID())
+    reconstructedVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ReconstructedUltrasound')
+
+    sphereCenter = np.array([30.0, 25.0, 0.0])
+    rows, columns = np.indices((100, 120))
     logic = AbdominalBiopsyNavigationLogic()
+    logic.startVolumeReconstruction(ultrasoundVolumeNode, reconstructedVolumeNode, spacingMm=1.0, sweepMarginMm=15.0)
+    for angleDeg in np.linspace(-20, 20, 41):
+      # Wobble the image plane around its top edge
+      transform = vtk.vtkTransform()
+      transform.RotateX(angleDeg)
+      usToProbe.SetMatrixTransformToParent(transform.GetMatrix())
+      usPoints = np.stack([columns * 0.5, rows * 0.5, np.zeros(rows.shape)], axis=-1)
+      probePoints = np.dot(usPoints, slicer.util.arrayFromTransformMatrix(usToProbe)[:3, :3].T)
+      frame = np.where(np.linalg.norm(probePoints - sphereCenter, axis=-1) < 10.0, 200, 20).astype(np.uint8)
+      slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, frame[np.newaxis])
+    logic.stopVolumeReconstruction()
+
+    reconstructedArray = slicer.util.arrayFromVolume(reconstructedVolumeNode)
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    reconstructedVolumeNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    def valueAt(point):
+      i, j, k = np.rint(np.dot(slicer.util.arrayFromVTKMatrix(rasToIjkMatrix), np.append(point, 1.0))[:3]).astype(int)
+      return reconstructedArray[k, j, i]
+    self.assertAlmostEqual(valueAt(sphereCenter + [0.0, 0.0, 5.0]), 200.0, delta=1.0)
+    self.assertAlmostEqual(valueAt([50.0, 45.0, 5.0]), 20.0, delta=1.0)
+    self.assertEqual(logic.reconstructionThread, None)
+
+    self.delayDisplay('Volume reconstruction test passed')
+
+  def test_ScanConversion(self):
+    """ Scan convert a synthetic wobbler sweep and check that the lookup table is only rebuilt
+    when the USToProbe calibration changes.
+    """
+
+    self.delayDisplay("Starting the scan conversion test")
+
+    geometry = ScanConversion.WobblerProbeGeometry(
+      transducerRadiusMm=40.0, fieldOfViewDeg=60.0, numberOfLines=64, numberOfSamples=128, depthMm=60.0,
+      motorRadiusMm=15.0, motorAnglesDeg=np.linspace(-20.0, 20.0, 21))
+    frames, lines, samples = np.indices((21, 64, 128))
+    # Intensity grows with the distance from the center of curvature of the array
+    sweep = (samples * 2).astype(np.uint8)
+
+    probeToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ProbeToReference')
+    usToProbe = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'USToProbe')
+    usToProbe.SetAndObserveTransformNodeID(probeToReference.GetID())
+    outputVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ScanConvertedSweep')
+
+    logic = AbdominalBiopsyNavigationLogic()
+    parameterNode = logic.getParameterNode()
+    self.assertFalse(logic.setWobblerProbeGeometryFromParameterNode(parameterNode, 1.0))
+    self.assertIsNone(logic.scanConversionCache)
+    parameterNode.SetParameter("WobblerProbeGeometry", ScanConversion.geometryToJSON(geometry))
+    self.assertTrue(logic.setWobblerProbeGeometryFromParameterNode(parameterNode, 1.0))
+    logic.scanConvertSweep(sweep, usToProbe, outputVolumeNode)
+    logic.scanConvertSweep(sweep, usToProbe, outputVolumeNode)
+    self.assertEqual(logic.scanConversionCache.numberOfBuilds, 1)
+    self.assertEqual(outputVolumeNode.GetParentTransformNode(), probeToReference)
+
+    # Sample along the central scan line of the central frame
+    volume = slicer.util.arrayFromVolume(outputVolumeNode)
+    rasToIjkMatrix = vtk.vtkMatrix4x4()
+    outputVolumeNode.GetRASToIJKMatrix(rasToIjkMatrix)
+    i, j, k = np.rint(np.dot(slicer.util.arrayFromVTKMatrix(rasToIjkMatrix), [0.0, 15.0 + 40.0 + 30.0, 0.0, 1.0])[:3]).astype(int)
+    self.assertAlmostEqual(float(volume[k, j, i]), 30.0 / 60.0 * 127 * 2, delta=3.0)
+
+    transform = vtk.vtkTransform()
+    transform.Translate(5.0, 0.0, 0.0)
+    usToProbe.SetMatrixTransformToParent(transform.GetMatrix())
+    logic.scanConvertSweep(sweep, usToProbe, outputVolumeNode)
+    self.assertEqual(logic.scanConversionCache.numberOfBuilds, 2)
+
+    self.delayDisplay('Scan conversion test passed')
+
+  def test_CineFreeze(self):
+    """ Stream more frames than the cine buffer holds, freeze and scroll back through the loop.
+    """
+
+    self.delayDisplay("Starting the cine freeze test")
+
+    ultrasoundVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Ultrasound_Ultrasound')
+    frozenVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'FrozenUltrasound')
+    logic = AbdominalBiopsyNavigationLogic()
+    logic.startCineRecording(ultrasoundVolumeNode, capacity=10)
+    for frameIndex in range(25):
+      slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, np.full((1, 40, 60), frameIndex, dtype=np.uint8))
+      # Frames are timestamped on arrival, keep them apart for the coarse clock of some platforms
+      time.sleep(0.02)
+
+    self.assertEqual(logic.freezeUltrasound(frozenVolumeNode), 10)
+    self.assertEqual(slicer.util.arrayFromVolume(frozenVolumeNode)[0, 0, 0], 24)
+    # The loop covers the last ten frames, a frame is found again by its acquisition time
+    self.assertGreater(logic.cineBuffer.duration(), 9 * 0.015)
+    self.assertEqual(logic.cineBuffer.ageAtTime(logic.cineBuffer.frame(9)[2]), 9)
+    self.assertEqual(logic.cineBuffer.ageAtTime(time.time() + 10.0), 0)
+    # Frames received while frozen are not recorded
+    slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, np.full((1, 40, 60), 100, dtype=np.uint8))
+    logic.showCineFrame(9)
+    self.assertEqual(slicer.util.arrayFromVolume(frozenVolumeNode)[0, 0, 0], 15)
+    self.assertRaises(ValueError, logic.showCineFrame, 10)
+
+    logic.unfreezeUltrasound()
+    slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, np.full((1, 40, 60), 200, dtype=np.uint8))
+    self.assertEqual(slicer.util.arrayFromVolume(frozenVolumeNode)[0, 0, 0], 15)
+    self.assertEqual(logic.cineBuffer.frame(0)[0][0, 0], 200)
+    logic.stopCineRecording()
+
+    self.delayDisplay('Cine freeze test passed')
+
+  def test_SessionRecording(self):
+    """ Record tracked frames in small chunks and read back a window from the middle of the session.
+    """
+
+    self.delayDisplay("Starting the session recording test")
+
+    import tempfile
+    probeToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ProbeToReference')
+    ultrasoundVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Ultrasound_Ultrasound')
+    sessionDirectory = os.path.join(tempfile.mkdtemp(), 'Session')
+    logic = AbdominalBiopsyNavigationLogic()
+    logic.startSessionRecording(sessionDirectory, ultrasoundVolumeNode, [probeToReference], chunkSize=4)
+    for frameIndex in range(10):
+      transform = vtk.vtkTransform()
+      transform.Translate(frameIndex, 0.0, 0.0)
+      probeToReference.SetMatrixTransformToParent(transform.GetMatrix())
+      slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, np.full((1, 20, 30), frameIndex, dtype=np.uint8))
+      time.sleep(0.01)
+    logic.stopSessionRecording()
+
+    session = logic.loadSessionWindow(sessionDirectory, 0.0, 3600.0)
+    timestamps, frames = session['Ultrasound_Ultrasound']
+    self.assertEqual(frames.shape, (10, 20, 30))
+    self.assertTrue(np.all(np.diff(timestamps) > 0))
+    # Initial pose and one pose per frame
+    self.assertEqual(session['ProbeToReference'][1].shape, (11, 4, 4))
+
+    # Frames are 10 ms apart, the margin absorbs rounding of the relative times
+    windowStart = timestamps[3] - session['ProbeToReference'][0][0] - 0.001
+    windowStop = timestamps[6] - session['ProbeToReference'][0][0] + 0.001
+    _, windowFrames = logic.loadSessionWindow(sessionDirectory, windowStart, windowStop)['Ultrasound_Ultrasound']
+    self.assertEqual(list(windowFrames[:, 0, 0]), [3, 4, 5, 6])
+
+    # Single items are looked up by time without loading the stream
+    sessionReader = SessionRecording.SessionReader(sessionDirectory)
+    frameTimestamp, frame = sessionReader.itemAtTime('Ultrasound_Ultrasound', timestamps[4] + 0.002)
+    self.assertEqual(frameTimestamp, timestamps[4])
+    self.assertEqual(frame[0, 0], 4)
+    _, probeToReferenceMatrix = sessionReader.itemAtTime('ProbeToReference', timestamps[4])
+    self.assertEqual(probeToReferenceMatrix[0, 3], 4.0)
+
+    # Each frame arrives shortly after the pose translated by its index
+    framePoses, valid = logic.posesAtFrameTimes(session, 'Ultrasound_Ultrasound', 'ProbeToReference')
+    self.assertTrue(np.all(valid))
+    self.assertTrue(np.all(np.abs(framePoses[:, 0, 3] - np.arange(10)) < 0.5))
+
+    self.delayDisplay('Session recording test passed')
+
+  def test_LivePoseInterpolation(self):
+    """ Stream a frame between two tracked poses and check that the frame waits for the second pose
+    and is reconstructed with the pose interpolated at its arrival time.
+    """
+
+    self.delayDisplay("Starting the live pose interpolation test")
+
+    probeToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ProbeToReference')
+    usToProbe = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'USToProbe')
+    usToProbe.SetAndObserveTransformNodeID(probeToReference.GetID())
+    ultrasoundVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Ultrasound_Ultrasound')
+    ultrasoundVolumeNode.SetAndObserveTransformNodeID(usToProbe.GetID())
+    reconstructedVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'ReconstructedUltrasound')
+
+    logic = AbdominalBiopsyNavigationLogic()
+    posedFrameMatrices = []
+    logic.addReconstructionFrame = lambda frame, pixelToWorldMatrix: posedFrameMatrices.append(pixelToWorldMatrix)
+    logic.startVolumeReconstruction(ultrasoundVolumeNode, reconstructedVolumeNode, trackedTransformNode=probeToReference)
+    time.sleep(0.05)
+    slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, np.zeros((1, 20, 30), dtype=np.uint8))
+    self.assertEqual(posedFrameMatrices, [])
+    time.sleep(0.05)
+    transform = vtk.vtkTransform()
+    transform.Translate(10.0, 0.0, 0.0)
+    probeToReference.SetMatrixTransformToParent(transform.GetMatrix())
+    logic.stopVolumeReconstruction()
+
+    # The frame arrived about halfway between the two poses
+    self.assertEqual(len(posedFrameMatrices), 1)
+    self.assertTrue(2.0 < posedFrameMatrices[0][0, 3] < 8.0)
+    self.assertEqual(logic.pendingReconstructionFrames, [])
+
+    self.delayDisplay('Live pose interpolation test passed')
+
+  def test_TemporalCalibration(self):
+    """ Simulate a probe moved up and down over a bright line whose images lag the tracker, and
+    check that the lag is found and corrected when frames are matched to poses.
+    """
+
+    self.delayDisplay("Starting the temporal calibration test")
+
+    imageLagSec = 0.08
+    motion = lambda t: 15.0 * np.sin(2.0 * np.pi * 0.6 * t) + 5.0 * np.sin(2.0 * np.pi * 1.1 * t)
+    poseTimestamps = np.arange(0.0, 8.0, 1.0 / 60.0)
+    poseMatrices = np.tile(np.eye(4), (poseTimestamps.size, 1, 1))
+    poseMatrices[:, 2, 3] = motion(poseTimestamps)
+    frameTimestamps = np.arange(0.1, 8.0, 1.0 / 25.0)
+    lineRows = 100.0 - 2.0 * motion(frameTimestamps - imageLagSec)
+    rows = np.arange(200)[np.newaxis, :, np.newaxis]
+    frames = np.repeat(255.0 * np.exp(-(rows - lineRows[:, np.newaxis, np.newaxis]) ** 2 / 8.0), 64, axis=2).astype(np.uint8)
+    session = {'Ultrasound_Ultrasound': (frameTimestamps, frames), 'ProbeToReference': (poseTimestamps, poseMatrices)}
+
+    logic = AbdominalBiopsyNavigationLogic()
+    startTime = time.time()
+    offsetSec, correlation = logic.calibrateTemporalOffset(session, 'Ultrasound_Ultrasound', 'ProbeToReference')
+    logging.info('Temporal calibration took {0:.3f} s'.format(time.time() - startTime))
+    self.assertAlmostEqual(offsetSec, -imageLagSec, delta=0.005)
+    self.assertGreater(correlation, 0.95)
+
+    framePoses, valid = logic.posesAtFrameTimes(session, 'Ultrasound_Ultrasound', 'ProbeToReference')
+    self.assertTrue(np.all(np.abs(framePoses[valid, 2, 3] - motion(frameTimestamps[valid] - imageLagSec)) < 0.2))
+
+    self.delayDisplay('Temporal calibration test passed')
+
+  def test_BackgroundReconstruction(self):
+    """ Reconstruct a simulated sweep in the worker process and check that the main thread keeps
+    running while it does, and that the result matches a reconstruction on the main thread.
+    """
+
+    self.delayDisplay("Starting the background reconstruction test")
+
+    numberOfFrames = 40
+    frames = np.random.RandomState(0).randint(0, 255, (numberOfFrames, 120, 90)).astype(np.uint8)
+    timestamps = np.arange(numberOfFrames) / 30.0
+    poseMatrices = np.tile(np.eye(4), (numberOfFrames, 1, 1))
+    poseMatrices[:, 2, 3] = np.arange(numberOfFrames) * 0.5
+    session = {'Ultrasound_Ultrasound': (timestamps, frames), 'ProbeToReference': (timestamps, poseMatrices)}
+    pixelToProbeMatrix = np.diag([0.5, 0.5, 0.5, 1.0])
+
+    reconstructedVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'BackgroundReconstruction')
+    logic = AbdominalBiopsyNavigationLogic()
+    finished = []
+    logic.reconstructSessionInBackground(session, 'Ultrasound_Ultrasound', 'ProbeToReference', reconstructedVolumeNode,
+                                         pixelToProbeMatrix, spacingMm=0.5, sweepMarginMm=5.0,
+                                         finishedCallback=lambda frameCount, errorMessage: finished.append((frameCount, errorMessage)))
+    numberOfMainThreadIterations = 0
+    startTime = time.time()
+    while not finished and time.time() - startTime < 60.0:
+      slicer.app.processEvents()
+      numberOfMainThreadIterations += 1
+    logic.stopWorkerProcess()
+
+    self.assertEqual(finished, [(numberOfFrames, None)])
+    self.assertGreater(numberOfMainThreadIterations, 1)
+    dimensions, voxelToWorldMatrix = VolumeReconstruction.volumeGeometryAroundFrame(
+      frames.shape[1:], np.dot(poseMatrices[0], pixelToProbeMatrix), 0.5, 5.0)
+    expectedVolume = np.zeros(dimensions, dtype=np.float32)
+    VolumeReconstruction.reconstructFrames(frames, np.matmul(poseMatrices, pixelToProbeMatrix), expectedVolume, voxelToWorldMatrix)
+    self.assertTrue(np.allclose(slicer.util.arrayFromVolume(reconstructedVolumeNode), expectedVolume))
+
+    # Stopping the worker right after submitting still hands the task back, so its shared memory is released
+    finished = []
+    logic.reconstructSessionInBackground(session, 'Ultrasound_Ultrasound', 'ProbeToReference', reconstructedVolumeNode,
+                                         pixelToProbeMatrix, spacingMm=0.5, sweepMarginMm=5.0,
+                                         finishedCallback=lambda frameCount, errorMessage: finished.append((frameCount, errorMessage)))
+    logic.stopWorkerProcess()
+    self.assertEqual(len(finished), 1)
+
+    self.delayDisplay('Background reconstruction test passed')
+
+  def test_PlusConnection(self):
+    """ Record a short session of poses and images, replay it from a local server standing in for
+    PLUS and check that both arrive and their message rates are reported.
+    """
+
+    self.delayDisplay("Starting the PLUS connection test")
+
+    if not hasattr(slicer, 'vtkMRMLIGTLConnectorNode'):
+      self.delayDisplay('OpenIGTLinkIF is not available, PLUS connection test skipped')
+      return
+
+    import tempfile
+    from WobblerNavigationLib import OpenIGTLink
+    probeToReferenceMatrix = np.eye(4)
+    probeToReferenceMatrix[:3, 3] = [10.0, 20.0, 30.0]
+    sessionRecorder = SessionRecording.SessionRecorder(os.path.join(tempfile.mkdtemp(), 'Session'), chunkSize=16)
+    sessionRecorder.addStream('ProbeToReference', (4, 4), np.float64)
+    sessionRecorder.addStream('Ultrasound_Ultrasound', (20, 30), np.uint8)
+    for index in range(50):
+      sessionRecorder.append('ProbeToReference', probeToReferenceMatrix, index * 0.02)
+      sessionRecorder.append('Ultrasound_Ultrasound', np.full((20, 30), 7, dtype=np.uint8), index * 0.02 + 0.01)
+    sessionRecorder.close()
+    # OpenIGTLink device names have at most 20 characters
+    messages = OpenIGTLink.replayMessagesFromSession(SessionRecording.SessionReader(sessionRecorder.directory),
+                                                     deviceNames={'Ultrasound_Ultrasound': 'Image_Reference'})
+    replayServer = OpenIGTLink.ReplayServer(messages)
+    replayServer.start()
+
+    logic = AbdominalBiopsyNavigationLogic()
+    logic.connectPlus('localhost:{0}'.format(replayServer.port))
+    state, streamRates = PlusConnection.OFF, {}
+    startTime = time.time()
+    while time.time() - startTime < 10.0 and not (streamRates.get('ProbeToReference') and streamRates.get('Image_Reference')):
+      slicer.app.processEvents()
+      time.sleep(0.05)
+      state, streamRates = logic.pollPlusConnection()
+    connectedSec = logic.plusConnectionSupervisor.timeInState(time.time())
+    probeToReference = slicer.util.getFirstNodeByName('ProbeToReference', className='vtkMRMLLinearTransformNode')
+    imageReference = slicer.util.getFirstNodeByName('Image_Reference', className='vtkMRMLScalarVolumeNode')
+    logic.disconnectPlus()
+    replayServer.stop()
+
+    self.assertEqual(state, PlusConnection.CONNECTED)
+    self.assertTrue(0.0 <= connectedSec <= time.time() - startTime)
+    self.assertGreater(streamRates['ProbeToReference'], 0.0)
+    self.assertGreater(streamRates['Image_Reference'], 0.0)
+    self.assertIn('ProbeToReference', logic.getStreamStatistics())
+    self.assertIn('Image_Reference', logic.getStreamStatistics())
+    # The replay server stamps the headers when sending, like a device on a synchronized clock
+    self.assertTrue(0.0 <= logic.getStreamStatistics()['ProbeToReference'].latencyMeanSec < 1.0)
+    self.assertTrue(np.allclose(slicer.util.arrayFromTransformMatrix(probeToReference), probeToReferenceMatrix))
+    self.assertEqual(slicer.util.arrayFromVolume(imageReference).shape, (1, 20, 30))
+    self.assertTrue(np.all(slicer.util.arrayFromVolume(imageReference) == 7))
+
+    self.delayDisplay('PLUS connection test passed')
+
+  def test_StreamStatistics(self):
+    """ Feed messages with known device and arrival times through the logic and check the rate,
+    jitter and latency of the stream.
+    """
+
+    self.delayDisplay("Starting the stream statistics test")
+
+    probeToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ProbeToReference')
+    logic = AbdominalBiopsyNavigationLogic()
+    logic.deviceTimestampAttributeName = 'DeviceTimestamp'
+    for index in range(20):
+      # Acquired every 50 ms, arriving 20 or 30 ms later
+      deviceTime = 1000.0 + 0.05 * index
+      probeToReference.SetAttribute('DeviceTimestamp', repr(deviceTime))
+      logic.plusMessageReceived(probeToReference, deviceTime + 0.02 + 0.01 * (index % 2))
+
+    summary = logic.streamStatistics.summary('ProbeToReference', 1000.0 + 0.05 * 19 + 0.1)
+    self.assertEqual(summary.numberOfSamples, 20)
+    # The first message arrives 20 ms and the last one 30 ms after acquisition
+    self.assertAlmostEqual(summary.meanIntervalSec, 0.96 / 19, places=6)
+    self.assertAlmostEqual(summary.updateRateHz, 19 / 0.96, places=6)
+    self.assertAlmostEqual(summary.jitterSec, 0.01, delta=0.0005)
+    self.assertAlmostEqual(summary.latencyMeanSec, 0.025, places=6)
+    self.assertAlmostEqual(summary.latencyMaximumSec, 0.03, places=6)
+    self.assertAlmostEqual(summary.ageSec, 0.07, places=6)
+    latencyHistogram = logic.getStreamHistogram('ProbeToReference', binEdges=np.array([0.0, 0.025, 0.05]))
+    self.assertEqual(list(latencyHistogram), [10, 10])
+
+    # Messages without a device timestamp count for the rate, not the latency
+    probeToReference.RemoveAttribute('DeviceTimestamp')
+    self.assertIsNone(logic.getDeviceTimestamp(probeToReference))
+
+    self.delayDisplay('Stream statistics test passed')
+
+  def test_CoalescedUpdates(self):
+    """ Modify a tracked transform many times between two ticks and check that the registered
+    update runs once, with the newest pose, and that a failing update does not keep the views paused.
+    """
+
+    self.delayDisplay("Starting the coalesced updates test")
+
+    needleToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleToReference')
+    logic = AbdominalBiopsyNavigationLogic()
+    updatedPositions = []
+    logic.registerTrackedUpdate('needleTip', lambda: updatedPositions.append(
+      slicer.util.arrayFromTransformMatrix(needleToReference)[0, 3]))
+    redSliceView = slicer.app.layoutManager().sliceWidget('Red').sliceView()
+    logic.startCoalescedUpdates([needleToReference], maximumRateHz=20.0, views=[redSliceView])
+    self.assertEqual(logic.pausedViews, [redSliceView])
+    for position in range(100):
+      transform = vtk.vtkTransform()
+      transform.Translate(position, 0.0, 0.0)
+      needleToReference.SetMatrixTransformToParent(transform.GetMatrix())
+    self.assertEqual(updatedPositions, [])
+    logic.onUpdateTick()
+    # Nothing changed since the last tick, nothing runs
+    logic.onUpdateTick()
+    self.assertEqual(updatedPositions, [99.0])
+    self.assertEqual(logic.updateScheduler.numberOfRuns, 1)
+    # One run served all transform modifications
+    self.assertEqual(logic.updateScheduler.coalescingRatio(), 100.0)
+
+    failedUpdates = []
+    def failingUpdate():
+      failedUpdates.append(True)
+      raise RuntimeError('Update failed')
+    logic.registerTrackedUpdate('failing', failingUpdate)
+    logic.updateScheduler.requestUpdate('failing')
+    # Wait one period of the update rate, the error is logged and not raised into the timer
+    time.sleep(0.1)
+    logic.onUpdateTick()
+    self.assertEqual(failedUpdates, [True])
+    logic.stopCoalescedUpdates()
+    self.assertEqual(logic.pausedViews, [])
+
+    self.delayDisplay('Coalesced updates test passed')
+
+  def test_NeedleGuidance(self):
+    """ Place a target in RAS, move a tracked needle towards it and check the distance, the angular
+    deviation from the planned trajectory and where the needle crosses the ultrasound image.
+    """
+
+    self.delayDisplay("Starting the needle guidance test")
+
+    referenceToRas = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ReferenceToRas')
+    needleToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleToReference')
+    needleTipToNeedle = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleTipToNeedle')
+    needleToReference.SetAndObserveTransformNodeID(referenceToRas.GetID())
+    needleTipToNeedle.SetAndObserveTransformNodeID(needleToReference.GetID())
+    transform = vtk.vtkTransform()
+    transform.Translate(10.0, -20.0, 5.0)
+    transform.RotateZ(30.0)
+    referenceToRas.SetMatrixTransformToParent(transform.GetMatrix())
+    referenceToRasMatrix = slicer.util.arrayFromTransformMatrix(referenceToRas)
+
+    def toRas(point):
+      return np.dot(referenceToRasMatrix, np.append(point, 1.0))[:3]
+
+    # Target 100 mm deep along Reference +Z, planned straight down from an entry point at the origin
+    targetNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'NeedleTarget')
+    targetNode.AddControlPoint(toRas([0.0, 0.0, 100.0]))
+    entryNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'NeedleEntry')
+    entryNode.AddControlPoint(toRas([0.0, 0.0, 0.0]))
+
+    # Image plane at Reference Z = 60 mm, 0.2 mm pixels
+    imageNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Ultrasound')
+    imageNode.SetAndObserveTransformNodeID(referenceToRas.GetID())
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(500, 500, 1)
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    imageNode.SetAndObserveImageData(imageData)
+    imageNode.SetSpacing(0.2, 0.2, 1.0)
+    imageNode.SetOrigin(-50.0, -50.0, 60.0)
+
+    logic = AbdominalBiopsyNavigationLogic()
+    guidances = []
+    logic.startNeedleGuidance(targetNode, needleTipToNeedle, referenceToRas, imageNode, entryNode, guidances.append)
+    logic.updateNeedleGuidance()
+
+    # Tip 3 mm off the planned trajectory, 20 mm deep, the needle Z axis points back towards the hub
+    needleTipMatrix = np.diag([1.0, -1.0, -1.0, 1.0])
+    needleTipMatrix[:3, 3] = [3.0, 0.0, 20.0]
+    slicer.util.updateTransformMatrixFromArray(needleToReference, needleTipMatrix)
+    guidance = logic.updateNeedleGuidance()
+    self.assertAlmostEqual(guidance.tipToTargetDistancesMm[0], np.hypot(3.0, 80.0), places=6)
+    self.assertAlmostEqual(guidance.depthsToTargetsMm[0], 80.0, places=6)
+    self.assertAlmostEqual(guidance.lateralDeviationsMm[0], 3.0, places=6)
+    self.assertAlmostEqual(guidance.angularDeviationsDeg[0], 0.0, places=4)
+    self.assertTrue(np.allclose(guidance.imagePlaneIntersection, [3.0, 0.0, 60.0]))
+    self.assertTrue(np.allclose(guidance.imagePlaneIntersectionPixel, [265.0, 250.0]))
+    self.assertAlmostEqual(guidance.tipToImagePlaneDistanceMm, 40.0, places=6)
+
+    # Moving the target is picked up without restarting the guidance
+    targetNode.SetNthControlPointPosition(0, toRas([3.0, 0.0, 100.0]))
+    guidance = logic.updateNeedleGuidance()
+    self.assertAlmostEqual(guidance.lateralDeviationsMm[0], 0.0, places=6)
+    self.assertAlmostEqual(guidance.angularDeviationsDeg[0], np.degrees(np.arctan2(3.0, 100.0)), places=4)
+    self.assertEqual(len(guidances), 3)
+
+    # So is a new registration of Reference to RAS
+    transform.Translate(0.0, 0.0, 10.0)
+    referenceToRas.SetMatrixTransformToParent(transform.GetMatrix())
+    guidance = logic.updateNeedleGuidance()
+    self.assertAlmostEqual(guidance.depthsToTargetsMm[0], 70.0, places=6)
+
+    logic.stopNeedleGuidance()
+    self.assertEqual(logic.needleGuidanceObservations, [])
+
+    self.delayDisplay('Needle guidance test passed')
+
+  def test_NeedleReslice(self):
+    """ Move a tracked needle and check that the slice node follows the needle shaft by updating
+    its existing SliceToRAS matrix.
+    """
+
+    self.delayDisplay("Starting the needle reslice test")
+
+    needleToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleToReference')
+    needleTipToNeedle = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleTipToNeedle')
+    needleTipToNeedle.SetAndObserveTransformNodeID(needleToReference.GetID())
+    sliceNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSliceNode', 'NeedleSlice')
+    sliceToRas = sliceNode.GetSliceToRAS()
+
+    logic = AbdominalBiopsyNavigationLogic()
+    logic.startCoalescedUpdates([needleToReference])
+    logic.startNeedleReslice(sliceNode, needleTipToNeedle)
+
+    transform = vtk.vtkTransform()
+    transform.Translate(10.0, 20.0, 30.0)
+    transform.RotateX(40.0)
+    transform.RotateY(-25.0)
+    needleToReference.SetMatrixTransformToParent(transform.GetMatrix())
+    logic.onUpdateTick()
+    logic.stopCoalescedUpdates()
+
+    needleTipToRasMatrix = slicer.util.arrayFromTransformMatrix(needleTipToNeedle, toWorld=True)
+    sliceToRasMatrix = slicer.util.arrayFromVTKMatrix(sliceNode.GetSliceToRAS())
+    self.assertIs(sliceNode.GetSliceToRAS(), sliceToRas)
+    # Slice centered at the tip, rows along the shaft towards the hub
+    self.assertTrue(np.allclose(sliceToRasMatrix[:3, 3], needleTipToRasMatrix[:3, 3]))
+    self.assertTrue(np.allclose(sliceToRasMatrix[:3, 1], needleTipToRasMatrix[:3, 2]))
+    self.assertTrue(np.allclose(np.dot(sliceToRasMatrix[:3, :3].T, sliceToRasMatrix[:3, :3]), np.eye(3)))
+
+    logic.stopNeedleReslice()
+    self.assertIsNone(logic.needleResliceNodes)
+
+    self.delayDisplay('Needle reslice test passed')
+
+  def test_Benchmark(self):
+    """ Run the benchmarks of the numerical core at small sizes, so that a broken benchmark is
+    noticed without waiting for the full run, and compare them to the reference baseline with a
+    loose tolerance. Tight comparisons on one machine are run with
+    python -m WobblerNavigationLib.Benchmark outside of the module tests.
+    """
+
+    self.delayDisplay("Starting the benchmark test")
+
+    from WobblerNavigationLib import Benchmark
+    results = Benchmark.runBenchmarks(sizes=(10, 100), repeat=1)
+    self.assertEqual(len(results), 2 * len(Benchmark.BENCHMARKS))
+    for result in results:
+      logging.info("{0} with {1}: {2:.6f} s".format(result['name'], result['size'], result['seconds']))
+      self.assertGreater(result['seconds'], 0.0)
 
-    # Test algorithm with non-inverted threshold
-    logic.run(inputVolume, outputVolume, threshold, True)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], threshold)
+    # A run compared to itself never regresses
+    baseline = {'results': results}
+    self.assertEqual(Benchmark.compareToBaseline(results, baseline), [])
 
-    # Test algorithm with inverted threshold
-    logic.run(inputVolume, outputVolume, threshold, False)
-    outputScalarRange = outputVolume.GetImageData().GetScalarRange()
-    self.assertEqual(outputScalarRange[0], inputScalarRange[0])
-    self.assertEqual(outputScalarRange[1], inputScalarRange[1])
+    # The reference baseline was recorded on another machine, so only gross regressions fail
+    exitStatus = Benchmark.main(['--baseline', Benchmark.REFERENCE_BASELINE, '--sizes', '10', '100', '1000',
+                                 '--repeat', '3', '--tolerance', '10'])
+    self.assertEqual(exitStatus, 0)
 
-    self.delayDisplay('Test passed')
+    self.delayDisplay('Benchmark test passed')
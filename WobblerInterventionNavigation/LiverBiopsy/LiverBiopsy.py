@@ -1,8 +1,12 @@
 import os, time, math
-import ScreenCapture
 import unittest
+import numpy as np
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from slicer.util import VTKObservationMixin
+from vtk.util import numpy_support
+from WobblerNavigationLib import NavigationMetrics, PlusConnection, SurfaceRegistration
+from WobblerNavigationLogic.NavigationLogic import NavigationLogic
 import logging
 
 #
@@ -31,11 +35,17 @@ This is a module designed to be the framework for percutaneous interventions of
 # LiverBiopsyWidget
 #
 
-class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
+class LiverBiopsyWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   """Uses ScriptedLoadableModuleWidget base class, available at:
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleWidget.__init__(self, parent)
+    VTKObservationMixin.__init__(self)
+    self._observedToCTToReferenceFiducialNode = None
+    self.criticalStructureCheckEnabled = False
+
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
 
@@ -48,6 +58,17 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.setupCustomViews()
     
     self.calibrationErrorThresholdMm = 0.9
+    # Fiducial pairs farther apart than this after the CT registration are considered misplaced
+    self.fiducialInlierThresholdMm = 5.0
+    self.spinCalibrationErrorThresholdDeg = 1.0
+    self.toolCalibrationMaximumDurationSec = 30
+    # Critical structures are checked along the needle path this far ahead of the tip
+    self.needleTrajectoryLengthMm = 50.0
+    self.criticalStructureWarningDistanceMm = 5.0
+    # The critical structure check runs at most this often, however fast the tracker updates
+    self.maximumUpdateRateHz = 30.0
+    self.cineDurationSec = 10.0
+    self.cineFrameRateHz = 30.0
     
     self.logic = LiverBiopsyLogic()
     
@@ -59,6 +80,9 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.ui.toProbeToUSFiducialWidget.setMRMLScene(slicer.mrmlScene)
     self.ui.fromCTToReferenceFiducialWidget.setMRMLScene(slicer.mrmlScene)
     self.ui.toCTToReferenceFiducialWidget.setMRMLScene(slicer.mrmlScene)
+    self.ui.surfacePointsFiducialWidget.setMRMLScene(slicer.mrmlScene)
+    self.ui.liverSurfaceModelSelector.setMRMLScene(slicer.mrmlScene)
+    self.ui.criticalStructuresSelector.setMRMLScene(slicer.mrmlScene)
 
     # connections
     
@@ -72,12 +96,25 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.ui.USCalibrationButton.connect('clicked(bool)', self.USCalibration)
     self.ui.initialCTRegistrationButton.connect('clicked(bool)', self.initialCTRegistration)
     self.ui.placeToCTToReferenceFiducialButton.connect('clicked(bool)', self.placeToCTToReferenceFiducial)
+    self.ui.placeSurfacePointButton.connect('clicked(bool)', self.placeSurfacePoint)
+    self.ui.fineCTRegistrationButton.connect('clicked(bool)', self.fineCTRegistration)
     self.ui.freezeUltrasoundButton.connect('clicked(bool)', self.onFreezeUltrasound)
+    self.ui.cineFrameSlider.connect('valueChanged(double)', self.onCineFrameChanged)
+    self.ui.criticalStructuresSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.onCriticalStructuresChanged)
+
+    # Keep a cine loop of the live ultrasound as soon as the image node exists, e.g. after connecting to PLUS
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded)
+    self.startCineRecording()
 
     self.toolCalibrationTimer = qt.QTimer()
-    self.toolCalibrationTimer.setInterval(500)
+    self.toolCalibrationTimer.setInterval(200)
     self.toolCalibrationTimer.connect('timeout()', self.toolCalibrationTimeout)
 
+    # The connector receives on its own thread, its state and message rates are polled from the main thread
+    self.plusConnectionTimer = qt.QTimer()
+    self.plusConnectionTimer.setInterval(500)
+    self.plusConnectionTimer.connect('timeout()', self.updatePlusConnectionStatus)
+
     self.ui.fromProbeToUSFiducialWidget.setCurrentNode(slicer.util.getFirstNodeByName('FromProbeToUSFiducialNode', className='vtkMRMLMarkupsFiducialNode'))
     self.ui.fromProbeToUSFiducialWidget.setNodeColor(qt.QColor(207,26,0,255))
     self.ui.toProbeToUSFiducialWidget.setCurrentNode(slicer.util.getFirstNodeByName('ToProbeToUSFiducialNode', className='vtkMRMLMarkupsFiducialNode'))
@@ -87,6 +124,13 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.ui.fromCTToReferenceFiducialWidget.setNodeColor(qt.QColor(85,255,0,255))
     self.ui.toCTToReferenceFiducialWidget.setCurrentNode(slicer.util.getFirstNodeByName('ToCTToReferenceFiducials', className='vtkMRMLMarkupsFiducialNode'))
     self.ui.toCTToReferenceFiducialWidget.setNodeColor(qt.QColor(255,170,0,255))
+    self.ui.surfacePointsFiducialWidget.setCurrentNode(slicer.util.getFirstNodeByName('CTSurfacePoints', className='vtkMRMLMarkupsFiducialNode'))
+    self.ui.surfacePointsFiducialWidget.setNodeColor(qt.QColor(0,170,255,255))
+
+    # Registration error is re-evaluated whenever a reference fiducial is placed, moved or removed
+    self.ui.fromCTToReferenceFiducialWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.updateCTRegistrationErrorPreview)
+    self.ui.toCTToReferenceFiducialWidget.connect("currentNodeChanged(vtkMRMLNode*)", self.observeToCTToReferenceFiducialNode)
+    self.observeToCTToReferenceFiducialNode(self.ui.toCTToReferenceFiducialWidget.currentNode())
     
     self.ui.testButton.connect('clicked(bool)', self.onTestFunction)
 
@@ -159,6 +203,7 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.ToProbeToUSFiducialNode = self.createVTKMRMLElement('ToProbeToUSFiducialNode', 'vtkMRMLMarkupsFiducialNode')
     self.FromCTToReferenceFiducialNode = self.createVTKMRMLElement('FromCTToReferenceFiducials', 'vtkMRMLMarkupsFiducialNode')
     self.ToCTToReferenceFiducialNode = self.createVTKMRMLElement('ToCTToReferenceFiducials', 'vtkMRMLMarkupsFiducialNode')
+    self.CTSurfacePointsNode = self.createVTKMRMLElement('CTSurfacePoints', 'vtkMRMLMarkupsFiducialNode')
 
     # Build Transform Tree
 
@@ -178,6 +223,10 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.NeedleBaseToNeedle.SetAndObserveTransformNodeID(self.NeedleToReference.GetID())
     self.CTToReference.SetAndObserveTransformNodeID(self.ReferenceToRas.GetID())
 
+    # Cache the composed transforms of the tree, tool tip positions are polled at tracker rate
+    self.logic.setupTransformTreeCache([self.ImageToMRI, self.StylusTipToStylus, self.StylusBaseToStylus,
+                                        self.NeedleTipToNeedle, self.NeedleBaseToNeedle, self.CTToReference])
+
   def createVTKMRMLElement(self, transformName, vtkMRMLClassName):
     vtkMRMLElement = slicer.util.getFirstNodeByName(transformName, className=vtkMRMLClassName)
     if not vtkMRMLElement:
@@ -194,8 +243,23 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     return vtkMRMLElement
 
 
+  def enter(self):
+    # Resume the critical structure check stopped when the module was left
+    if self.criticalStructureCheckEnabled:
+      self.startCriticalStructureCheck()
+
+
+  def exit(self):
+    self.logic.stopCoalescedUpdates()
+
+
   def cleanup(self):
-    pass
+    self.removeObservers()
+    self.logic.stopCoalescedUpdates()
+    self.plusConnectionTimer.stop()
+    self.logic.disconnectPlus()
+    self.logic.stopCineRecording()
+    self.logic.removeTransformTreeCache()
 
 
   def setupCustomViews(self):
@@ -253,7 +317,33 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
 
 
   def onConnectPLUS(self):
-    pass
+    logging.debug('onConnectPLUS')
+
+    if self.ui.connectPLUSButton.text == 'Connect to PLUS':
+      try:
+        self.logic.connectPlus(self.ui.plusHostandPort.text)
+      except ValueError as error:
+        slicer.util.errorDisplay("Invalid PLUS server address: {0}".format(error))
+        return
+      self.plusConnectionTimer.start()
+      self.ui.connectPLUSButton.setText('Disconnect from PLUS')
+    else:
+      self.plusConnectionTimer.stop()
+      self.logic.disconnectPlus()
+      self.ui.connectPLUSButton.setText('Connect to PLUS')
+    self.updatePlusConnectionStatus()
+
+
+  def updatePlusConnectionStatus(self):
+    state, streamRates = self.logic.pollPlusConnection()
+    stateTexts = {
+      PlusConnection.OFF: 'Not connected',
+      PlusConnection.CONNECTING: 'Connecting',
+      PlusConnection.CONNECTED: 'Connected',
+      PlusConnection.WAITING: 'Connection lost, retrying',
+      }
+    rateTexts = ['{0}: {1:.1f} Hz'.format(name, rate) for name, rate in sorted(streamRates.items())]
+    self.ui.plusConnectionStatusLabel.text = '\n'.join([stateTexts[state]] + rateTexts)
 
 
   def onSaveScene(self):
@@ -321,8 +411,7 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.ui.stylusPivotCalibrationButton.setEnabled(False)
     self.ui.stylusSpinCalibrationButton.setEnabled(False)
 
-    self.toolCalibrationStopTime = time.time() + float(5)
-    self.logic.toolCalibration(self.toolToReferenceNode, self.toolCalibrationTimer)
+    self.startToolCalibration()
 
 
   def needleSpinCalibration(self):
@@ -355,21 +444,40 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     self.ui.stylusPivotCalibrationButton.setEnabled(False)
     self.ui.stylusSpinCalibrationButton.setEnabled(False)
 
-    self.toolCalibrationStopTime = time.time() + float(5)
+    self.startToolCalibration()
+
+
+  def startToolCalibration(self):
+    logging.debug('startToolCalibration')
+
+    # Calibration stops as soon as the estimate converges, the duration is only an upper limit
+    self.toolCalibrationStopTime = time.time() + float(self.toolCalibrationMaximumDurationSec)
     self.logic.toolCalibration(self.toolToReferenceNode, self.toolCalibrationTimer)
 
 
   def toolCalibrationTimeout(self):
     logging.debug('toolCalibrationTimeout')
     
+    calibrationFinished = time.time() >= self.toolCalibrationStopTime
+    if self.toolCalibrationMode == self.PIVOT_CALIBRATION:
+      pivotCalibrationSolver = self.logic.pivotCalibrationSolver
+      calibrationFinished = calibrationFinished or pivotCalibrationSolver.converged
+      calibrationProgress = "Pivoting: {0} poses, error = {1:.2f} mm".format(
+        pivotCalibrationSolver.numberOfPoses, pivotCalibrationSolver.rootMeanSquareError)
+    else:
+      spinCalibrationSolver = self.logic.spinCalibrationSolver
+      calibrationFinished = calibrationFinished or spinCalibrationSolver.converged
+      calibrationProgress = "Spinning: {0:.0f} deg covered, error = {1:.2f} deg".format(
+        spinCalibrationSolver.coverageDeg, spinCalibrationSolver.rootMeanSquareErrorDeg)
+
     if self.toolBeingCalibrated == 'Needle':
       self.ui.needleCalibrationErrorLabel.setText("")
-      self.ui.needleCalibrationCountdownLabel.setText("Calibrating for {0:.0f} more seconds".format(self.toolCalibrationStopTime - time.time()))
+      self.ui.needleCalibrationCountdownLabel.setText(calibrationProgress)
     elif self.toolBeingCalibrated == 'Stylus':
       self.ui.stylusCalibrationErrorLabel.setText("")
-      self.ui.stylusCalibrationCountdownLabel.setText("Calibrating for {0:.0f} more seconds".format(self.toolCalibrationStopTime - time.time()))
-    
-    if (time.time() >= self.toolCalibrationStopTime):
+      self.ui.stylusCalibrationCountdownLabel.setText(calibrationProgress)
+
+    if calibrationFinished:
       self.toolCalibrationTimer.stop()
 
       self.ui.needlePivotCalibrationButton.setEnabled(True)
@@ -391,7 +499,7 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
           self.ui.stylusCalibrationErrorLabel.setText(calibrationError)
           self.ui.stylusCalibrationCountdownLabel.setText(calibrationStatus)
       else:
-        calibrationStatus, calibrationError = self.logic.spinCalibration(self.calibrationErrorThresholdMm, self.toolCalibrationResultNode)
+        calibrationStatus, calibrationError = self.logic.spinCalibration(self.spinCalibrationErrorThresholdDeg, self.toolCalibrationResultNode)
 
         if self.toolBeingCalibrated == 'Needle':
           self.ui.needleCalibrationErrorLabel.setText(calibrationError)
@@ -409,19 +517,16 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
 
   def returnPointAtStylusTip(self): #Coordinate returned is in the reference coordinate system
     logging.debug('returnPointAtStylusTip')
-    StylusTipToReference = vtk.vtkMatrix4x4()
+    StylusTipToReference = self.logic.getMatrixToWorld(self.StylusTipToStylus)
 
-    self.StylusTipToStylus.GetMatrixTransformToWorld(StylusTipToReference)
-    return [StylusTipToReference.GetElement(0,3), StylusTipToReference.GetElement(1,3), StylusTipToReference.GetElement(2,3)]
+    return [StylusTipToReference[0,3], StylusTipToReference[1,3], StylusTipToReference[2,3]]
 
 
   def returnTransformedPointAtStylusTip(self, TargetTransform): #Coordinate returned is in target coordinate system
     logging.debug('returnTransformedPointAtStylusTip')
-    StylusTipToTarget = vtk.vtkMatrix4x4()
-
-    self.StylusTipToStylus.GetMatrixTransformToNode(TargetTransform, StylusTipToTarget)
+    StylusTipToTarget = self.logic.getMatrixToNode(self.StylusTipToStylus, TargetTransform)
     
-    return [StylusTipToTarget.GetElement(0,3), StylusTipToTarget.GetElement(1,3), StylusTipToTarget.GetElement(2,3)]
+    return [StylusTipToTarget[0,3], StylusTipToTarget[1,3], StylusTipToTarget[2,3]]
 
 
   def USCalibration(self):
@@ -447,6 +552,52 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     currentNode.AddFiducialFromArray(newFiducial)
 
 
+  def observeToCTToReferenceFiducialNode(self, toMarkupsNode):
+    logging.debug("observeToCTToReferenceFiducialNode")
+
+    markupsEvents = [slicer.vtkMRMLMarkupsNode.PointAddedEvent, slicer.vtkMRMLMarkupsNode.PointModifiedEvent,
+                     slicer.vtkMRMLMarkupsNode.PointRemovedEvent]
+
+    if self._observedToCTToReferenceFiducialNode is not None:
+      for event in markupsEvents:
+        self.removeObserver(self._observedToCTToReferenceFiducialNode, event, self.updateCTRegistrationErrorPreview)
+    if toMarkupsNode is not None:
+      for event in markupsEvents:
+        self.addObserver(toMarkupsNode, event, self.updateCTRegistrationErrorPreview)
+    self._observedToCTToReferenceFiducialNode = toMarkupsNode
+
+    self.updateCTRegistrationErrorPreview()
+
+
+  def updateCTRegistrationErrorPreview(self, caller=None, event=None):
+    # Evaluate the registration for the fiducials placed so far without modifying CTToReference
+    fromMarkupsNode = self.ui.fromCTToReferenceFiducialWidget.currentNode()
+    toMarkupsNode = self.ui.toCTToReferenceFiducialWidget.currentNode()
+    if fromMarkupsNode is None or toMarkupsNode is None:
+      return
+
+    nFromPoints = fromMarkupsNode.GetNumberOfFiducials()
+    nToPoints = toMarkupsNode.GetNumberOfFiducials()
+    if nToPoints < nFromPoints:
+      self.ui.initialCTRegistrationErrorLabel.setText("Placed {0} of {1} fiducials".format(nToPoints, nFromPoints))
+      return
+
+    calibrationMessage, RMSE = self.logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, None,
+                                                               inlierThresholdMm=self.fiducialInlierThresholdMm)
+    if not calibrationMessage.startswith('Success'):
+      self.ui.initialCTRegistrationErrorLabel.setText(calibrationMessage.format(RMSE))
+      return
+
+    errorStatistics = self.logic.registrationErrorStatistics
+    previewMessage = "Preview: RMSE = {0:.2f} mm, max = {1:.2f} mm, 95% = {2:.2f} mm, leave-one-out = {3:.2f} mm".format(
+      errorStatistics.rootMeanSquareError, errorStatistics.maximumError, errorStatistics.percentileErrors[95],
+      errorStatistics.leaveOneOutRootMeanSquareError)
+    if self.logic.rejectedFiducialIndices:
+      previewMessage += ", rejected " + ', '.join(
+        toMarkupsNode.GetNthFiducialLabel(index) for index in self.logic.rejectedFiducialIndices)
+    self.ui.initialCTRegistrationErrorLabel.setText(previewMessage)
+
+
   def initialCTRegistration(self):
     logging.debug("initialCTRegistration")
     
@@ -454,11 +605,57 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     toMarkupsNode = self.ui.toCTToReferenceFiducialWidget.currentNode()
     outputTransformNode = self.CTToReference
     
-    calibrationMessage, RMSE = self.logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, outputTransformNode)
+    calibrationMessage, RMSE = self.logic.landmarkRegistration(fromMarkupsNode, toMarkupsNode, outputTransformNode,
+                                                               inlierThresholdMm=self.fiducialInlierThresholdMm)
 
     self.ui.initialCTRegistrationErrorLabel.setText(calibrationMessage.format(RMSE))
 
 
+  def placeSurfacePoint(self):
+    logging.debug("placeSurfacePoint")
+
+    currentNode = self.ui.surfacePointsFiducialWidget.currentNode()
+    currentNode.AddFiducialFromArray(self.returnPointAtStylusTip())
+
+
+  def fineCTRegistration(self):
+    logging.debug("fineCTRegistration")
+
+    surfaceModelNode = self.ui.liverSurfaceModelSelector.currentNode()
+    if surfaceModelNode is None:
+      self.ui.fineCTRegistrationErrorLabel.setText("Select the liver surface model")
+      return
+    if not self.installSciPy():
+      self.ui.fineCTRegistrationErrorLabel.setText("Surface registration needs SciPy")
+      return
+
+    registrationMessage, RMSE = self.logic.surfaceRegistration(
+      surfaceModelNode, self.ui.surfacePointsFiducialWidget.currentNode(), self.CTToReference)
+
+    self.ui.fineCTRegistrationErrorLabel.setText(registrationMessage.format(RMSE))
+
+
+  def installSciPy(self):
+    """
+    Surface registration and the critical structure check build a SciPy KD-tree, which Slicer does not bundle.
+    :return: True if a recent enough SciPy is available, after installing it if the user agreed
+    """
+    try:
+      SurfaceRegistration.requireSciPy()
+      return True
+    except ImportError as error:
+      if not slicer.util.confirmOkCancelDisplay("{0}\n\nInstall it now?".format(error)):
+        return False
+    slicer.util.pip_install('scipy>={0}.{1}'.format(*SurfaceRegistration.MINIMUM_SCIPY_VERSION))
+    try:
+      SurfaceRegistration.requireSciPy()
+      return True
+    except ImportError as error:
+      # An older SciPy that was already imported stays loaded until Slicer is restarted
+      slicer.util.errorDisplay("{0}\n\nRestart Slicer to use the installed version.".format(error))
+      return False
+
+
   def saveTransforms(self):
     logging.debug("saveTransforms")
     
@@ -469,19 +666,88 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
     slicer.util.saveNode(self.ProbeToUS, os.path.join(self.moduleTransformsPath, 'ProbeToUS' + ".h5"))
 
 
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    if isinstance(node, slicer.vtkMRMLScalarVolumeNode) and node.GetName() == 'Ultrasound_Ultrasound':
+      self.startCineRecording()
+
+
+  def startCineRecording(self):
+    ultrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound', className='vtkMRMLScalarVolumeNode')
+    if ultrasoundVolumeNode is None or self.logic.cineUltrasoundVolumeNode is ultrasoundVolumeNode:
+      return
+    self.logic.startCineRecording(ultrasoundVolumeNode, int(round(self.cineDurationSec * self.cineFrameRateHz)))
+
+
   def onFreezeUltrasound(self):
     logging.debug("onFreezeUltrasound")
 
     buttonLabel = self.ui.freezeUltrasoundButton.text
     if buttonLabel == 'Freeze Ultrasound':
+      frozenVolumeNode = slicer.util.getFirstNodeByName('FrozenUltrasound', className='vtkMRMLScalarVolumeNode')
+      if frozenVolumeNode is None:
+        frozenVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'FrozenUltrasound')
+      numberOfFrames = self.logic.freezeUltrasound(frozenVolumeNode)
+      if numberOfFrames == 0:
+        slicer.util.errorDisplay("No ultrasound frames have been received yet")
+        return
       self.ui.freezeUltrasoundButton.setText('Unfreeze Ultrasound')
-
-      self.UltrasoundVolumeNode = slicer.util.getFirstNodeByName('Ultrasound_Ultrasound')
-      self.FrozenUS = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeDisplayNode', 'FrozenUltrasound')
-
-
+      self.ui.cineFrameSlider.blockSignals(True)
+      self.ui.cineFrameSlider.minimum = 1 - numberOfFrames
+      self.ui.cineFrameSlider.value = 0
+      self.ui.cineFrameSlider.blockSignals(False)
+      self.ui.cineFrameSlider.enabled = True
+      slicer.util.setSliceViewerLayers(background=frozenVolumeNode)
     else:
+      self.logic.unfreezeUltrasound()
       self.ui.freezeUltrasoundButton.setText('Freeze Ultrasound')
+      self.ui.cineFrameSlider.enabled = False
+      if self.logic.cineUltrasoundVolumeNode is not None:
+        slicer.util.setSliceViewerLayers(background=self.logic.cineUltrasoundVolumeNode)
+
+
+  def onCineFrameChanged(self, value):
+    self.logic.showCineFrame(-int(round(value)))
+
+
+  def onCriticalStructuresChanged(self, segmentationNode):
+    self.criticalStructureCheckEnabled = False
+    self.logic.unregisterTrackedUpdate('criticalStructureProximity')
+    self.logic.stopCoalescedUpdates()
+    self.ui.criticalStructureProximityLabel.setText('')
+    self.ui.criticalStructureProximityLabel.setStyleSheet('')
+    if segmentationNode is None:
+      return
+    if not self.installSciPy():
+      self.ui.criticalStructureProximityLabel.setText('The critical structure check needs SciPy')
+      return
+    self.criticalStructureCheckEnabled = True
+    self.logic.registerTrackedUpdate('criticalStructureProximity', self.updateCriticalStructureProximity)
+    self.startCriticalStructureCheck()
+
+
+  def startCriticalStructureCheck(self):
+    # Checked once per coalesced update after the needle, its calibration or the CT registration has changed
+    self.logic.startCoalescedUpdates([self.NeedleToReference, self.NeedleTipToNeedle, self.CTToReference],
+                                     self.maximumUpdateRateHz)
+    self.updateCriticalStructureProximity()
+
+
+  def updateCriticalStructureProximity(self):
+    proximity = self.logic.needleStructureProximity(self.ui.criticalStructuresSelector.currentNode(), self.CTToReference,
+                                                    self.NeedleTipToNeedle, self.ReferenceToRas, self.needleTrajectoryLengthMm)
+    if proximity is None:
+      self.ui.criticalStructureProximityLabel.setText('No critical structure segmented')
+      return
+
+    text = 'Critical structure {0:.1f} mm from the needle path, {1:.0f} mm ahead of the tip'.format(
+      proximity.distanceMm, proximity.segmentFraction * self.needleTrajectoryLengthMm)
+    if proximity.distanceMm < self.criticalStructureWarningDistanceMm:
+      self.ui.criticalStructureProximityLabel.setText('Warning: ' + text)
+      self.ui.criticalStructureProximityLabel.setStyleSheet('color: red')
+    else:
+      self.ui.criticalStructureProximityLabel.setText(text)
+      self.ui.criticalStructureProximityLabel.setStyleSheet('')
 
 
   def onTestFunction(self):
@@ -492,144 +758,113 @@ class LiverBiopsyWidget(ScriptedLoadableModuleWidget):
 # LiverBiopsyLogic
 #
 
-class LiverBiopsyLogic(ScriptedLoadableModuleLogic):
+class LiverBiopsyLogic(NavigationLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
   should be such that other python code can import
   this class and make use of the functionality without
   requiring an instance of the Widget.
-  Uses ScriptedLoadableModuleLogic base class, available at:
-  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  The transform tree cache, registration, tool calibration, PLUS connection and cine loop are
+  inherited from WobblerNavigationLogic.NavigationLogic, shared with the AbdominalBiopsyNavigation module.
   """
 
-  def toolCalibration(self, transformNodeToolToReference, qtTimer):
-    logging.debug('toolCalibration')
-
-    self.pivotCalibrationLogic = slicer.modules.pivotcalibration.logic()
-    self.pivotCalibrationLogic.SetAndObserveTransformNode(transformNodeToolToReference)
-
-    qtTimer.start()
-    self.pivotCalibrationLogic.SetRecordingState(True)
-
-  def pivotCalibration(self, calibrationErrorThresholdMm, toolCalibrationResultNode, toolCalibrationToolBaseNode):
-    logging.debug('pivotCalibration')
-
-    self.pivotCalibrationLogic.SetRecordingState(False)
-
-    calibrationSuccess = self.pivotCalibrationLogic.ComputePivotCalibration()
-    if not calibrationSuccess:
-      self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-      return "Calibration failed: ", self.pivotCalibrationLogic.GetErrorText(), 0
-    else:
-      if (self.pivotCalibrationLogic.GetPivotRMSE() >= float(calibrationErrorThresholdMm)):
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        return "Calibration failed:", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetPivotRMSE()), 0
-      else:
-        toolTipToToolMatrix = vtk.vtkMatrix4x4()
-        self.pivotCalibrationLogic.GetToolTipToToolMatrix(toolTipToToolMatrix)
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        toolCalibrationResultNode.SetMatrixTransformToParent(toolTipToToolMatrix)
-
-        toolTipToToolBaseTransform = vtk.vtkMatrix4x4()
-        toolCalibrationResultNode.GetMatrixTransformToNode(toolCalibrationToolBaseNode, toolTipToToolBaseTransform)
-        toolLength = int(math.sqrt(toolTipToToolBaseTransform.GetElement(0, 3) ** 2 + toolTipToToolBaseTransform.GetElement(1,3) ** 2 + toolTipToToolBaseTransform.GetElement(2, 3) ** 2))
-
-        return "Calibration completed", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetPivotRMSE()), toolLength
+  def __init__(self):
+    NavigationLogic.__init__(self)
+    self.surfaceIndexKey = None
+    self.surfaceIndex = None
+    self.surfaceRegistrationResult = None
+    self.structureProximityKey = None
+    self.structureProximity = NavigationMetrics.StructureProximity()
 
+  def surfaceRegistration(self, surfaceModelNode, surfacePointsNode, ctToReferenceNode, inlierFraction=0.9):
+    """
+    Refine ctToReferenceNode by ICP between points sampled on the liver with the tracked stylus
+    and the liver surface segmented from CT. The current transform, e.g. from the fiducial
+    registration, is the starting point. The result of the last registration is kept in
+    self.surfaceRegistrationResult.
+    :param surfaceModelNode: liver surface model, its points are in CT coordinates
+    :param surfacePointsNode: markups of the sampled points, e.g. stylus tip positions in RAS
+    :param ctToReferenceNode: its parent transform, e.g. ReferenceToRas, defines the Reference coordinate system
+    :param inlierFraction: fraction of the sampled points closest to the surface that is used
+    """
+    logging.debug('surfaceRegistration')
 
-  def spinCalibration(self, calibrationErrorThresholdMm, toolCalibrationResultNode):
-    logging.debug('spinCalibration')
+    if surfacePointsNode is None or surfacePointsNode.GetNumberOfFiducials() < 3:
+      return 'Insufficient number of surface points. Error {0:.2f}', 2
 
-    self.pivotCalibrationLogic.SetRecordingState(False)
+    # ICP estimates ReferenceToCT, so the points are registered in the coordinate system CTToReference maps to
+    sampledPoints, _ = self.transformPointsBetweenNodes(slicer.util.arrayFromMarkupsControlPoints(surfacePointsNode, world=True),
+                                                        None, ctToReferenceNode.GetParentTransformNode())
+    referenceToCTMatrix = np.linalg.inv(slicer.util.arrayFromTransformMatrix(ctToReferenceNode))
+    try:
+      result = SurfaceRegistration.iterativeClosestPoint(sampledPoints, self.getSurfaceIndex(surfaceModelNode),
+                                                         referenceToCTMatrix, inlierFraction=inlierFraction)
+    except ValueError:
+      return 'Unstable registration. Check the surface points. Error {0:.2f}', 3
 
-    calibrationSuccess = self.pivotCalibrationLogic.ComputeSpinCalibration()
-    if not calibrationSuccess:
-      self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-      return "Calibration failed: ", self.pivotCalibrationLogic.GetErrorText()
-    else:
-      if (self.pivotCalibrationLogic.GetSpinRMSE() >= float(calibrationErrorThresholdMm)):
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        return "Calibration failed:", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetSpinRMSE())
-      else:
-        toolTipToToolMatrix = vtk.vtkMatrix4x4()
-        self.pivotCalibrationLogic.GetToolTipToToolMatrix(toolTipToToolMatrix)
-        self.pivotCalibrationLogic.ClearToolToReferenceMatrices()
-        toolCalibrationResultNode.SetMatrixTransformToParent(toolTipToToolMatrix)
-
-        return "Calibration completed", "Error = {0:.2f} mm".format(self.pivotCalibrationLogic.GetSpinRMSE())
-  
-  def landmarkRegistration(self, fromMarkupsNode, toMarkupsNode, outputTransformNode):
-    logging.debug('landmarkRegistration')
-    
-    fromPoints = vtk.vtkPoints()
-    toPoints = vtk.vtkPoints()
-
-    nFromPoints = fromMarkupsNode.GetNumberOfFiducials()
-    nToPoints = toMarkupsNode.GetNumberOfFiducials()
-    
-    if nFromPoints != nToPoints:
-      return 'Number of points in markups nodes are not equal. Error {0:.2f}', 1
-      
-    if nFromPoints < 3:
-      return 'Insufficient number of points in markups nodes. Error {0:.2f}', 2
-
-    for i in range( nFromPoints ):
-      p = [0, 0, 0]
-      fromMarkupsNode.GetNthControlPointPositionWorld(i, p)
-      fromPoints.InsertNextPoint( p )
-      toMarkupsNode.GetNthControlPointPositionWorld(i, p)
-      toPoints.InsertNextPoint( p )
-
-    lt = vtk.vtkLandmarkTransform()
-    lt.SetSourceLandmarks( fromPoints )
-    lt.SetTargetLandmarks( toPoints )
-    lt.SetModeToSimilarity()
-    lt.Update()
+    self.surfaceRegistrationResult = result
+    if not result.converged:
+      return 'Surface registration did not converge. Error {0:.2f}', result.rootMeanSquareError
 
     resultsMatrix = vtk.vtkMatrix4x4()
-    lt.GetMatrix( resultsMatrix )
+    slicer.util.updateVTKMatrixFromArray(resultsMatrix, np.linalg.inv(result.matrix))
+    ctToReferenceNode.SetMatrixTransformToParent(resultsMatrix)
 
-    det = resultsMatrix.Determinant()
-    if det < 1e-8:
-      return 'Unstable registration. Check input for collinear points. Error {0:.2f}', 3
-      
-    outputTransformNode.SetMatrixTransformToParent(resultsMatrix)
-    
-    return self.calculateRMSE(nFromPoints, fromPoints, toPoints, resultsMatrix)
-    
-  def calculateRMSE(self, nPoints, fromPoints, toPoints, transformMatrix):
-    logging.debug('calculateRMSE')
-    sumSquareError = 0
-    
-    for i in range( nPoints ):
-      pFrom = fromPoints.GetPoint(i)
-      pTo = toPoints.GetPoint(i)
+    return "Success. Error = {0:.2f} mm", result.rootMeanSquareError
 
-      pFrom = [pFrom[0], pFrom[1], pFrom[2], 1]
-      transformMatrix.MultiplyPoint(pFrom, pFrom)
-      
-      dist = (pTo[0] - pFrom[0]) ** 2 + (pTo[1] - pFrom[1]) ** 2 + (pTo[2] - pFrom[2]) ** 2
-      sumSquareError += dist
-    
-    RMSE = math.sqrt(sumSquareError/nPoints)
-    
-    return "Success. Error = {0:.2f} mm", RMSE
+  def getSurfaceIndex(self, surfaceModelNode):
+    """
+    :return: SurfaceRegistration.ClosestPointIndex of the model points, rebuilt only when the model changed
+    """
+    surfaceIndexKey = (surfaceModelNode.GetID(), surfaceModelNode.GetPolyData().GetMTime())
+    if surfaceIndexKey != self.surfaceIndexKey:
+      self.surfaceIndex = SurfaceRegistration.ClosestPointIndex(slicer.util.arrayFromModelPoints(surfaceModelNode))
+      self.surfaceIndexKey = surfaceIndexKey
+    return self.surfaceIndex
+
+  def needleStructureProximity(self, segmentationNode, ctToReferenceNode, needleTipNode, referenceNode,
+                               trajectoryLengthMm=50.0, segmentIds=None):
+    """
+    Shortest distance between the needle path, from the tip to trajectoryLengthMm ahead of it, and
+    critical structures, e.g. vessels, segmented in CT.
+    :param segmentationNode: segmentation of the structures, its points are in CT coordinates
+    :param needleTipNode: NeedleTipToNeedle, its Z axis points from the tip towards the needle hub
+    :param referenceNode: ReferenceToRas, the result is in its coordinate system
+    :param segmentIds: segments to check, all segments if None
+    :return: NavigationMetrics.SegmentProximity, None if the segments are empty
+    """
+    structureProximity = self.getStructureProximity(segmentationNode, ctToReferenceNode, referenceNode, segmentIds)
+    if structureProximity is None:
+      return None
 
+    needleTipMatrix = self.getMatrixToNode(needleTipNode, referenceNode)
+    needleDirection = -needleTipMatrix[:3, 2] / np.linalg.norm(needleTipMatrix[:3, 2])
+    return structureProximity.segmentProximity(needleTipMatrix[:3, 3],
+                                               needleTipMatrix[:3, 3] + trajectoryLengthMm * needleDirection)
 
-  def calculateSubtransform(self, AToCTransformNode, BToCTransformNode, outputTransformNode):
-    logging.debug('calculateSubtransform')
-    # In a transform hierarchy with A -> B -> C 
-    # This function calculates the transform A -> B given the transforms B -> C and A -> C 
-    AToCMatrix = vtk.vtkMatrix4x4()
-    
-    
-    CToBMatrix = vtk.vtkMatrix4x4()
-    
-    resultsMatrix = vtk.vtkMatrix4x4()
-    resultsMatrix.Multiply4x4(CToBMatrix, AToCMatrix)
-    
-    outputTransformNode.SetMatrixTransformToParent(resultsMatrix)
-    return
+  def getStructureProximity(self, segmentationNode, ctToReferenceNode, referenceNode, segmentIds=None):
+    """
+    :return: NavigationMetrics.StructureProximity of the closed surface points of the segments, its index
+      is rebuilt only when the segments or the CT to Reference transform changed. None if the segments are empty.
+    """
+    if segmentIds is None:
+      segmentIds = vtk.vtkStringArray()
+      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIds)
+      segmentIds = [segmentIds.GetValue(index) for index in range(segmentIds.GetNumberOfValues())]
+    # Does nothing if the surfaces exist already, they are kept up to date with the segments from then on
+    segmentationNode.CreateClosedSurfaceRepresentation()
+    polyDatas = [segmentationNode.GetClosedSurfaceInternalRepresentation(segmentId) for segmentId in segmentIds]
+    polyDatas = [polyData for polyData in polyDatas if polyData is not None and polyData.GetNumberOfPoints() > 0]
+    if not polyDatas:
+      return None
+
+    structureProximityKey = (segmentationNode.GetID(), tuple(segmentIds), tuple(polyData.GetMTime() for polyData in polyDatas))
+    if structureProximityKey != self.structureProximityKey:
+      self.structureProximity.setStructurePoints(np.concatenate(
+        [numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()) for polyData in polyDatas]))
+      self.structureProximityKey = structureProximityKey
+    self.structureProximity.setStructureToReferenceMatrix(self.getMatrixToNode(ctToReferenceNode, referenceNode))
+    return self.structureProximity
 
 
 class LiverBiopsyTest(ScriptedLoadableModuleTest):
@@ -649,31 +884,212 @@ class LiverBiopsyTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_LiverBiopsy1()
-
-
-  def test_LiverBiopsy1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    self.test_ToolCalibration()
+    self.test_SurfaceRegistration()
+    self.test_StructureProximity()
+    self.test_CineFreeze()
+
+
+  def test_ToolCalibration(self):
+    """ Feed synthetic pivoting and spinning poses of a stylus into the calibration solvers and
+    check the resulting StylusTipToStylus transform.
+    """
+
+    self.delayDisplay("Starting the tool calibration test")
+
+    randomState = np.random.RandomState(0)
+    stylusToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'StylusToReference')
+    stylusTipToStylus = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'StylusTipToStylus')
+    stylusBaseToStylus = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'StylusBaseToStylus')
+    stylusTipToStylus.SetAndObserveTransformNodeID(stylusToReference.GetID())
+    stylusBaseToStylus.SetAndObserveTransformNodeID(stylusToReference.GetID())
+    toolTipPosition = np.array([0.0, 0.0, -160.0])
+    pivotPosition = np.array([50.0, 20.0, 300.0])
+
+    def rotation(axis, angleDeg):
+      transform = vtk.vtkTransform()
+      transform.RotateWXYZ(angleDeg, axis)
+      return slicer.util.arrayFromVTKMatrix(transform.GetMatrix())
+
+    def pivotPoses(numberOfPoses, maximumAngleDeg):
+      poses = []
+      for _ in range(numberOfPoses):
+        pose = rotation(randomState.normal(size=3), randomState.uniform(-maximumAngleDeg, maximumAngleDeg))
+        pose[:3, 3] = pivotPosition - np.dot(pose[:3, :3], toolTipPosition) + randomState.normal(scale=0.2, size=3)
+        poses.append(pose)
+      return poses
+
+    logic = LiverBiopsyLogic()
+
+    # Too little pivoting must be rejected
+    for pose in pivotPoses(100, 0.01):
+      logic.pivotCalibrationSolver.addPose(pose)
+    calibrationStatus, calibrationError, toolLength = logic.pivotCalibration(1.0, stylusTipToStylus, stylusBaseToStylus)
+    self.assertTrue(calibrationStatus.startswith("Calibration failed"))
+
+    logic.pivotCalibrationSolver.reset()
+    for pose in pivotPoses(200, 40.0):
+      logic.pivotCalibrationSolver.addPose(pose)
+    calibrationStatus, calibrationError, toolLength = logic.pivotCalibration(1.0, stylusTipToStylus, stylusBaseToStylus)
+    self.assertEqual(calibrationStatus, "Calibration completed")
+    self.assertAlmostEqual(toolLength, 160, delta=1)
+    self.assertTrue(np.allclose(slicer.util.arrayFromTransformMatrix(stylusTipToStylus)[:3, 3], toolTipPosition, atol=0.2))
+
+    # A full turn around the shaft, the coverage must reach 360 degrees
+    for angleDeg in np.linspace(-180.0, 180.0, 200):
+      pose = np.dot(rotation(randomState.normal(size=3), 0.5), rotation([0.0, 0.0, 1.0], angleDeg))
+      pose[:3, 3] = randomState.normal(scale=0.2, size=3)
+      logic.spinCalibrationSolver.addPose(pose)
+    calibrationStatus, calibrationError = logic.spinCalibration(1.0, stylusTipToStylus)
+    self.assertEqual(calibrationStatus, "Calibration completed")
+    self.assertGreater(logic.spinCalibrationSolver.coverageDeg, 350.0)
+    stylusTipToStylusArray = slicer.util.arrayFromTransformMatrix(stylusTipToStylus)
+    # The tip Z axis points from the tip towards the stylus origin, the tip position is kept
+    self.assertGreater(stylusTipToStylusArray[2, 2], 0.999)
+    self.assertTrue(np.allclose(stylusTipToStylusArray[:3, 3], toolTipPosition, atol=0.2))
+
+    self.delayDisplay('Tool calibration test passed')
+
+
+  def test_SurfaceRegistration(self):
+    """ Sample points on an ellipsoid surface model, move them by a known transform and check that
+    ICP recovers CTToReference from a perturbed start.
+    """
+
+    self.delayDisplay("Starting the surface registration test")
+
+    randomState = np.random.RandomState(0)
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(80.0)
+    sphere.SetThetaResolution(400)
+    sphere.SetPhiResolution(250)
+    sphere.Update()
+    surfaceModelNode = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+    # Flatten the sphere into an ellipsoid, a sphere would not constrain rotations
+    surfacePoints = slicer.util.arrayFromModelPoints(surfaceModelNode)
+    surfacePoints *= [1.0, 0.7, 0.5]
+    slicer.util.arrayFromModelPointsModified(surfaceModelNode)
+
+    ctToReferenceMatrix = np.eye(4)
+    ctToReferenceMatrix[:3, :3] = [[np.cos(0.2), -np.sin(0.2), 0.0], [np.sin(0.2), np.cos(0.2), 0.0], [0.0, 0.0, 1.0]]
+    ctToReferenceMatrix[:3, 3] = [20.0, -10.0, 5.0]
+    sampledCTPoints = surfacePoints[randomState.choice(surfacePoints.shape[0], 300, replace=False)]
+    sampledPoints = np.dot(sampledCTPoints, ctToReferenceMatrix[:3, :3].T) + ctToReferenceMatrix[:3, 3]
+    sampledPoints += randomState.normal(0.0, 0.3, sampledPoints.shape)
+
+    # Start from a fiducial registration that is a few mm and degrees off
+    initialMatrix = np.array(ctToReferenceMatrix)
+    initialMatrix[:3, 3] += [4.0, 3.0, -3.0]
+    initialMatrix[:3, :3] = np.dot(initialMatrix[:3, :3], np.array(
+      [[1.0, 0.0, 0.0], [0.0, np.cos(0.05), -np.sin(0.05)], [0.0, np.sin(0.05), np.cos(0.05)]]))
+
+    # The stylus samples the points in RAS, under a Reference that is or is not aligned with RAS
+    referenceToRasMatrices = [np.eye(4), np.eye(4)]
+    referenceToRasMatrices[1][:3, :3] = [[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+    referenceToRasMatrices[1][:3, 3] = [-150.0, 40.0, 300.0]
+    logic = LiverBiopsyLogic()
+    for referenceToRasMatrix in referenceToRasMatrices:
+      referenceToRas = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ReferenceToRas')
+      referenceToRas.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(referenceToRasMatrix))
+      ctToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'CTToReference')
+      ctToReference.SetAndObserveTransformNodeID(referenceToRas.GetID())
+      ctToReference.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(initialMatrix))
+      surfacePointsNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', 'CTSurfacePoints')
+      for point in np.dot(sampledPoints, referenceToRasMatrix[:3, :3].T) + referenceToRasMatrix[:3, 3]:
+        surfacePointsNode.AddFiducialFromArray(point)
+
+      startTime = time.time()
+      registrationMessage, RMSE = logic.surfaceRegistration(surfaceModelNode, surfacePointsNode, ctToReference)
+      logging.info('Surface registration of {0} points took {1:.3f} s'.format(surfacePoints.shape[0], time.time() - startTime))
+      self.assertTrue(registrationMessage.startswith('Success'))
+      self.assertLess(RMSE, 1.0)
+      self.assertTrue(np.allclose(slicer.util.arrayFromTransformMatrix(ctToReference), ctToReferenceMatrix, atol=0.5))
+
+    self.delayDisplay('Surface registration test passed')
+
+
+  def test_StructureProximity(self):
+    """ Segment a spherical vessel section in CT, point the tracked needle past it and check the
+    distance to the needle path, before and after CTToReference changes.
+    """
+
+    self.delayDisplay("Starting the structure proximity test")
+
+    referenceToRas = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ReferenceToRas')
+    ctToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'CTToReference')
+    needleToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleToReference')
+    needleTipToNeedle = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'NeedleTipToNeedle')
+    ctToReference.SetAndObserveTransformNodeID(referenceToRas.GetID())
+    needleToReference.SetAndObserveTransformNodeID(referenceToRas.GetID())
+    needleTipToNeedle.SetAndObserveTransformNodeID(needleToReference.GetID())
+
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(10.0, 0.0, 30.0)
+    sphere.SetRadius(4.0)
+    sphere.SetThetaResolution(200)
+    sphere.SetPhiResolution(200)
+    sphere.Update()
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'Vessels')
+    segmentationNode.SetAndObserveTransformNodeID(ctToReference.GetID())
+    segmentationNode.AddSegmentFromClosedSurfaceRepresentation(sphere.GetOutput(), 'Vessel')
+
+    # Needle tip at the Reference origin, pointing along +Z
+    slicer.util.updateTransformMatrixFromArray(needleTipToNeedle, np.diag([1.0, -1.0, -1.0, 1.0]))
+
+    logic = LiverBiopsyLogic()
+    proximity = logic.needleStructureProximity(segmentationNode, ctToReference, needleTipToNeedle, referenceToRas, 50.0)
+    self.assertAlmostEqual(proximity.distanceMm, 6.0, delta=0.05)
+    self.assertAlmostEqual(proximity.segmentFraction, 0.6, delta=0.01)
+
+    # The index is only rebuilt after CTToReference changes
+    logic.needleStructureProximity(segmentationNode, ctToReference, needleTipToNeedle, referenceToRas, 50.0)
+    self.assertEqual(logic.structureProximity.numberOfIndexBuilds, 1)
+    ctToReferenceMatrix = np.eye(4)
+    ctToReferenceMatrix[:3, 3] = [-4.0, 0.0, 0.0]
+    slicer.util.updateTransformMatrixFromArray(ctToReference, ctToReferenceMatrix)
+    proximity = logic.needleStructureProximity(segmentationNode, ctToReference, needleTipToNeedle, referenceToRas, 50.0)
+    self.assertEqual(logic.structureProximity.numberOfIndexBuilds, 2)
+    self.assertAlmostEqual(proximity.distanceMm, 2.0, delta=0.05)
+
+    # A structure beyond the end of the checked path is measured from the end
+    proximity = logic.needleStructureProximity(segmentationNode, ctToReference, needleTipToNeedle, referenceToRas, 20.0)
+    self.assertAlmostEqual(proximity.segmentFraction, 1.0)
+    self.assertAlmostEqual(proximity.distanceMm, np.hypot(6.0, 10.0) - 4.0, delta=0.05)
+
+    self.delayDisplay('Structure proximity test passed')
+
+
+  def test_CineFreeze(self):
+    """ Freeze the live ultrasound of the tracked probe and scroll back through the cine loop.
     """
 
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import SampleData
-    SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767')
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
-    self.delayDisplay('Test passed!')
+    self.delayDisplay("Starting the cine freeze test")
+
+    probeToReference = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ProbeToReference')
+    ultrasoundVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Ultrasound_Ultrasound')
+    ultrasoundVolumeNode.SetAndObserveTransformNodeID(probeToReference.GetID())
+    frozenVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'FrozenUltrasound')
+
+    logic = LiverBiopsyLogic()
+    self.assertEqual(logic.freezeUltrasound(frozenVolumeNode), 0)
+    logic.startCineRecording(ultrasoundVolumeNode, capacity=5)
+    for frameIndex in range(8):
+      probeToReferenceMatrix = vtk.vtkMatrix4x4()
+      probeToReferenceMatrix.SetElement(0, 3, frameIndex)
+      probeToReference.SetMatrixTransformToParent(probeToReferenceMatrix)
+      slicer.util.updateVolumeFromArray(ultrasoundVolumeNode, np.full((1, 20, 30), frameIndex, dtype=np.uint8))
+
+    self.assertEqual(logic.freezeUltrasound(frozenVolumeNode), 5)
+    self.assertEqual(slicer.util.arrayFromVolume(frozenVolumeNode)[0, 0, 0], 7)
+    # Each frame is shown at the probe pose it was acquired at
+    logic.showCineFrame(4)
+    self.assertEqual(slicer.util.arrayFromVolume(frozenVolumeNode)[0, 0, 0], 3)
+    frozenIjkToRas = vtk.vtkMatrix4x4()
+    frozenVolumeNode.GetIJKToRASMatrix(frozenIjkToRas)
+    self.assertAlmostEqual(frozenIjkToRas.GetElement(0, 3), 3.0)
+
+    logic.unfreezeUltrasound()
+    logic.stopCineRecording()
+    self.assertIsNone(logic.cineBuffer)
+
+    self.delayDisplay('Cine freeze test passed')
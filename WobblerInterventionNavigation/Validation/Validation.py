@@ -1,9 +1,10 @@
-import os, math
+import os
 import unittest
 import logging
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
+from WobblerNavigationLib import Accuracy
 
 #
 # Validation
@@ -110,45 +111,11 @@ class ValidationLogic(ScriptedLoadableModuleLogic):
 
     logging.info('Processing started')
 
-    point1 = vtk.vtkPoints()
-    point2 = vtk.vtkPoints()
-    point3 = vtk.vtkPoints()
-    point4 = vtk.vtkPoints()
-
-    p = [0, 0, 0]
-    TestPoint1.GetNthControlPointPositionWorld(0, p)
-    point1.InsertNextPoint(p)
-    TestPoint2.GetNthControlPointPositionWorld(0, p)
-    point2.InsertNextPoint(p)
-    TestPoint3.GetNthControlPointPositionWorld(0, p)
-    point3.InsertNextPoint(p)
-    TestPoint4.GetNthControlPointPositionWorld(0, p)
-    point4.InsertNextPoint(p)
-
-    p1 = point1.GetPoint(0)
-    p2 = point2.GetPoint(0)
-    p3 = point3.GetPoint(0)
-    p4 = point4.GetPoint(0)
-
-    centroid = [0, 0, 0]
-    centroid[0] = (p1[0] + p2[0] + p3[0] + p4[0]) / 4
-    centroid[1] = (p1[1] + p2[1] + p3[1] + p4[1]) / 4
-    centroid[2] = (p1[2] + p2[2] + p3[2] + p4[2]) / 4
-
-    print(centroid)
-
-    dist1 = math.sqrt((centroid[0] - p1[0]) ** 2 + (centroid[1] - p1[1]) ** 2 + (centroid[2] - p1[2]) ** 2)
-    dist2 = math.sqrt((centroid[0] - p2[0]) ** 2 + (centroid[1] - p2[1]) ** 2 + (centroid[2] - p2[2]) ** 2)
-    dist3 = math.sqrt((centroid[0] - p3[0]) ** 2 + (centroid[1] - p3[1]) ** 2 + (centroid[2] - p3[2]) ** 2)
-    dist4 = math.sqrt((centroid[0] - p4[0]) ** 2 + (centroid[1] - p4[1]) ** 2 + (centroid[2] - p4[2]) ** 2)
-
-    print(dist1)
-    print(dist2)
-    print(dist3)
-    print(dist4)
-
-    dist = (dist1 + dist2 + dist3 + dist4) / 4
-    print(dist)
+    testPoints = [slicer.util.arrayFromMarkupsControlPoints(testPoint, world=True)[0]
+                  for testPoint in (TestPoint1, TestPoint2, TestPoint3, TestPoint4)]
+    centroid, dist = Accuracy.meanDistanceToCentroid(testPoints)
+
+    logging.debug('Centroid: {0}, average distance: {1}'.format(centroid, dist))
 
     logging.info('Processing completed')
     return "Success. Average Distance = {0:.2f} mm", dist
@@ -173,19 +140,27 @@ class ValidationTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_Validation1()
-
-  def test_Validation1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
+    self.test_MeanDistanceFourPoints()
+
+  def test_MeanDistanceFourPoints(self):
+    """ Four test points at the corners of a square around a known centroid have the
+    half diagonal of the square as average distance.
     """
 
     self.delayDisplay("Starting the test")
 
+    testPoints = []
+    for position in ([10, 10, 5], [-10, 10, 5], [-10, -10, 5], [10, -10, 5]):
+      testPoint = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+      testPoint.AddFiducialFromArray(position)
+      testPoints.append(testPoint)
+
+    logic = ValidationLogic()
+    calibrationMessage, result = logic.MeanDistanceFourPoints(*testPoints)
+    self.assertTrue(calibrationMessage.startswith("Success"))
+    self.assertAlmostEqual(result, 10.0 * 2 ** 0.5, places=6)
+
+    with self.assertRaises(ValueError):
+      logic.MeanDistanceFourPoints(testPoints[0], testPoints[1], testPoints[2], None)
+
+    self.delayDisplay('Test passed')
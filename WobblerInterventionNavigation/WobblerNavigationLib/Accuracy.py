@@ -0,0 +1,19 @@
+import numpy as np
+
+#
+# Accuracy measures for validation
+#
+
+
+def meanDistanceToCentroid(points):
+  """
+  Spread of repeated measurements of the same physical point, e.g. one target seen from
+  several probe positions through the calibrated ProbeToUS transforms.
+  :param points: (N, 3) array
+  :return: centroid of the points and mean distance of the points from the centroid
+  """
+  points = np.asarray(points, dtype=np.float64)
+  if points.ndim != 2 or points.shape[1] != 3 or points.shape[0] == 0:
+    raise ValueError("Points must be a non-empty (N, 3) array")
+  centroid = points.mean(axis=0)
+  return centroid, float(np.linalg.norm(points - centroid, axis=1).mean())
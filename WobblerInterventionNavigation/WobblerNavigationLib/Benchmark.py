@@ -0,0 +1,257 @@
+"""
+Performance benchmarks of the navigation hot paths on synthetic data.
+
+Run without Slicer, e.g.
+
+  python -m WobblerNavigationLib.Benchmark --baseline BenchmarkBaseline.json --update
+  python -m WobblerNavigationLib.Benchmark --baseline BenchmarkBaseline.json
+
+The first command records a baseline, the second one compares a new run to it and exits with
+a non-zero status if any benchmark became slower than the tolerance allows. Baselines are
+only comparable on the machine they were recorded on.
+
+REFERENCE_BASELINE is the baseline committed with the package. On other machines it only
+catches gross regressions, so compare to it with a loose tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from . import Accuracy, Registration, RegistrationError, ToolCalibration
+
+BASELINE_FORMAT_VERSION = 1
+
+REFERENCE_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BenchmarkBaseline.json')
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+
+#
+# Synthetic data
+#
+
+
+def randomRotations(numberOfRotations, randomState, maximumAngleDeg=180.0):
+  """
+  :return: (K, 3, 3) array of rotations around random axes by random angles up to maximumAngleDeg
+  """
+  axes = randomState.normal(size=(numberOfRotations, 3))
+  axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+  angles = np.radians(randomState.uniform(-maximumAngleDeg, maximumAngleDeg, numberOfRotations))
+  return rotationsAroundAxes(axes, angles)
+
+
+def rotationsAroundAxes(axes, angles):
+  """
+  Rodrigues formula for K axis-angle pairs.
+  :param axes: (K, 3) array of unit axes
+  :param angles: (K,) array of angles in radians
+  :return: (K, 3, 3) array of rotations
+  """
+  crossProductMatrices = np.zeros((axes.shape[0], 3, 3))
+  crossProductMatrices[:, 0, 1] = -axes[:, 2]
+  crossProductMatrices[:, 0, 2] = axes[:, 1]
+  crossProductMatrices[:, 1, 0] = axes[:, 2]
+  crossProductMatrices[:, 1, 2] = -axes[:, 0]
+  crossProductMatrices[:, 2, 0] = -axes[:, 1]
+  crossProductMatrices[:, 2, 1] = axes[:, 0]
+  sines = np.sin(angles)[:, np.newaxis, np.newaxis]
+  cosines = np.cos(angles)[:, np.newaxis, np.newaxis]
+  return np.eye(3) + sines * crossProductMatrices + (1.0 - cosines) * np.matmul(crossProductMatrices, crossProductMatrices)
+
+
+def syntheticFiducials(numberOfPoints, randomState, noiseMm=0.5):
+  """
+  Fiducial pairs related by a random similarity transform, with isotropic localization noise.
+  :return: (N, 3) from points, (N, 3) to points and the (4, 4) fromTo matrix
+  """
+  fromToMatrix = np.eye(4)
+  fromToMatrix[:3, :3] = randomState.uniform(0.8, 1.2) * randomRotations(1, randomState)[0]
+  fromToMatrix[:3, 3] = randomState.uniform(-200.0, 200.0, 3)
+  fromPoints = randomState.uniform(-150.0, 150.0, (numberOfPoints, 3))
+  toPoints = (np.dot(fromPoints, fromToMatrix[:3, :3].T) + fromToMatrix[:3, 3]
+              + randomState.normal(scale=noiseMm, size=(numberOfPoints, 3)))
+  return fromPoints, toPoints, fromToMatrix
+
+
+def syntheticPivotPoses(numberOfPoses, randomState, toolTipPosition=(0.0, 0.0, -160.0), pivotPosition=(50.0, 20.0, 300.0),
+                        maximumAngleDeg=40.0, noiseMm=0.2):
+  """
+  ToolToReference poses of a tool pivoting around its tip.
+  :return: (K, 4, 4) array
+  """
+  rotations = randomRotations(numberOfPoses, randomState, maximumAngleDeg)
+  poses = np.tile(np.eye(4), (numberOfPoses, 1, 1))
+  poses[:, :3, :3] = rotations
+  poses[:, :3, 3] = (np.asarray(pivotPosition) - np.einsum('kij,j->ki', rotations, toolTipPosition)
+                     + randomState.normal(scale=noiseMm, size=(numberOfPoses, 3)))
+  return poses
+
+
+def syntheticSpinPoses(numberOfPoses, randomState, shaftDirection=(0.0, 0.0, 1.0), wobbleDeg=0.5):
+  """
+  ToolToReference poses of a tool spinning around its shaft, with a small wobble of the shaft.
+  :return: (K, 4, 4) array
+  """
+  shaftDirection = np.asarray(shaftDirection, dtype=np.float64)
+  shaftDirection /= np.linalg.norm(shaftDirection)
+  spins = rotationsAroundAxes(np.tile(shaftDirection, (numberOfPoses, 1)), np.linspace(-np.pi, np.pi, numberOfPoses))
+  wobbles = randomRotations(numberOfPoses, randomState, wobbleDeg)
+  poses = np.tile(np.eye(4), (numberOfPoses, 1, 1))
+  poses[:, :3, :3] = np.matmul(wobbles, spins)
+  poses[:, :3, 3] = randomState.normal(scale=0.2, size=(numberOfPoses, 3))
+  return poses
+
+#
+# Benchmarks
+#
+
+
+def _landmarkRegistrationBenchmark(size, randomState):
+  fromPoints, toPoints, _ = syntheticFiducials(size, randomState)
+  return lambda: Registration.landmarkRegistration(fromPoints, toPoints, Registration.SIMILARITY)
+
+
+def _registrationErrorBenchmark(size, randomState):
+  fromPoints, toPoints, _ = syntheticFiducials(size, randomState)
+  fromToMatrix, _ = Registration.landmarkRegistration(fromPoints, toPoints, Registration.SIMILARITY)
+  return lambda: RegistrationError.registrationErrorStatistics(fromPoints, toPoints, fromToMatrix, Registration.SIMILARITY)
+
+
+def _pivotCalibrationBenchmark(size, randomState):
+  # Poses are streamed one by one like the TransformModifiedEvent observer does
+  poses = syntheticPivotPoses(size, randomState)
+
+  def run():
+    solver = ToolCalibration.IncrementalPivotCalibration()
+    for pose in poses:
+      solver.addPose(pose)
+  return run
+
+
+def _spinCalibrationBenchmark(size, randomState):
+  poses = syntheticSpinPoses(size, randomState)
+
+  def run():
+    solver = ToolCalibration.IncrementalSpinCalibration()
+    for pose in poses:
+      solver.addPose(pose)
+  return run
+
+
+def _validationBenchmark(size, randomState):
+  points = randomState.normal(scale=1.0, size=(size, 3)) + randomState.uniform(-100.0, 100.0, 3)
+  return lambda: Accuracy.meanDistanceToCentroid(points)
+
+
+# name: (setup function returning the callable to time, largest size that is run)
+BENCHMARKS = {
+  'landmarkRegistration': (_landmarkRegistrationBenchmark, None),
+  'registrationErrorStatistics': (_registrationErrorBenchmark, None),
+  'pivotCalibration': (_pivotCalibrationBenchmark, 10000),
+  'spinCalibration': (_spinCalibrationBenchmark, 10000),
+  'validationMeanDistance': (_validationBenchmark, None),
+  }
+
+
+def timeFunction(function, repeat=5):
+  """
+  :return: shortest wall time of repeat calls in seconds, the least disturbed by other processes
+  """
+  times = []
+  for _ in range(repeat):
+    startTime = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - startTime)
+  return min(times)
+
+
+def runBenchmarks(sizes=DEFAULT_SIZES, names=None, repeat=5, seed=0):
+  """
+  :param sizes: numbers of points or poses to run each benchmark with
+  :param names: benchmarks to run, all of BENCHMARKS if None
+  :return: list of {'name', 'size', 'seconds'} results
+  """
+  results = []
+  for name in sorted(BENCHMARKS if names is None else names):
+    setupFunction, maximumSize = BENCHMARKS[name]
+    for size in sizes:
+      if maximumSize is not None and size > maximumSize:
+        continue
+      function = setupFunction(size, np.random.RandomState(seed))
+      results.append({'name': name, 'size': int(size), 'seconds': timeFunction(function, repeat)})
+  return results
+
+
+def saveBaseline(results, fileName):
+  baseline = {
+    'formatVersion': BASELINE_FORMAT_VERSION,
+    'machine': platform.machine(),
+    'processor': platform.processor(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'results': results,
+    }
+  with open(fileName, 'w') as baselineFile:
+    json.dump(baseline, baselineFile, indent=2, sort_keys=True)
+
+
+def loadBaseline(fileName):
+  with open(fileName) as baselineFile:
+    baseline = json.load(baselineFile)
+  if baseline.get('formatVersion') != BASELINE_FORMAT_VERSION:
+    raise ValueError("Unsupported benchmark baseline format in {0}".format(fileName))
+  return baseline
+
+
+def compareToBaseline(results, baseline, tolerance=1.5, minimumSeconds=1e-3):
+  """
+  Find the benchmarks that became slower than the baseline.
+  :param tolerance: allowed ratio of new time to baseline time
+  :param minimumSeconds: baseline times below this are compared against this value, very short
+    timings are dominated by noise
+  :return: list of (name, size, baseline seconds, new seconds) of the regressed benchmarks
+  """
+  baselineSeconds = {(result['name'], result['size']): result['seconds'] for result in baseline['results']}
+  regressions = []
+  for result in results:
+    key = (result['name'], result['size'])
+    if key not in baselineSeconds:
+      continue
+    if result['seconds'] > tolerance * max(baselineSeconds[key], minimumSeconds):
+      regressions.append((result['name'], result['size'], baselineSeconds[key], result['seconds']))
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark the wobbler navigation numerical core")
+  parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+  parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS), default=None)
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--baseline', help="baseline JSON file to compare to or to update")
+  parser.add_argument('--update', action='store_true', help="write the results to the baseline file")
+  parser.add_argument('--tolerance', type=float, default=1.5)
+  args = parser.parse_args(argv)
+
+  results = runBenchmarks(args.sizes, args.benchmarks, args.repeat)
+  for result in results:
+    print("{0:<30} {1:>8} {2:12.6f} s".format(result['name'], result['size'], result['seconds']))
+
+  if args.baseline is None:
+    return 0
+  if args.update:
+    saveBaseline(results, args.baseline)
+    return 0
+  regressions = compareToBaseline(results, loadBaseline(args.baseline), args.tolerance)
+  for name, size, baselineSeconds, seconds in regressions:
+    print("Regression: {0} with {1} took {2:.6f} s, baseline {3:.6f} s".format(name, size, seconds, baselineSeconds))
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,98 @@
+import numpy as np
+
+#
+# Ultrasound cine loop
+#
+
+
+class CineBuffer(object):
+  """
+  Ring buffer of the most recent tracked frames of an image stream.
+
+  Frames and their poses are copied into arrays that are allocated once, so memory use is fixed
+  by the capacity no matter how long the stream runs or how often it is frozen. Frames are
+  returned as views of the buffer without copying. While the buffer is frozen new frames are
+  ignored, so the views stay valid for cine review until the buffer is unfrozen.
+  """
+
+  def __init__(self, frameShape, dtype, capacity):
+    """
+    :param frameShape: (rows, columns) of the frames
+    :param dtype: pixel type of the frames
+    :param capacity: number of frames kept, e.g. the frame rate times the reviewable duration
+    """
+    if capacity < 1:
+      raise ValueError("Cine buffer capacity must be at least one frame")
+    self.frameShape = tuple(int(n) for n in frameShape)
+    self.dtype = np.dtype(dtype)
+    self.capacity = int(capacity)
+    self._frames = np.zeros((self.capacity,) + self.frameShape, dtype=self.dtype)
+    self._pixelToWorldMatrices = np.tile(np.eye(4), (self.capacity, 1, 1))
+    self._timestamps = np.zeros(self.capacity)
+    self._nextSlot = 0
+    self.numberOfFrames = 0
+    self.frozen = False
+
+  def addFrame(self, frame, pixelToWorldMatrix, timestamp):
+    """
+    Copy a frame into the oldest slot of the buffer.
+    :param frame: (rows, columns) image
+    :param pixelToWorldMatrix: (4, 4) pose of the frame, from (column, row, 0) pixel indices to world
+    :param timestamp: acquisition time in seconds
+    :return: False if the buffer is frozen and the frame was ignored
+    """
+    if self.frozen:
+      return False
+    if np.shape(frame) != self.frameShape:
+      raise ValueError("Frame shape {0} does not match the cine buffer {1}".format(np.shape(frame), self.frameShape))
+    slot = self._nextSlot
+    np.copyto(self._frames[slot], frame, casting='unsafe')
+    self._pixelToWorldMatrices[slot] = pixelToWorldMatrix
+    self._timestamps[slot] = timestamp
+    self._nextSlot = (slot + 1) % self.capacity
+    self.numberOfFrames = min(self.numberOfFrames + 1, self.capacity)
+    return True
+
+  def freeze(self):
+    self.frozen = True
+
+  def unfreeze(self):
+    self.frozen = False
+
+  def clear(self):
+    self._nextSlot = 0
+    self.numberOfFrames = 0
+    self.frozen = False
+
+  def _slot(self, age):
+    if not 0 <= age < self.numberOfFrames:
+      raise ValueError("Cine buffer holds {0} frames, frame {1} is not available".format(self.numberOfFrames, age))
+    return (self._nextSlot - 1 - age) % self.capacity
+
+  def frame(self, age=0):
+    """
+    :param age: 0 for the latest frame, 1 for the one before, up to numberOfFrames - 1
+    :return: read-only (rows, columns) view of the frame in the buffer, its (4, 4) pixelToWorld matrix and timestamp
+    """
+    slot = self._slot(age)
+    frame = self._frames[slot]
+    frame.flags.writeable = False
+    return frame, self._pixelToWorldMatrices[slot].copy(), self._timestamps[slot]
+
+  def ageAtTime(self, timestamp):
+    """
+    :return: age of the buffered frame acquired closest to timestamp
+    """
+    if self.numberOfFrames == 0:
+      raise ValueError("Cine buffer is empty")
+    ages = np.arange(self.numberOfFrames)
+    slots = (self._nextSlot - 1 - ages) % self.capacity
+    return int(ages[np.argmin(np.abs(self._timestamps[slots] - timestamp))])
+
+  def duration(self):
+    """
+    :return: time between the oldest and the latest buffered frame in seconds
+    """
+    if self.numberOfFrames == 0:
+      return 0.0
+    return float(self._timestamps[self._slot(0)] - self._timestamps[self._slot(self.numberOfFrames - 1)])
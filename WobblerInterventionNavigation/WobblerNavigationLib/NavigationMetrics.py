@@ -0,0 +1,236 @@
+import collections
+
+import numpy as np
+
+from .SurfaceRegistration import ClosestPointIndex
+from .Transforms import transformPoints
+
+#
+# Needle guidance metrics
+#
+
+NeedleGuidance = collections.namedtuple('NeedleGuidance', [
+  'tipPosition',  # (3,) needle tip
+  'needleDirection',  # (3,) unit vector the needle points to
+  'tipToTargetDistancesMm',  # (T,) distance from the tip to each target
+  'depthsToTargetsMm',  # (T,) distance along the needle from the tip to the point closest to each target, negative if passed
+  'lateralDeviationsMm',  # (T,) distance of each target from the needle axis
+  'angularDeviationsDeg',  # (T,) angle between the needle and the planned trajectory to each target, NaN if not planned
+  'imagePlaneIntersection',  # (3,) point where the needle axis crosses the image plane, None if parallel or no plane
+  'imagePlaneIntersectionPixel',  # (column, row) of that point in the image, None if there is no intersection
+  'tipToImagePlaneDistanceMm',  # distance along the needle from the tip to the image plane, negative if behind the tip
+  ])
+
+
+class NeedleNavigation(object):
+  """
+  Live guidance metrics of a tracked needle relative to planned targets and the ultrasound image.
+
+  Targets, planned trajectories and the image plane are converted once, when they change, into
+  the coordinate system the needle tip pose is given in, e.g. Reference. Each needle pose update
+  then only costs a few vectorized operations for all targets together.
+  """
+
+  def __init__(self, needleDirectionInTip=(0.0, 0.0, -1.0)):
+    """
+    :param needleDirectionInTip: direction the needle points to in NeedleTip coordinates, the tip
+      Z axis points from the tip towards the needle hub by calibration convention
+    """
+    self.needleDirectionInTip = np.asarray(needleDirectionInTip, dtype=np.float64) / np.linalg.norm(needleDirectionInTip)
+    self.setTargets(np.zeros((0, 3)))
+    self._imagePlaneOrigin = None
+
+  def setTargets(self, targetPoints, entryPoints=None):
+    """
+    :param targetPoints: (T, 3) array
+    :param entryPoints: (T, 3) array of the planned skin entry point of each target, None if there is no plan
+    """
+    self._targets = np.array(targetPoints, dtype=np.float64).reshape(-1, 3)
+    self._trajectoryDirections = np.full(self._targets.shape, np.nan)
+    if entryPoints is not None:
+      trajectories = self._targets - np.asarray(entryPoints, dtype=np.float64).reshape(-1, 3)
+      lengths = np.linalg.norm(trajectories, axis=1, keepdims=True)
+      self._trajectoryDirections = np.where(lengths > 0, trajectories / np.where(lengths > 0, lengths, 1.0), np.nan)
+
+  def numberOfTargets(self):
+    return self._targets.shape[0]
+
+  def setImagePlane(self, pixelToTargetsMatrix):
+    """
+    :param pixelToTargetsMatrix: (4, 4) matrix from (column, row, 0) pixel indices of the image to the
+      coordinate system of the targets, None to stop computing the image plane intersection
+    """
+    if pixelToTargetsMatrix is None:
+      self._imagePlaneOrigin = None
+      return
+    pixelToTargetsMatrix = np.asarray(pixelToTargetsMatrix, dtype=np.float64)
+    normal = np.cross(pixelToTargetsMatrix[:3, 0], pixelToTargetsMatrix[:3, 1])
+    self._imagePlaneNormal = normal / np.linalg.norm(normal)
+    self._imagePlaneOrigin = pixelToTargetsMatrix[:3, 3].copy()
+    self._targetsToPixelMatrix = np.linalg.inv(pixelToTargetsMatrix)
+
+  def update(self, needleTipMatrix):
+    """
+    :param needleTipMatrix: (4, 4) matrix from NeedleTip to the coordinate system of the targets
+    :return: NeedleGuidance
+    """
+    needleTipMatrix = np.asarray(needleTipMatrix, dtype=np.float64)
+    tipPosition = needleTipMatrix[:3, 3]
+    needleDirection = np.dot(needleTipMatrix[:3, :3], self.needleDirectionInTip)
+    needleDirection /= np.linalg.norm(needleDirection)
+
+    tipToTargets = self._targets - tipPosition
+    depths = np.dot(tipToTargets, needleDirection)
+    lateralOffsets = tipToTargets - depths[:, np.newaxis] * needleDirection
+    angularDeviations = np.degrees(np.arccos(np.clip(np.dot(self._trajectoryDirections, needleDirection), -1.0, 1.0)))
+
+    intersection = None
+    intersectionPixel = None
+    tipToImagePlaneDistance = np.nan
+    if self._imagePlaneOrigin is not None:
+      directionAlongNormal = np.dot(self._imagePlaneNormal, needleDirection)
+      if abs(directionAlongNormal) > 1e-9:
+        tipToImagePlaneDistance = np.dot(self._imagePlaneNormal, self._imagePlaneOrigin - tipPosition) / directionAlongNormal
+        intersection = tipPosition + tipToImagePlaneDistance * needleDirection
+        intersectionPixel = np.dot(self._targetsToPixelMatrix[:2, :3], intersection) + self._targetsToPixelMatrix[:2, 3]
+
+    return NeedleGuidance(
+      tipPosition=tipPosition.copy(),
+      needleDirection=needleDirection,
+      tipToTargetDistancesMm=np.linalg.norm(tipToTargets, axis=1),
+      depthsToTargetsMm=depths,
+      lateralDeviationsMm=np.linalg.norm(lateralOffsets, axis=1),
+      angularDeviationsDeg=angularDeviations,
+      imagePlaneIntersection=intersection,
+      imagePlaneIntersectionPixel=intersectionPixel,
+      tipToImagePlaneDistanceMm=float(tipToImagePlaneDistance))
+
+
+def needleAlignedSliceMatrix(needleTipMatrix, lateralDirection=(1.0, 0.0, 0.0), needleDirectionInTip=(0.0, 0.0, -1.0)):
+  """
+  Slice through the needle shaft, e.g. to reslice the CT along the needle. The slice is centered at
+  the tip, its rows run along the needle with the hub up, and its columns follow lateralDirection as
+  closely as possible, so the slice does not turn when the needle is rotated about its own axis.
+  :param needleTipMatrix: (4, 4) matrix from NeedleTip to the slice coordinate system, e.g. RAS
+  :param lateralDirection: preferred column direction, e.g. patient left to right
+  :param needleDirectionInTip: direction the needle points to in NeedleTip coordinates
+  :return: (4, 4) SliceToRAS matrix
+  """
+  needleTipMatrix = np.asarray(needleTipMatrix, dtype=np.float64)
+  needleDirection = np.dot(needleTipMatrix[:3, :3], needleDirectionInTip)
+  needleDirection /= np.linalg.norm(needleDirection)
+  lateralDirection = np.asarray(lateralDirection, dtype=np.float64)
+  columnDirection = lateralDirection - np.dot(lateralDirection, needleDirection) * needleDirection
+  if np.linalg.norm(columnDirection) < 1e-3 * np.linalg.norm(lateralDirection):
+    # The needle points along lateralDirection, any column direction shows the shaft
+    fallbackDirection = np.zeros(3)
+    fallbackDirection[np.argmin(np.abs(needleDirection))] = 1.0
+    columnDirection = fallbackDirection - np.dot(fallbackDirection, needleDirection) * needleDirection
+  columnDirection /= np.linalg.norm(columnDirection)
+
+  sliceMatrix = np.eye(4)
+  sliceMatrix[:3, 0] = columnDirection
+  sliceMatrix[:3, 1] = -needleDirection
+  sliceMatrix[:3, 2] = np.cross(columnDirection, -needleDirection)
+  sliceMatrix[:3, 3] = needleTipMatrix[:3, 3]
+  return sliceMatrix
+
+
+#
+# Proximity of the needle to critical structures
+#
+
+SegmentProximity = collections.namedtuple('SegmentProximity', [
+  'distanceMm',  # shortest distance between the segment and the structure
+  'structurePoint',  # (3,) point of the structure closest to the segment
+  'segmentPoint',  # (3,) point of the segment closest to the structure
+  'segmentFraction',  # position of segmentPoint from the start (0) to the end (1) of the segment
+  ])
+
+
+def segmentProximity(closestPointIndex, segmentStart, segmentEnd, samplingStepMm=1.0):
+  """
+  Shortest distance from a line segment, e.g. the needle trajectory ahead of the tip, to a point set.
+  The segment is sampled and the sample closest to the points bounds the search radius, so only the
+  points in a thin tube around the segment are compared to it exactly. The result is exact for any
+  sampling step, a finer step only makes the tube thinner.
+  :param closestPointIndex: SurfaceRegistration.ClosestPointIndex of the structure points
+  :param segmentStart: (3,) point
+  :param segmentEnd: (3,) point
+  :return: SegmentProximity
+  """
+  segmentStart = np.asarray(segmentStart, dtype=np.float64)
+  segment = np.asarray(segmentEnd, dtype=np.float64) - segmentStart
+  segmentLengthSquared = np.dot(segment, segment)
+  numberOfSamples = max(int(np.ceil(np.sqrt(segmentLengthSquared) / samplingStepMm)), 1) + 1
+  samples = segmentStart + np.linspace(0.0, 1.0, numberOfSamples)[:, np.newaxis] * segment
+
+  # Every segment point is within half a sample spacing of a sample, so the structure point closest to
+  # the segment is at most that much farther from its nearest sample than the closest sample distance
+  sampleDistances, _ = closestPointIndex.closestPoints(samples)
+  searchRadius = sampleDistances.min() + 0.5 * np.sqrt(segmentLengthSquared) / (numberOfSamples - 1) + 1e-9
+  # Samples farther than the search radius from all points have no points within it
+  nearSamples = samples[sampleDistances <= searchRadius]
+  candidatePoints = closestPointIndex.points[closestPointIndex.pointsWithinDistance(nearSamples, searchRadius)]
+
+  fractions = np.zeros(candidatePoints.shape[0])
+  if segmentLengthSquared > 0:
+    fractions = np.clip(np.dot(candidatePoints - segmentStart, segment) / segmentLengthSquared, 0.0, 1.0)
+  segmentPoints = segmentStart + fractions[:, np.newaxis] * segment
+  distances = np.linalg.norm(candidatePoints - segmentPoints, axis=1)
+  closest = int(np.argmin(distances))
+  return SegmentProximity(
+    distanceMm=float(distances[closest]),
+    structurePoint=candidatePoints[closest],
+    segmentPoint=segmentPoints[closest],
+    segmentFraction=float(fractions[closest]))
+
+
+class StructureProximity(object):
+  """
+  Proximity queries of needle segments to a critical structure, e.g. vessels segmented in CT.
+
+  The structure points are kept in the coordinate system of the needle, e.g. Reference, in a KD-tree
+  that is rebuilt lazily, on the first query after the points or the structure to Reference transform,
+  e.g. CTToReference after a registration, have changed.
+  """
+
+  def __init__(self, samplingStepMm=1.0):
+    self.samplingStepMm = samplingStepMm
+    self._structurePoints = None
+    self._structureToReferenceMatrix = np.eye(4)
+    self._closestPointIndex = None
+    self.numberOfIndexBuilds = 0
+
+  def setStructurePoints(self, structurePoints):
+    """
+    :param structurePoints: (M, 3) array of points in structure coordinates, e.g. CT
+    """
+    self._structurePoints = np.array(structurePoints, dtype=np.float64).reshape(-1, 3)
+    self._closestPointIndex = None
+
+  def setStructureToReferenceMatrix(self, matrix):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if not np.array_equal(matrix, self._structureToReferenceMatrix):
+      self._structureToReferenceMatrix = matrix.copy()
+      self._closestPointIndex = None
+
+  def closestPointIndex(self):
+    """
+    :return: SurfaceRegistration.ClosestPointIndex of the structure points in Reference coordinates
+    """
+    if self._closestPointIndex is None:
+      if self._structurePoints is None or self._structurePoints.shape[0] == 0:
+        raise ValueError("The structure has no points")
+      points = transformPoints(self._structureToReferenceMatrix, self._structurePoints)
+      self._closestPointIndex = ClosestPointIndex(points)
+      self.numberOfIndexBuilds += 1
+    return self._closestPointIndex
+
+  def segmentProximity(self, segmentStart, segmentEnd):
+    """
+    :param segmentStart: (3,) point in Reference coordinates
+    :param segmentEnd: (3,) point in Reference coordinates
+    :return: SegmentProximity
+    """
+    return segmentProximity(self.closestPointIndex(), segmentStart, segmentEnd, self.samplingStepMm)
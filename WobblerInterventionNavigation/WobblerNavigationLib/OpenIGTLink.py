@@ -0,0 +1,288 @@
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+#
+# OpenIGTLink messages and a replay server
+#
+
+HEADER_SIZE = 58
+HEADER_FORMAT = '>H12s20sQQQ'
+HEADER_TIMESTAMP_OFFSET = 34
+IMAGE_HEADER_FORMAT = '>HBBBB3H12f3H3H'
+DEVICE_NAME_LENGTH = 20
+
+COORDINATE_RAS = 1
+ENDIAN_BIG = 1
+
+# OpenIGTLink scalar type codes of NumPy types
+SCALAR_TYPES = {
+  np.dtype(np.int8): 2,
+  np.dtype(np.uint8): 3,
+  np.dtype(np.int16): 4,
+  np.dtype(np.uint16): 5,
+  np.dtype(np.int32): 6,
+  np.dtype(np.uint32): 7,
+  np.dtype(np.float32): 10,
+  np.dtype(np.float64): 11,
+  }
+
+_CRC64_POLYNOMIAL = 0x42F0E1EBA9EA3693
+_CRC64_BLOCK_SIZE = 1024
+
+
+def _crc64Table():
+  table = np.zeros(256, dtype=np.uint64)
+  for byte in range(256):
+    crc = byte << 56
+    for _ in range(8):
+      crc = ((crc << 1) ^ _CRC64_POLYNOMIAL) if crc & (1 << 63) else (crc << 1)
+      crc &= 0xFFFFFFFFFFFFFFFF
+    table[byte] = crc
+  return table
+
+
+_CRC64_TABLE = _crc64Table()
+_crc64ShiftTables = None
+
+
+def _crc64Step(crcs, data):
+  # One byte of the table driven CRC for arrays of CRCs and bytes, uint64 shifts drop the high bits
+  return _CRC64_TABLE[((crcs >> np.uint64(56)) ^ data.astype(np.uint64)) & np.uint64(0xFF)] ^ (crcs << np.uint64(8))
+
+
+def _crc64BlockShiftTables():
+  # Feeding a block of zeros maps the CRC linearly, tables of the image of each byte of the CRC
+  global _crc64ShiftTables
+  if _crc64ShiftTables is None:
+    crcs = (np.arange(256, dtype=np.uint64)[np.newaxis, :] << (np.uint64(8) * np.arange(8, dtype=np.uint64)[:, np.newaxis]))
+    zeros = np.zeros(crcs.shape, dtype=np.uint8)
+    for _ in range(_CRC64_BLOCK_SIZE):
+      crcs = _crc64Step(crcs, zeros)
+    _crc64ShiftTables = crcs
+  return _crc64ShiftTables
+
+
+def crc64(data):
+  """
+  CRC-64/ECMA-182 checksum of OpenIGTLink message bodies.
+
+  The CRC is linear and leading zero bytes do not change it, so long bodies such as images are
+  split into equal blocks whose CRCs are computed together, byte by byte across all blocks, and
+  then combined, instead of a Python loop over every byte.
+  :param data: bytes
+  :return: int
+  """
+  data = np.frombuffer(data, dtype=np.uint8)
+  if data.size < 4 * _CRC64_BLOCK_SIZE:
+    table = _CRC64_TABLE.tolist()
+    crc = 0
+    for byte in data.tolist():
+      crc = table[(crc >> 56) ^ byte] ^ ((crc << 8) & 0xFFFFFFFFFFFFFFFF)
+    return crc
+
+  paddedSize = -(-data.size // _CRC64_BLOCK_SIZE) * _CRC64_BLOCK_SIZE
+  blocks = np.concatenate([np.zeros(paddedSize - data.size, dtype=np.uint8), data]).reshape(-1, _CRC64_BLOCK_SIZE)
+  blockCrcs = np.zeros(blocks.shape[0], dtype=np.uint64)
+  for column in range(_CRC64_BLOCK_SIZE):
+    blockCrcs = _crc64Step(blockCrcs, blocks[:, column])
+
+  shiftTables = _crc64BlockShiftTables()
+  crc = 0
+  for blockCrc in blockCrcs.tolist():
+    shiftedCrc = 0
+    for byteIndex in range(8):
+      shiftedCrc ^= int(shiftTables[byteIndex, (crc >> (8 * byteIndex)) & 0xFF])
+    crc = shiftedCrc ^ blockCrc
+  return crc
+
+
+def packTimestamp(timestamp):
+  """
+  :param timestamp: seconds since the epoch
+  :return: 64 bit fixed point timestamp, seconds in the upper and the fraction in the lower 32 bits
+  """
+  seconds = int(timestamp)
+  return (seconds << 32) | int((timestamp - seconds) * 2 ** 32)
+
+
+def unpackTimestamp(packedTimestamp):
+  return (packedTimestamp >> 32) + (packedTimestamp & 0xFFFFFFFF) / 2.0 ** 32
+
+
+def packMessage(messageType, deviceName, timestamp, body):
+  """
+  :return: bytes of an OpenIGTLink version 1 message with header and body
+  """
+  if len(deviceName) > DEVICE_NAME_LENGTH:
+    raise ValueError("Device name {0} is longer than {1} characters".format(deviceName, DEVICE_NAME_LENGTH))
+  header = struct.pack(HEADER_FORMAT, 1, messageType.encode('ascii'), deviceName.encode('ascii'),
+                       packTimestamp(timestamp), len(body), crc64(body))
+  return header + body
+
+
+def unpackHeader(header):
+  """
+  :return: message type, device name, timestamp, body size and CRC of a message header
+  """
+  _, messageType, deviceName, packedTimestamp, bodySize, crc = struct.unpack(HEADER_FORMAT, header)
+  return (messageType.rstrip(b'\0').decode('ascii'), deviceName.rstrip(b'\0').decode('ascii'),
+          unpackTimestamp(packedTimestamp), bodySize, crc)
+
+
+def packTransformMessage(deviceName, matrix, timestamp):
+  """
+  :param matrix: (4, 4) homogeneous transform
+  """
+  matrix = np.asarray(matrix, dtype=np.float64)
+  # Columns of the rotation followed by the translation
+  body = np.concatenate([matrix[:3, :3].T.reshape(-1), matrix[:3, 3]]).astype('>f4').tobytes()
+  return packMessage('TRANSFORM', deviceName, timestamp, body)
+
+
+def unpackTransformBody(body):
+  """
+  :return: (4, 4) matrix of a TRANSFORM message body
+  """
+  values = np.frombuffer(body, dtype='>f4').astype(np.float64)
+  matrix = np.eye(4)
+  matrix[:3, :3] = values[:9].reshape(3, 3).T
+  matrix[:3, 3] = values[9:12]
+  return matrix
+
+
+def packImageMessage(deviceName, frame, ijkToRasMatrix, timestamp):
+  """
+  :param frame: (rows, columns) or (slices, rows, columns) array
+  :param ijkToRasMatrix: (4, 4) matrix from voxel indices to RAS
+  """
+  frame = np.asarray(frame)
+  if frame.dtype not in SCALAR_TYPES:
+    raise ValueError("Images of type {0} can not be sent".format(frame.dtype))
+  if frame.ndim == 2:
+    frame = frame[np.newaxis]
+  size = frame.shape[::-1]
+  ijkToRasMatrix = np.asarray(ijkToRasMatrix, dtype=np.float64)
+  # The position of an image is the center of its voxels
+  center = np.dot(ijkToRasMatrix[:3, :3], (np.array(size) - 1) / 2.0) + ijkToRasMatrix[:3, 3]
+  matrixValues = list(ijkToRasMatrix[:3, 0]) + list(ijkToRasMatrix[:3, 1]) + list(ijkToRasMatrix[:3, 2]) + list(center)
+  imageHeader = struct.pack(IMAGE_HEADER_FORMAT, 1, 1, SCALAR_TYPES[frame.dtype], ENDIAN_BIG, COORDINATE_RAS,
+                            *(list(size) + matrixValues + [0, 0, 0] + list(size)))
+  body = imageHeader + frame.astype(frame.dtype.newbyteorder('>')).tobytes()
+  return packMessage('IMAGE', deviceName, timestamp, body)
+
+
+def replayMessagesFromSession(sessionReader, startTime=-np.inf, stopTime=np.inf, deviceNames=None, ijkToRasMatrix=None):
+  """
+  OpenIGTLink messages of a time window of a recorded session, in the order they were recorded.
+  Streams of (4, 4) items are sent as TRANSFORM, all others as IMAGE messages.
+  :param sessionReader: SessionRecording.SessionReader
+  :param deviceNames: dict of stream name to device name, for stream names that are too long or should be renamed
+  :param ijkToRasMatrix: (4, 4) matrix of the replayed images, identity if None
+  :return: list of (timestamp, message bytes)
+  """
+  deviceNames = deviceNames or {}
+  ijkToRasMatrix = np.eye(4) if ijkToRasMatrix is None else ijkToRasMatrix
+  messages = []
+  for name in sessionReader.streamNames():
+    deviceName = deviceNames.get(name, name)
+    timestamps, items = sessionReader.read(name, startTime, stopTime)
+    for timestamp, item in zip(timestamps, items):
+      if item.shape == (4, 4):
+        messages.append((float(timestamp), packTransformMessage(deviceName, item, timestamp)))
+      else:
+        messages.append((float(timestamp), packImageMessage(deviceName, item, ijkToRasMatrix, timestamp)))
+  messages.sort(key=lambda message: message[0])
+  return messages
+
+
+class ReplayServer(object):
+  """
+  Local stand-in for a PLUS server. Sends prepared OpenIGTLink messages to each client that
+  connects, with the original time between messages scaled by speed, and starts over at the end
+  if loop is set. Clients are served one at a time on a background thread.
+  """
+
+  def __init__(self, messages, host='127.0.0.1', port=0, speed=1.0, loop=True, restamp=True):
+    """
+    :param messages: list of (timestamp, message bytes), e.g. from replayMessagesFromSession
+    :param port: TCP port to listen on, 0 to pick a free one, see self.port after start
+    :param restamp: replace the recorded timestamp in the message headers by the time of sending,
+      like a live device. The checksum only covers the body, so the prepared bodies are reused.
+    """
+    if not messages:
+      raise ValueError("There are no messages to replay")
+    self.messages = messages
+    self.host = host
+    self.port = port
+    self.speed = speed
+    self.loop = loop
+    self.restamp = restamp
+    self.numberOfSentMessages = 0
+    self.numberOfClients = 0
+    self._serverSocket = None
+    self._thread = None
+    self._stopEvent = threading.Event()
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._serverSocket.bind((self.host, self.port))
+    self._serverSocket.listen(1)
+    # Accept times out regularly, so stop does not wait for a client
+    self._serverSocket.settimeout(0.1)
+    self.port = self._serverSocket.getsockname()[1]
+    self._stopEvent.clear()
+    self._thread = threading.Thread(target=self._run, name='OpenIGTLinkReplay')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self._stopEvent.set()
+    self._thread.join()
+    self._thread = None
+    self._serverSocket.close()
+    self._serverSocket = None
+
+  def isRunning(self):
+    return self._thread is not None
+
+  def _run(self):
+    while not self._stopEvent.is_set():
+      try:
+        clientSocket, _ = self._serverSocket.accept()
+      except socket.timeout:
+        continue
+      self.numberOfClients += 1
+      try:
+        self._replay(clientSocket)
+      except (socket.error, OSError):
+        # Client disconnected, wait for the next one
+        pass
+      finally:
+        clientSocket.close()
+
+  def _replay(self, clientSocket):
+    while not self._stopEvent.is_set():
+      firstTimestamp = self.messages[0][0]
+      startTime = time.perf_counter()
+      for timestamp, message in self.messages:
+        delay = (timestamp - firstTimestamp) / self.speed - (time.perf_counter() - startTime)
+        if delay > 0 and self._stopEvent.wait(delay):
+          return
+        if self.restamp:
+          clientSocket.sendall(message[:HEADER_TIMESTAMP_OFFSET])
+          clientSocket.sendall(struct.pack('>Q', packTimestamp(time.time())))
+          clientSocket.sendall(memoryview(message)[HEADER_TIMESTAMP_OFFSET + 8:])
+        else:
+          clientSocket.sendall(message)
+        self.numberOfSentMessages += 1
+      if not self.loop:
+        return
@@ -0,0 +1,169 @@
+import collections
+
+#
+# Supervision of the connection to a PLUS server
+#
+
+DEFAULT_PLUS_PORT = 18944
+
+OFF = 'off'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+WAITING = 'waiting'
+
+
+def parseHostAndPort(hostAndPort, defaultPort=DEFAULT_PLUS_PORT):
+  """
+  :param hostAndPort: "host:port" or "host"
+  :return: host and integer port
+  """
+  host, separator, port = hostAndPort.strip().rpartition(':')
+  if not separator:
+    host, port = port, ''
+  if not host:
+    raise ValueError("No host in {0!r}".format(hostAndPort))
+  if not port:
+    return host, defaultPort
+  if not port.isdigit() or not 0 < int(port) < 65536:
+    raise ValueError("Invalid port in {0!r}".format(hostAndPort))
+  return host, int(port)
+
+
+class ReconnectionBackoff(object):
+  """
+  Exponentially growing delays between reconnection attempts, so a server that is down is not
+  flooded with connection requests but a short network glitch is recovered from quickly.
+  """
+
+  def __init__(self, initialDelaySec=0.5, maximumDelaySec=10.0, factor=2.0):
+    self.initialDelaySec = initialDelaySec
+    self.maximumDelaySec = maximumDelaySec
+    self.factor = factor
+    self.reset()
+
+  def reset(self):
+    self._nextDelaySec = self.initialDelaySec
+
+  def nextDelay(self):
+    """
+    :return: delay before the next attempt in seconds, the following one will be longer
+    """
+    delaySec = self._nextDelaySec
+    self._nextDelaySec = min(self._nextDelaySec * self.factor, self.maximumDelaySec)
+    return delaySec
+
+
+class MessageRateMeter(object):
+  """
+  Rolling message rate of each stream over the last windowSec seconds.
+  """
+
+  def __init__(self, windowSec=2.0):
+    self.windowSec = windowSec
+    self._arrivalTimes = collections.defaultdict(collections.deque)
+
+  def reset(self):
+    self._arrivalTimes.clear()
+
+  def addMessage(self, streamName, arrivalTime):
+    arrivalTimes = self._arrivalTimes[streamName]
+    arrivalTimes.append(arrivalTime)
+    self._dropOldMessages(arrivalTimes, arrivalTime)
+
+  def _dropOldMessages(self, arrivalTimes, now):
+    while arrivalTimes and arrivalTimes[0] < now - self.windowSec:
+      arrivalTimes.popleft()
+
+  def rates(self, now):
+    """
+    :return: dict of stream name to messages per second, 0 for streams that stopped sending
+    """
+    rates = {}
+    for streamName, arrivalTimes in self._arrivalTimes.items():
+      self._dropOldMessages(arrivalTimes, now)
+      rates[streamName] = len(arrivalTimes) / self.windowSec
+    return rates
+
+
+class ConnectionSupervisor(object):
+  """
+  Keeps a client connection to a PLUS server up.
+
+  The connector is any object with Start(), Stop() and GetState() methods, e.g. a
+  vtkMRMLIGTLConnectorNode in client mode, which connects and receives on its own thread. The
+  supervisor never blocks: poll is called periodically, e.g. from a timer on the main thread,
+  checks the connector state and restarts it with increasing delays after a failed attempt or
+  a lost connection.
+  """
+
+  def __init__(self, connector, connectedState, connectionTimeoutSec=3.0, backoff=None, rateWindowSec=2.0):
+    """
+    :param connectedState: value of connector.GetState() when connected
+    :param connectionTimeoutSec: an attempt that is not connected after this time is restarted
+    """
+    self.connector = connector
+    self.connectedState = connectedState
+    self.connectionTimeoutSec = connectionTimeoutSec
+    self.backoff = backoff or ReconnectionBackoff()
+    self.messageRates = MessageRateMeter(rateWindowSec)
+    self.state = OFF
+    self.numberOfConnections = 0
+    self.numberOfAttempts = 0
+    self._stateChangeTime = 0.0
+    self._nextAttemptTime = 0.0
+
+  def start(self, now):
+    self.backoff.reset()
+    self.messageRates.reset()
+    self._attempt(now)
+
+  def stop(self):
+    if self.state != OFF:
+      self.connector.Stop()
+    self.state = OFF
+
+  def _attempt(self, now):
+    self.connector.Start()
+    self.numberOfAttempts += 1
+    self._setState(CONNECTING, now)
+
+  def _wait(self, now):
+    self.connector.Stop()
+    self._nextAttemptTime = now + self.backoff.nextDelay()
+    self._setState(WAITING, now)
+
+  def _setState(self, state, now):
+    self.state = state
+    self._stateChangeTime = now
+
+  def poll(self, now):
+    """
+    :return: current state, OFF, CONNECTING, CONNECTED or WAITING for the next attempt
+    """
+    if self.state == OFF:
+      return self.state
+    connected = self.connector.GetState() == self.connectedState
+    if connected:
+      if self.state != CONNECTED:
+        self.backoff.reset()
+        self.numberOfConnections += 1
+        self._setState(CONNECTED, now)
+    elif self.state == CONNECTED:
+      self._wait(now)
+    elif self.state == CONNECTING and now - self._stateChangeTime > self.connectionTimeoutSec:
+      self._wait(now)
+    elif self.state == WAITING and now >= self._nextAttemptTime:
+      self._attempt(now)
+    return self.state
+
+  def timeInState(self, now):
+    return now - self._stateChangeTime
+
+  def messageReceived(self, streamName, now):
+    self.messageRates.addMessage(streamName, now)
+
+  def streamRates(self, now):
+    """
+    :return: dict of stream name to messages per second over the rate window
+    """
+    return self.messageRates.rates(now)
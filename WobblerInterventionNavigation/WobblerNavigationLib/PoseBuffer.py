@@ -0,0 +1,121 @@
+import numpy as np
+
+from .Transforms import matricesFromQuaternions, quaternionsFromMatrices, slerp
+
+#
+# Timestamped tracker poses
+#
+
+
+class PoseBuffer(object):
+  """
+  Ring buffer of the most recent timestamped poses of a tracked tool, e.g. ProbeToReference.
+
+  Poses are stored as rotation quaternions and translations in arrays that are allocated once.
+  posesAtTimes interpolates the poses at any number of timestamps in one call, e.g. at the
+  acquisition times of all frames of a sweep: rotations by SLERP and translations linearly
+  between the two poses recorded around each timestamp.
+  """
+
+  def __init__(self, capacity=4096):
+    """
+    :param capacity: number of poses kept, e.g. the tracker rate times the longest sweep duration
+    """
+    if capacity < 2:
+      raise ValueError("Pose buffer capacity must be at least two poses")
+    self.capacity = int(capacity)
+    self._timestamps = np.zeros(self.capacity)
+    self._quaternions = np.zeros((self.capacity, 4))
+    self._translations = np.zeros((self.capacity, 3))
+    self._nextSlot = 0
+    self.numberOfPoses = 0
+
+  def clear(self):
+    self._nextSlot = 0
+    self.numberOfPoses = 0
+
+  def addPose(self, timestamp, matrix):
+    """
+    :param timestamp: acquisition time in seconds, must not decrease
+    :param matrix: (4, 4) rigid transform
+    """
+    self.addPoses([timestamp], np.asarray(matrix)[np.newaxis])
+
+  def addPoses(self, timestamps, matrices):
+    """
+    :param timestamps: (N,) acquisition times in seconds, must not decrease
+    :param matrices: (N, 4, 4) rigid transforms
+    """
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    matrices = np.asarray(matrices, dtype=np.float64)
+    if matrices.shape != (timestamps.size, 4, 4):
+      raise ValueError("Expected {0} (4, 4) matrices, got an array of shape {1}".format(timestamps.size, matrices.shape))
+    if timestamps.size == 0:
+      return
+    lastTimestamp = self._timestamps[(self._nextSlot - 1) % self.capacity] if self.numberOfPoses else -np.inf
+    if timestamps[0] < lastTimestamp or np.any(np.diff(timestamps) < 0):
+      raise ValueError("Pose timestamps must not decrease")
+    if timestamps.size > self.capacity:
+      timestamps = timestamps[-self.capacity:]
+      matrices = matrices[-self.capacity:]
+
+    quaternions = quaternionsFromMatrices(matrices)
+    # Keep consecutive quaternions in the same hemisphere, so interpolation never takes the long way round
+    previousQuaternion = self._quaternions[(self._nextSlot - 1) % self.capacity] if self.numberOfPoses else quaternions[0]
+    signs = np.sign(np.sum(quaternions * np.concatenate([[previousQuaternion], quaternions[:-1]]), axis=1))
+    signs[signs == 0] = 1.0
+    quaternions *= np.cumprod(signs)[:, np.newaxis]
+
+    slots = (self._nextSlot + np.arange(timestamps.size)) % self.capacity
+    self._timestamps[slots] = timestamps
+    self._quaternions[slots] = quaternions
+    self._translations[slots] = matrices[:, :3, 3]
+    self._nextSlot = (self._nextSlot + timestamps.size) % self.capacity
+    self.numberOfPoses = min(self.numberOfPoses + timestamps.size, self.capacity)
+
+  def _ordered(self):
+    if self.numberOfPoses < self.capacity:
+      return self._timestamps[:self.numberOfPoses], self._quaternions[:self.numberOfPoses], self._translations[:self.numberOfPoses]
+    order = np.roll(np.arange(self.capacity), -self._nextSlot)
+    return self._timestamps[order], self._quaternions[order], self._translations[order]
+
+  def timeRange(self):
+    """
+    :return: timestamps of the oldest and the newest pose, None if the buffer is empty
+    """
+    if self.numberOfPoses == 0:
+      return None
+    timestamps, _, _ = self._ordered()
+    return float(timestamps[0]), float(timestamps[-1])
+
+  def posesAtTimes(self, timestamps, maximumGapSec=None):
+    """
+    Interpolate the poses at the given times. Times before the oldest or after the newest pose get
+    that pose and are marked invalid.
+    :param timestamps: (K,) times in seconds, in any order
+    :param maximumGapSec: poses interpolated between two poses further apart than this, e.g. when
+      the tool was not visible to the tracker, are marked invalid. None to accept any gap.
+    :return: (K, 4, 4) matrices and (K,) boolean array, True where the pose was interpolated
+      between recorded poses
+    """
+    if self.numberOfPoses == 0:
+      raise ValueError("The pose buffer is empty")
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    poseTimestamps, quaternions, translations = self._ordered()
+
+    # Index of the pose after each time, the interval is between it and the previous pose
+    following = np.clip(np.searchsorted(poseTimestamps, timestamps, side='right'), 1, max(poseTimestamps.size - 1, 1))
+    previous = following - 1
+    following = np.minimum(following, poseTimestamps.size - 1)
+    intervals = poseTimestamps[following] - poseTimestamps[previous]
+    fractions = np.where(intervals > 0, (timestamps - poseTimestamps[previous]) / np.where(intervals > 0, intervals, 1.0), 0.0)
+    fractions = np.clip(fractions, 0.0, 1.0)
+
+    matrices = np.tile(np.eye(4), (timestamps.size, 1, 1))
+    matrices[:, :3, :3] = matricesFromQuaternions(slerp(quaternions[previous], quaternions[following], fractions))
+    matrices[:, :3, 3] = translations[previous] + fractions[:, np.newaxis] * (translations[following] - translations[previous])
+
+    valid = (timestamps >= poseTimestamps[0]) & (timestamps <= poseTimestamps[-1])
+    if maximumGapSec is not None:
+      valid &= intervals <= maximumGapSec
+    return matrices, valid
@@ -0,0 +1,191 @@
+import itertools
+import math
+
+import numpy as np
+
+#
+# Point based registration
+#
+
+RIGID = 'rigid'
+SIMILARITY = 'similarity'
+AFFINE = 'affine'
+
+REGISTRATION_MODES = (RIGID, SIMILARITY, AFFINE)
+
+
+def landmarkRegistration(fromPoints, toPoints, mode=SIMILARITY):
+  """
+  Compute the transform that maps fromPoints onto toPoints in the least squares sense.
+  Rigid and similarity modes use the closed-form SVD solution of Umeyama (1991),
+  affine mode solves the linear least squares problem directly.
+  :param fromPoints: (N, 3) array of points in the "from" coordinate system
+  :param toPoints: (N, 3) array of the corresponding points in the "to" coordinate system
+  :param mode: one of RIGID, SIMILARITY or AFFINE
+  :return: (4, 4) fromToTo matrix and (N, 3) array of residual vectors (toPoint - transformed fromPoint)
+  """
+  fromPoints = np.asarray(fromPoints, dtype=np.float64)
+  toPoints = np.asarray(toPoints, dtype=np.float64)
+  if fromPoints.ndim != 2:
+    raise ValueError("Point sets must be (N, 3) arrays of equal size")
+
+  fromToMatrices, residuals, degenerate = _solveRegistrations(fromPoints[np.newaxis], toPoints[np.newaxis], mode)
+  if degenerate[0]:
+    raise ValueError("Point set is degenerate, check input for collinear points")
+  return fromToMatrices[0], residuals[0]
+
+
+def batchLandmarkRegistration(fromPointSets, toPointSets, mode=SIMILARITY):
+  """
+  Solve K independent landmark registrations in one vectorized call.
+  Degenerate point sets do not abort the batch, their matrix and RMSE are set to NaN.
+  :param fromPointSets: (K, N, 3) array, K sets of N points in the "from" coordinate system
+  :param toPointSets: (K, N, 3) array of the corresponding points in the "to" coordinate system
+  :param mode: one of RIGID, SIMILARITY or AFFINE
+  :return: (K, 4, 4) array of fromToTo matrices and (K,) array of RMSE values
+  """
+  fromPointSets = np.asarray(fromPointSets, dtype=np.float64)
+  toPointSets = np.asarray(toPointSets, dtype=np.float64)
+  if fromPointSets.ndim != 3:
+    raise ValueError("Point sets must be (K, N, 3) arrays of equal size")
+
+  fromToMatrices, residuals, degenerate = _solveRegistrations(fromPointSets, toPointSets, mode)
+  rootMeanSquareErrors = np.sqrt(np.einsum('kni,kni->k', residuals, residuals) / residuals.shape[1])
+  fromToMatrices[degenerate] = np.nan
+  rootMeanSquareErrors[degenerate] = np.nan
+  return fromToMatrices, rootMeanSquareErrors
+
+
+def robustLandmarkRegistration(fromPoints, toPoints, mode=SIMILARITY, inlierThresholdMm=3.0,
+                               maximumNumberOfHypotheses=1000, randomState=None):
+  """
+  Landmark registration that tolerates misplaced points (RANSAC).
+  Registrations of minimal point subsets are solved in one batch, all of them if there are at
+  most maximumNumberOfHypotheses, random ones otherwise. Each hypothesis is scored on all points,
+  points closer than inlierThresholdMm cost their squared error and the others the squared
+  threshold (MSAC). The best hypothesis is refit on its inliers until the inliers do not change.
+  :param fromPoints: (N, 3) array of points in the "from" coordinate system
+  :param toPoints: (N, 3) array of the corresponding points in the "to" coordinate system
+  :param mode: one of RIGID, SIMILARITY or AFFINE
+  :param inlierThresholdMm: largest distance of a point that is consistent with the registration
+  :param randomState: numpy.random.RandomState for drawing the subsets, a fixed seed if None
+  :return: (4, 4) fromToTo matrix and (N,) boolean array, False for the rejected points
+  """
+  fromPoints = np.asarray(fromPoints, dtype=np.float64)
+  toPoints = np.asarray(toPoints, dtype=np.float64)
+  if fromPoints.ndim != 2:
+    raise ValueError("Point sets must be (N, 3) arrays of equal size")
+  numberOfPoints = fromPoints.shape[0]
+  sampleSize = 4 if mode == AFFINE else 3
+  if numberOfPoints <= sampleSize:
+    # No point can be checked against the others
+    fromToMatrix, _ = landmarkRegistration(fromPoints, toPoints, mode)
+    return fromToMatrix, np.ones(numberOfPoints, dtype=bool)
+
+  if math.comb(numberOfPoints, sampleSize) <= maximumNumberOfHypotheses:
+    samples = np.array(list(itertools.combinations(range(numberOfPoints), sampleSize)))
+  else:
+    randomState = np.random.RandomState(0) if randomState is None else randomState
+    samples = np.argsort(randomState.random_sample((maximumNumberOfHypotheses, numberOfPoints)), axis=1)[:, :sampleSize]
+  hypotheses, _, degenerate = _solveRegistrations(fromPoints[samples], toPoints[samples], mode)
+
+  # (K, N) squared distances of all points under all hypotheses
+  differences = toPoints - (np.einsum('kij,nj->kni', hypotheses[:, :3, :3], fromPoints) + hypotheses[:, np.newaxis, :3, 3])
+  squaredDistances = np.einsum('kni,kni->kn', differences, differences)
+  squaredThreshold = inlierThresholdMm ** 2
+  costs = np.minimum(squaredDistances, squaredThreshold).sum(axis=1)
+  costs[degenerate] = np.inf
+  bestHypothesis = int(np.argmin(costs))
+  if not np.isfinite(costs[bestHypothesis]):
+    raise ValueError("Point set is degenerate, check input for collinear points")
+  inliers = squaredDistances[bestHypothesis] <= squaredThreshold
+
+  for refinement in range(5):
+    fromToMatrix, _ = landmarkRegistration(fromPoints[inliers], toPoints[inliers], mode)
+    residuals = toPoints - (np.dot(fromPoints, fromToMatrix[:3, :3].T) + fromToMatrix[:3, 3])
+    refinedInliers = np.einsum('ni,ni->n', residuals, residuals) <= squaredThreshold
+    if np.array_equal(refinedInliers, inliers) or np.count_nonzero(refinedInliers) < sampleSize or refinement == 4:
+      break
+    inliers = refinedInliers
+  return fromToMatrix, inliers
+
+
+def rootMeanSquareError(residuals):
+  """
+  Root mean square of the residual vector lengths.
+  :param residuals: (N, 3) array of residual vectors
+  """
+  residuals = np.asarray(residuals, dtype=np.float64)
+  return float(np.sqrt(np.einsum('ij,ij->', residuals, residuals) / residuals.shape[0]))
+
+
+def _solveRegistrations(fromPointSets, toPointSets, mode):
+  """
+  Registration solver shared by the single and batch entry points. Works on (K, N, 3) stacks.
+  :return: (K, 4, 4) matrices, (K, N, 3) residuals and (K,) boolean mask of degenerate point sets
+  """
+  if mode not in REGISTRATION_MODES:
+    raise ValueError("Unknown registration mode: {0}".format(mode))
+  if fromPointSets.shape[-1] != 3 or fromPointSets.shape != toPointSets.shape:
+    raise ValueError("Point sets must be arrays of 3D points of equal size")
+  minimumNumberOfPoints = 4 if mode == AFFINE else 3
+  if fromPointSets.shape[1] < minimumNumberOfPoints:
+    raise ValueError("At least {0} points are needed for {1} registration".format(minimumNumberOfPoints, mode))
+
+  fromCentroids = fromPointSets.mean(axis=1)
+  toCentroids = toPointSets.mean(axis=1)
+  fromCentered = fromPointSets - fromCentroids[:, np.newaxis, :]
+  toCentered = toPointSets - toCentroids[:, np.newaxis, :]
+
+  if mode == AFFINE:
+    fromToMatrices, degenerate = _solveAffineFromMoments(
+      fromCentroids, toCentroids, np.einsum('kni,knj->kij', fromCentered, fromCentered),
+      np.einsum('kni,knj->kij', fromCentered, toCentered))
+  else:
+    fromToMatrices, degenerate = _solveSimilarityFromMoments(
+      fromCentroids, toCentroids, np.einsum('kni,knj->kij', toCentered, fromCentered),
+      np.einsum('kni,kni->k', fromCentered, fromCentered), mode)
+
+  residuals = toCentered - np.einsum('kij,knj->kni', fromToMatrices[:, :3, :3], fromCentered)
+  return fromToMatrices, residuals, degenerate
+
+
+def _solveSimilarityFromMoments(fromCentroids, toCentroids, covariances, fromVariances, mode):
+  """
+  Closed-form rigid or similarity solution from the centered moments of K point set pairs.
+  :param covariances: (K, 3, 3) sums of outer products of centered to and from points
+  :param fromVariances: (K,) sums of squared lengths of the centered from points
+  :return: (K, 4, 4) matrices and (K,) boolean mask of degenerate point sets
+  """
+  numberOfSets = covariances.shape[0]
+  U, singularValues, Vt = np.linalg.svd(covariances)
+  degenerate = singularValues[:, 1] <= 1e-8 * np.maximum(singularValues[:, 0], 1e-300)
+  reflections = np.ones((numberOfSets, 3))
+  reflections[np.linalg.det(U) * np.linalg.det(Vt) < 0, 2] = -1.0
+  rotations = np.matmul(U * reflections[:, np.newaxis, :], Vt)
+  if mode == SIMILARITY:
+    scales = np.einsum('ki,ki->k', singularValues, reflections) / np.maximum(fromVariances, 1e-300)
+    rotations *= scales[:, np.newaxis, np.newaxis]
+  return _matricesFromLinearParts(rotations, fromCentroids, toCentroids), degenerate
+
+
+def _solveAffineFromMoments(fromCentroids, toCentroids, fromCovariances, crossCovariances):
+  """
+  Least squares affine solution from the centered moments of K point set pairs.
+  Centering decouples the translation, so only the 3x3 part needs to be solved.
+  :param fromCovariances: (K, 3, 3) sums of outer products of centered from points
+  :param crossCovariances: (K, 3, 3) sums of outer products of centered from and to points
+  :return: (K, 4, 4) matrices and (K,) boolean mask of degenerate point sets
+  """
+  eigenvalues = np.linalg.eigvalsh(fromCovariances)
+  # Eigenvalues are the squared singular values of the centered from points
+  degenerate = eigenvalues[:, 0] <= 1e-16 * np.maximum(eigenvalues[:, 2], 1e-300)
+  linear = np.matmul(np.linalg.pinv(fromCovariances), crossCovariances)
+  return _matricesFromLinearParts(np.swapaxes(linear, 1, 2), fromCentroids, toCentroids), degenerate
+
+
+def _matricesFromLinearParts(linearParts, fromCentroids, toCentroids):
+  fromToMatrices = np.tile(np.eye(4), (linearParts.shape[0], 1, 1))
+  fromToMatrices[:, :3, :3] = linearParts
+  fromToMatrices[:, :3, 3] = toCentroids - np.einsum('kij,kj->ki', linearParts, fromCentroids)
+  return fromToMatrices
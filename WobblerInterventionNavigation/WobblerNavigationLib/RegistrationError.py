@@ -0,0 +1,100 @@
+import collections
+import numpy as np
+
+from . import Registration
+from .Transforms import transformPoints
+
+#
+# Registration error analysis
+#
+
+RegistrationErrorStatistics = collections.namedtuple('RegistrationErrorStatistics', [
+  'residuals',  # (N, 3) toPoint - transformed fromPoint
+  'distances',  # (N,) length of each residual
+  'rootMeanSquareError',
+  'maximumError',
+  'percentileErrors',  # {percentile: error}
+  'leaveOneOutErrors',  # (N,) error at each point when it is left out of the registration
+  'leaveOneOutRootMeanSquareError',
+  ])
+
+
+def registrationErrorStatistics(fromPoints, toPoints, fromToMatrix, mode=Registration.SIMILARITY, percentiles=(50, 95)):
+  """
+  Evaluate how well fromToMatrix maps fromPoints onto toPoints.
+  The leave-one-out error re-registers the points N times, each time without one point,
+  and measures the error at the point that was left out. All N registrations are solved
+  in a single batch.
+  :param fromPoints: (N, 3) array
+  :param toPoints: (N, 3) array
+  :param fromToMatrix: (4, 4) array
+  :param mode: registration mode used for the leave-one-out registrations
+  :param percentiles: percentiles of the point distance distribution to report
+  :return: RegistrationErrorStatistics
+  """
+  fromPoints = np.asarray(fromPoints, dtype=np.float64)
+  toPoints = np.asarray(toPoints, dtype=np.float64)
+  if fromPoints.ndim != 2 or fromPoints.shape[1] != 3 or fromPoints.shape != toPoints.shape:
+    raise ValueError("Point sets must be (N, 3) arrays of equal size")
+  if fromPoints.shape[0] == 0:
+    raise ValueError("Point sets are empty")
+
+  residuals = toPoints - transformPoints(fromToMatrix, fromPoints)
+  distances = np.sqrt(np.einsum('ij,ij->i', residuals, residuals))
+  percentileErrors = {percentile: float(error) for percentile, error in zip(percentiles, np.percentile(distances, percentiles))}
+
+  leaveOneOutErrors = leaveOneOutRegistrationErrors(fromPoints, toPoints, mode)
+
+  return RegistrationErrorStatistics(
+    residuals=residuals,
+    distances=distances,
+    rootMeanSquareError=float(np.sqrt(np.mean(distances ** 2))),
+    maximumError=float(distances.max()),
+    percentileErrors=percentileErrors,
+    leaveOneOutErrors=leaveOneOutErrors,
+    leaveOneOutRootMeanSquareError=float(np.sqrt(np.mean(leaveOneOutErrors ** 2))),
+    )
+
+
+def leaveOneOutRegistrationErrors(fromPoints, toPoints, mode=Registration.SIMILARITY):
+  """
+  For each point, register all other points and measure the distance between the point and
+  its prediction. Values are NaN when too few points remain or the remaining points are degenerate.
+  :return: (N,) array of leave-one-out errors
+  """
+  numberOfPoints = fromPoints.shape[0]
+  minimumNumberOfPoints = 4 if mode == Registration.AFFINE else 3
+  if numberOfPoints - 1 < minimumNumberOfPoints:
+    return np.full(numberOfPoints, np.nan)
+
+  # Registering all points but point i only needs the point set moments without point i. They are
+  # downdated from the moments of the full set, so the N registrations cost O(N) instead of O(N^2).
+  # Working relative to the full centroids keeps the downdates well conditioned.
+  fromCentroid = fromPoints.mean(axis=0)
+  toCentroid = toPoints.mean(axis=0)
+  fromCentered = fromPoints - fromCentroid
+  toCentered = toPoints - toCentroid
+  numberOfKeptPoints = float(numberOfPoints - 1)
+  keptFromCentroids = -fromCentered / numberOfKeptPoints
+  keptToCentroids = -toCentered / numberOfKeptPoints
+
+  if mode == Registration.AFFINE:
+    keptFromCovariances = (np.dot(fromCentered.T, fromCentered) - np.einsum('ki,kj->kij', fromCentered, fromCentered)
+                           - numberOfKeptPoints * np.einsum('ki,kj->kij', keptFromCentroids, keptFromCentroids))
+    keptCrossCovariances = (np.dot(fromCentered.T, toCentered) - np.einsum('ki,kj->kij', fromCentered, toCentered)
+                            - numberOfKeptPoints * np.einsum('ki,kj->kij', keptFromCentroids, keptToCentroids))
+    fromToMatrices, degenerate = Registration._solveAffineFromMoments(
+      keptFromCentroids, keptToCentroids, keptFromCovariances, keptCrossCovariances)
+  else:
+    keptCovariances = (np.dot(toCentered.T, fromCentered) - np.einsum('ki,kj->kij', toCentered, fromCentered)
+                       - numberOfKeptPoints * np.einsum('ki,kj->kij', keptToCentroids, keptFromCentroids))
+    keptFromVariances = (np.einsum('ki,ki->', fromCentered, fromCentered) - np.einsum('ki,ki->k', fromCentered, fromCentered)
+                         - numberOfKeptPoints * np.einsum('ki,ki->k', keptFromCentroids, keptFromCentroids))
+    fromToMatrices, degenerate = Registration._solveSimilarityFromMoments(
+      keptFromCentroids, keptToCentroids, keptCovariances, keptFromVariances, mode)
+
+  predictedPoints = np.einsum('kij,kj->ki', fromToMatrices[:, :3, :3], fromCentered) + fromToMatrices[:, :3, 3]
+  differences = toCentered - predictedPoints
+  leaveOneOutErrors = np.sqrt(np.einsum('ij,ij->i', differences, differences))
+  leaveOneOutErrors[degenerate] = np.nan
+  return leaveOneOutErrors
@@ -0,0 +1,226 @@
+import collections
+import json
+
+import numpy as np
+
+#
+# Wobbler probe scan conversion
+#
+
+WobblerProbeGeometry = collections.namedtuple('WobblerProbeGeometry', [
+  'transducerRadiusMm',  # radius of curvature of the transducer array
+  'fieldOfViewDeg',  # angle between the first and the last scan line of a frame
+  'numberOfLines',
+  'numberOfSamples',  # samples per scan line
+  'depthMm',  # imaging depth, distance from the transducer surface to the last sample
+  'motorRadiusMm',  # distance from the motor axis to the center of curvature of the array
+  'motorAnglesDeg',  # increasing motor angle of each frame of a sweep
+  ])
+"""
+Geometry of a curved array that is swept by a motor, defined in the US coordinate system:
+the motor axis is the X axis, Y points from the motor axis towards the transducer at motor
+angle 0, scan lines fan out in the XY plane and the motor tilts the frames towards Z.
+"""
+
+
+def sweepPoints(geometry, frames, lines, samples):
+  """
+  Position of raw sweep samples in the US coordinate system. Indices may be fractional.
+  :return: (..., 3) array of points
+  """
+  geometry = _validatedGeometry(geometry)
+  motorAngles = np.radians(np.interp(frames, np.arange(len(geometry.motorAnglesDeg)), geometry.motorAnglesDeg))
+  lineAngles = np.radians(-0.5 * geometry.fieldOfViewDeg + lines * _lineSpacingDeg(geometry))
+  radii = geometry.transducerRadiusMm + samples * _sampleSpacingMm(geometry)
+  inPlaneY = geometry.motorRadiusMm + radii * np.cos(lineAngles)
+  return np.stack([radii * np.sin(lineAngles), inPlaneY * np.cos(motorAngles), inPlaneY * np.sin(motorAngles)], axis=-1)
+
+
+def _lineSpacingDeg(geometry):
+  return geometry.fieldOfViewDeg / (geometry.numberOfLines - 1)
+
+
+def _sampleSpacingMm(geometry):
+  return geometry.depthMm / (geometry.numberOfSamples - 1)
+
+
+def _validatedGeometry(geometry):
+  # Motor angles are stored as a tuple, so geometries can be compared
+  geometry = geometry._replace(motorAnglesDeg=tuple(float(angle) for angle in geometry.motorAnglesDeg))
+  if geometry.numberOfLines < 2 or geometry.numberOfSamples < 2 or len(geometry.motorAnglesDeg) < 2:
+    raise ValueError("Wobbler sweeps need at least two frames, lines and samples")
+  if np.any(np.diff(geometry.motorAnglesDeg) <= 0):
+    raise ValueError("Motor angles of a sweep must be increasing")
+  return geometry
+
+
+def geometryToJSON(geometry):
+  """
+  :return: WobblerProbeGeometry as a JSON string, e.g. to store it in a parameter node
+  """
+  return json.dumps(_validatedGeometry(geometry)._asdict())
+
+
+def geometryFromJSON(geometryJSON):
+  """
+  :param geometryJSON: string written by geometryToJSON
+  :return: WobblerProbeGeometry
+  """
+  try:
+    return _validatedGeometry(WobblerProbeGeometry(**json.loads(geometryJSON)))
+  except (TypeError, ValueError) as error:
+    raise ValueError("Invalid wobbler probe geometry: {0}".format(error))
+
+
+class ScanConversionTable(object):
+  """
+  Lookup table that maps a raw wobbler sweep of (frames, lines, samples) onto a Cartesian grid.
+
+  For every voxel inside the swept region the table stores the flat sweep index of the sample
+  cell that contains the voxel and the fractional position within that cell, so converting a
+  sweep is a vectorized gather of the 8 cell corners and a trilinear blend, without any
+  trigonometry per frame.
+  """
+
+  def __init__(self, geometry, probeToUSMatrix, spacingMm, slabSize=16):
+    """
+    :param geometry: WobblerProbeGeometry
+    :param probeToUSMatrix: (4, 4) calibration matrix, the grid is axis aligned in the probe coordinate system
+    :param spacingMm: isotropic voxel size
+    :param slabSize: number of grid slices processed at once while building, limits temporary memory
+    """
+    self.geometry = _validatedGeometry(geometry)
+    self.probeToUSMatrix = np.array(probeToUSMatrix, dtype=np.float64)
+    self.spacingMm = float(spacingMm)
+    geometry = self.geometry
+    self.sweepShape = (len(geometry.motorAnglesDeg), geometry.numberOfLines, geometry.numberOfSamples)
+
+    # Grid around the boundary of the swept region
+    usToProbeMatrix = np.linalg.inv(self.probeToUSMatrix)
+    frames, lines, samples = [np.linspace(0, n - 1, min(n, 16)) for n in self.sweepShape]
+    boundaryPoints = np.concatenate([
+      sweepPoints(geometry, *np.meshgrid([0, self.sweepShape[0] - 1], lines, samples)).reshape(-1, 3),
+      sweepPoints(geometry, *np.meshgrid(frames, [0, self.sweepShape[1] - 1], samples)).reshape(-1, 3),
+      sweepPoints(geometry, *np.meshgrid(frames, lines, [0, self.sweepShape[2] - 1])).reshape(-1, 3),
+      ])
+    # The outermost sample arc bulges beyond its sampled points, the margin of one voxel covers it
+    boundaryPoints = np.dot(boundaryPoints, usToProbeMatrix[:3, :3].T) + usToProbeMatrix[:3, 3]
+    minimum = boundaryPoints.min(axis=0) - self.spacingMm
+    maximum = boundaryPoints.max(axis=0) + self.spacingMm
+    numberOfVoxels = np.ceil((maximum - minimum) / self.spacingMm).astype(int) + 1
+    self.dimensions = tuple(int(n) for n in numberOfVoxels[::-1])
+    self.voxelToProbeMatrix = np.diag([self.spacingMm, self.spacingMm, self.spacingMm, 1.0])
+    self.voxelToProbeMatrix[:3, 3] = minimum
+
+    voxelNumbers = []
+    cellIndices = []
+    cellFractions = []
+    voxelToUSMatrix = np.dot(self.probeToUSMatrix, self.voxelToProbeMatrix)
+    slices, rows, columns = self.dimensions
+    for firstSlice in range(0, slices, slabSize):
+      slabSlices = min(slabSize, slices - firstSlice)
+      k, j, i = np.indices((slabSlices, rows, columns)).reshape(3, -1)
+      voxelIndices = np.stack([i, j, k + firstSlice]).astype(np.float64)
+      usPoints = np.dot(voxelToUSMatrix[:3, :3], voxelIndices) + voxelToUSMatrix[:3, 3:4]
+      inside, indices, fractions = self._sweepCells(usPoints)
+      voxelNumbers.append(firstSlice * rows * columns + np.flatnonzero(inside))
+      cellIndices.append(indices)
+      cellFractions.append(fractions)
+
+    self.voxelNumbers = np.concatenate(voxelNumbers)
+    self.cellIndices = np.concatenate(cellIndices)
+    self.cellFractions = np.concatenate(cellFractions, axis=1)
+
+    self._framesStride = self.sweepShape[1] * self.sweepShape[2]
+    self._linesStride = self.sweepShape[2]
+
+  def _sweepCells(self, usPoints):
+    # Invert sweepPoints: motor angle from the YZ plane, then polar coordinates within the frame
+    geometry = self.geometry
+    x, y, z = usPoints
+    motorAnglesDeg = np.degrees(np.arctan2(z, y))
+    inPlaneY = np.hypot(y, z) - geometry.motorRadiusMm
+    lineAnglesDeg = np.degrees(np.arctan2(x, inPlaneY))
+    radii = np.hypot(x, inPlaneY)
+
+    frames = np.interp(motorAnglesDeg, geometry.motorAnglesDeg, np.arange(self.sweepShape[0]), left=-1.0, right=-1.0)
+    lines = (lineAnglesDeg + 0.5 * geometry.fieldOfViewDeg) / _lineSpacingDeg(geometry)
+    samples = (radii - geometry.transducerRadiusMm) / _sampleSpacingMm(geometry)
+    positions = np.stack([frames, lines, samples])
+    sizes = np.array(self.sweepShape)[:, np.newaxis]
+    inside = np.all((positions >= 0) & (positions <= sizes - 1), axis=0) & (inPlaneY > 0)
+
+    positions = positions[:, inside]
+    # The last cell is used for positions on the upper boundary, so all 8 corners exist
+    cells = np.minimum(np.floor(positions).astype(np.int64), sizes - 2)
+    fractions = (positions - cells).astype(np.float32)
+    indices = ((cells[0] * self.sweepShape[1] + cells[1]) * self.sweepShape[2] + cells[2]).astype(np.int32)
+    return inside, indices, fractions
+
+  def convert(self, sweep, out=None):
+    """
+    Scan convert one sweep.
+    :param sweep: (frames, lines, samples) array
+    :param out: optional (slices, rows, columns) float32 array to write into, voxels outside the sweep are not modified
+    :return: (slices, rows, columns) float32 volume in the grid of voxelToProbeMatrix
+    """
+    if out is None:
+      out = np.zeros(self.dimensions, dtype=np.float32)
+    out.reshape(-1)[self.voxelNumbers] = self.convertedValues(sweep)
+    return out
+
+  def convertedValues(self, sweep):
+    """
+    :param sweep: (frames, lines, samples) array
+    :return: float32 array of the scan converted values of the voxels listed in self.voxelNumbers
+    """
+    sweep = np.asarray(sweep)
+    if sweep.shape != self.sweepShape:
+      raise ValueError("Sweep shape {0} does not match the probe geometry {1}".format(sweep.shape, self.sweepShape))
+
+    flatSweep = sweep.reshape(-1)
+    frameFractions, lineFractions, sampleFractions = self.cellFractions
+    frameWeights = (1.0 - frameFractions, frameFractions)
+    lineWeights = (1.0 - lineFractions, lineFractions)
+    sampleWeights = (1.0 - sampleFractions, sampleFractions)
+    values = np.zeros(self.cellIndices.shape, dtype=np.float32)
+    for df in (0, 1):
+      for dl in (0, 1):
+        frameLineWeights = frameWeights[df] * lineWeights[dl]
+        for ds in (0, 1):
+          offset = df * self._framesStride + dl * self._linesStride + ds
+          values += frameLineWeights * sampleWeights[ds] * flatSweep[self.cellIndices + offset]
+    return values
+
+
+class ScanConversionCache(object):
+  """
+  Keeps the scan conversion table of the current probe geometry and calibration. The table is
+  only rebuilt when the geometry, e.g. the depth setting, the voxel size or the ProbeToUS
+  calibration changes.
+  """
+
+  def __init__(self, geometry, spacingMm):
+    self.geometry = _validatedGeometry(geometry)
+    self.spacingMm = spacingMm
+    self.numberOfBuilds = 0
+    self._table = None
+
+  def setGeometry(self, geometry):
+    self.geometry = _validatedGeometry(geometry)
+
+  def setSpacing(self, spacingMm):
+    self.spacingMm = spacingMm
+
+  def lookupTable(self, probeToUSMatrix):
+    """
+    :param probeToUSMatrix: (4, 4) current calibration matrix
+    :return: ScanConversionTable, from the cache if nothing has changed since it was built
+    """
+    table = self._table
+    if (table is None or table.geometry != self.geometry or table.spacingMm != float(self.spacingMm)
+        or not np.array_equal(table.probeToUSMatrix, probeToUSMatrix)):
+      table = ScanConversionTable(self.geometry, probeToUSMatrix, self.spacingMm)
+      self._table = table
+      self.numberOfBuilds += 1
+    return table
@@ -0,0 +1,228 @@
+import json
+import os
+
+import numpy as np
+
+#
+# Chunked memory-mapped recording of tracked image and transform streams
+#
+
+SESSION_FORMAT_VERSION = 1
+
+SESSION_INDEX_FILE_NAME = 'session.json'
+
+
+class SessionRecorder(object):
+  """
+  Appends timestamped items of several streams, e.g. ultrasound frames and tracker poses, to a
+  session directory.
+
+  Each stream is stored in chunks of a fixed number of items. A chunk is a memory-mapped .npy
+  file of the items and one of their timestamps. Only the current chunk of each stream is mapped,
+  so recording for hours does not grow memory use. The session index lists the chunks with their
+  time range and is rewritten whenever a chunk is started or finished. Timestamps of unwritten
+  items are NaN, so a session that was not closed, e.g. after a crash, can still be read.
+  """
+
+  def __init__(self, directory, chunkSize=256):
+    """
+    :param directory: session directory, created if it does not exist, must not contain a session yet
+    :param chunkSize: number of items per chunk file
+    """
+    if chunkSize < 1:
+      raise ValueError("Chunk size must be at least one item")
+    if os.path.exists(os.path.join(directory, SESSION_INDEX_FILE_NAME)):
+      raise ValueError("Directory {0} already contains a recorded session".format(directory))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.chunkSize = int(chunkSize)
+    self._streams = {}
+    self._openChunks = {}
+    self._writeIndex()
+
+  def addStream(self, name, itemShape, dtype):
+    """
+    :param name: unique stream name, e.g. the transform or image node name
+    :param itemShape: shape of one item, e.g. (4, 4) for transforms or (rows, columns) for frames
+    :param dtype: type of the items
+    """
+    if name in self._streams:
+      raise ValueError("Stream {0} is already recorded".format(name))
+    self._streams[name] = {
+      'itemShape': [int(n) for n in itemShape],
+      'dtype': np.dtype(dtype).str,
+      'chunks': [],
+      }
+    self._writeIndex()
+
+  def hasStream(self, name):
+    return name in self._streams
+
+  def append(self, name, item, timestamp):
+    """
+    Copy an item to the current chunk of its stream.
+    :param timestamp: acquisition time in seconds, must not decrease within a stream
+    """
+    stream = self._streams[name]
+    openChunk = self._openChunks.get(name)
+    if openChunk is not None and timestamp < openChunk['lastTimestamp']:
+      raise ValueError("Timestamps of stream {0} must not decrease".format(name))
+    if openChunk is None or openChunk['count'] == self.chunkSize:
+      openChunk = self._startChunk(name, stream)
+
+    count = openChunk['count']
+    openChunk['items'][count] = item
+    openChunk['timestamps'][count] = timestamp
+    openChunk['count'] = count + 1
+    openChunk['lastTimestamp'] = timestamp
+    chunk = stream['chunks'][-1]
+    if chunk['firstTimestamp'] is None:
+      chunk['firstTimestamp'] = float(timestamp)
+
+  def _startChunk(self, name, stream):
+    self._finishChunk(name)
+    chunkNumber = len(stream['chunks'])
+    itemsFileName = '{0}_{1:06d}.npy'.format(name, chunkNumber)
+    timestampsFileName = '{0}_{1:06d}_timestamps.npy'.format(name, chunkNumber)
+    items = np.lib.format.open_memmap(os.path.join(self.directory, itemsFileName), mode='w+', dtype=np.dtype(stream['dtype']),
+                                      shape=(self.chunkSize,) + tuple(stream['itemShape']))
+    timestamps = np.lib.format.open_memmap(os.path.join(self.directory, timestampsFileName), mode='w+', dtype=np.float64,
+                                           shape=(self.chunkSize,))
+    timestamps.fill(np.nan)
+    stream['chunks'].append({
+      'itemsFile': itemsFileName,
+      'timestampsFile': timestampsFileName,
+      'firstTimestamp': None,
+      'lastTimestamp': None,
+      'count': None,
+      })
+    openChunk = {'items': items, 'timestamps': timestamps, 'count': 0, 'lastTimestamp': -np.inf}
+    self._openChunks[name] = openChunk
+    self._writeIndex()
+    return openChunk
+
+  def _finishChunk(self, name):
+    openChunk = self._openChunks.pop(name, None)
+    if openChunk is None:
+      return
+    openChunk['items'].flush()
+    openChunk['timestamps'].flush()
+    chunk = self._streams[name]['chunks'][-1]
+    chunk['count'] = openChunk['count']
+    chunk['lastTimestamp'] = float(openChunk['lastTimestamp'])
+
+  def flush(self):
+    """
+    Write the mapped chunks to disk.
+    """
+    for openChunk in self._openChunks.values():
+      openChunk['items'].flush()
+      openChunk['timestamps'].flush()
+
+  def close(self):
+    for name in list(self._openChunks):
+      self._finishChunk(name)
+    self._writeIndex()
+
+  def _writeIndex(self):
+    index = {'formatVersion': SESSION_FORMAT_VERSION, 'chunkSize': self.chunkSize, 'streams': self._streams}
+    # Replace the index atomically, a reader never sees a partially written file
+    temporaryFileName = os.path.join(self.directory, SESSION_INDEX_FILE_NAME + '.tmp')
+    with open(temporaryFileName, 'w') as indexFile:
+      json.dump(index, indexFile, indent=2, sort_keys=True)
+    os.replace(temporaryFileName, os.path.join(self.directory, SESSION_INDEX_FILE_NAME))
+
+
+class SessionReader(object):
+  """
+  Random access to a session written by SessionRecorder. Only the chunks that overlap a
+  requested time window are mapped.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    with open(os.path.join(directory, SESSION_INDEX_FILE_NAME)) as indexFile:
+      index = json.load(indexFile)
+    if index.get('formatVersion') != SESSION_FORMAT_VERSION:
+      raise ValueError("Unsupported session format in {0}".format(directory))
+    self._streams = index['streams']
+
+  def streamNames(self):
+    return sorted(self._streams)
+
+  def _chunkTimestamps(self, chunk):
+    timestamps = np.load(os.path.join(self.directory, chunk['timestampsFile']), mmap_mode='r')
+    count = chunk['count']
+    if count is None:
+      # Chunk of a session that was not closed, written items come first
+      count = int(np.count_nonzero(~np.isnan(timestamps)))
+    return timestamps[:count]
+
+  def timeRange(self, name):
+    """
+    :return: timestamps of the first and the last item of the stream, None if it is empty
+    """
+    chunks = self._streams[name]['chunks']
+    firstTimestamps = None
+    for chunk in chunks:
+      firstTimestamps = self._chunkTimestamps(chunk)
+      if firstTimestamps.size > 0:
+        break
+    if firstTimestamps is None or firstTimestamps.size == 0:
+      return None
+    for chunk in reversed(chunks):
+      lastTimestamps = self._chunkTimestamps(chunk)
+      if lastTimestamps.size > 0:
+        return float(firstTimestamps[0]), float(lastTimestamps[-1])
+
+  def read(self, name, startTime, stopTime):
+    """
+    :return: (K,) timestamps and (K, ...) array of the items of the stream with startTime <= timestamp <= stopTime
+    """
+    stream = self._streams[name]
+    timestampParts = []
+    itemParts = []
+    for chunk in stream['chunks']:
+      # Finished chunks outside the window are skipped without opening them
+      if chunk['count'] is not None and (chunk['count'] == 0 or chunk['lastTimestamp'] < startTime
+                                         or chunk['firstTimestamp'] > stopTime):
+        continue
+      timestamps = self._chunkTimestamps(chunk)
+      first = np.searchsorted(timestamps, startTime, side='left')
+      last = np.searchsorted(timestamps, stopTime, side='right')
+      if first == last:
+        continue
+      items = np.load(os.path.join(self.directory, chunk['itemsFile']), mmap_mode='r')
+      timestampParts.append(np.array(timestamps[first:last]))
+      itemParts.append(np.array(items[first:last]))
+    if not timestampParts:
+      return np.zeros(0), np.zeros([0] + stream['itemShape'], dtype=np.dtype(stream['dtype']))
+    return np.concatenate(timestampParts), np.concatenate(itemParts)
+
+  def itemAtTime(self, name, timestamp):
+    """
+    :return: timestamp and item of the stream recorded closest to timestamp
+    """
+    previous = None
+    following = None
+    for chunk in self._streams[name]['chunks']:
+      if chunk['count'] == 0:
+        continue
+      if chunk['count'] is not None and chunk['lastTimestamp'] < timestamp:
+        previous = (chunk['lastTimestamp'], chunk, chunk['count'] - 1)
+        continue
+      timestamps = self._chunkTimestamps(chunk)
+      index = int(np.searchsorted(timestamps, timestamp))
+      if index > 0:
+        previous = (float(timestamps[index - 1]), chunk, index - 1)
+      if index < timestamps.size:
+        following = (float(timestamps[index]), chunk, index)
+        break
+
+    candidates = [candidate for candidate in (previous, following) if candidate is not None]
+    if not candidates:
+      raise ValueError("Stream {0} is empty".format(name))
+    itemTimestamp, chunk, index = min(candidates, key=lambda candidate: abs(candidate[0] - timestamp))
+    items = np.load(os.path.join(self.directory, chunk['itemsFile']), mmap_mode='r')
+    return itemTimestamp, np.array(items[index])
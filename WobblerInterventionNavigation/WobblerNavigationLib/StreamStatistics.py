@@ -0,0 +1,117 @@
+import collections
+
+import numpy as np
+
+#
+# Arrival time statistics of tracking and imaging streams
+#
+
+StreamSummary = collections.namedtuple('StreamSummary', [
+  'numberOfSamples',  # samples in the window the statistics are computed from
+  'updateRateHz',
+  'meanIntervalSec',  # mean time between arrivals
+  'jitterSec',  # standard deviation of the time between arrivals
+  'latencyMeanSec',  # arrival time minus device timestamp, NaN if the stream has no device timestamps
+  'latency95thPercentileSec',
+  'latencyMaximumSec',
+  'ageSec',  # time since the last arrival
+  ])
+
+LATENCY = 'latency'
+INTERVAL = 'interval'
+
+
+class _StreamSamples(object):
+  # Ring buffer of the arrival and device times of the last samples of one stream
+
+  def __init__(self, windowSize):
+    self.arrivalTimes = np.zeros(windowSize)
+    self.deviceTimes = np.full(windowSize, np.nan)
+    self.numberOfSamples = 0
+    self.nextIndex = 0
+
+  def add(self, arrivalTime, deviceTime):
+    self.arrivalTimes[self.nextIndex] = arrivalTime
+    self.deviceTimes[self.nextIndex] = np.nan if deviceTime is None else deviceTime
+    self.nextIndex = (self.nextIndex + 1) % self.arrivalTimes.size
+    self.numberOfSamples = min(self.numberOfSamples + 1, self.arrivalTimes.size)
+
+  def ordered(self):
+    indices = (self.nextIndex - self.numberOfSamples + np.arange(self.numberOfSamples)) % self.arrivalTimes.size
+    return self.arrivalTimes[indices], self.deviceTimes[indices]
+
+
+class StreamStatistics(object):
+  """
+  Rolling update rate, jitter and latency of named streams, e.g. the transforms and images
+  received from PLUS.
+
+  Every sample is the time it arrived, and the timestamp the device assigned to it where
+  available. The last windowSize samples of each stream are kept in preallocated arrays, so
+  adding a sample is constant time and memory does not grow during long sessions.
+  """
+
+  def __init__(self, windowSize=256):
+    if windowSize < 2:
+      raise ValueError("Stream statistics need a window of at least two samples")
+    self.windowSize = int(windowSize)
+    self._streams = {}
+
+  def reset(self):
+    self._streams = {}
+
+  def streamNames(self):
+    return sorted(self._streams)
+
+  def addSample(self, streamName, arrivalTime, deviceTime=None):
+    """
+    :param arrivalTime: time the sample was received in seconds
+    :param deviceTime: time the device acquired the sample in seconds on the same clock, None if not known
+    """
+    samples = self._streams.get(streamName)
+    if samples is None:
+      samples = _StreamSamples(self.windowSize)
+      self._streams[streamName] = samples
+    samples.add(arrivalTime, deviceTime)
+
+  def _values(self, streamName, quantity):
+    arrivalTimes, deviceTimes = self._streams[streamName].ordered()
+    if quantity == INTERVAL:
+      return np.diff(arrivalTimes)
+    if quantity == LATENCY:
+      latencies = arrivalTimes - deviceTimes
+      return latencies[~np.isnan(latencies)]
+    raise ValueError("Unknown stream quantity: {0}".format(quantity))
+
+  def summary(self, streamName, now):
+    """
+    :param now: current time on the arrival clock
+    :return: StreamSummary of the samples in the window
+    """
+    arrivalTimes, _ = self._streams[streamName].ordered()
+    intervals = self._values(streamName, INTERVAL)
+    latencies = self._values(streamName, LATENCY)
+    timeSpan = arrivalTimes[-1] - arrivalTimes[0]
+    return StreamSummary(
+      numberOfSamples=int(arrivalTimes.size),
+      updateRateHz=float(intervals.size / timeSpan) if timeSpan > 0 else 0.0,
+      meanIntervalSec=float(intervals.mean()) if intervals.size else np.nan,
+      jitterSec=float(intervals.std()) if intervals.size else np.nan,
+      latencyMeanSec=float(latencies.mean()) if latencies.size else np.nan,
+      latency95thPercentileSec=float(np.percentile(latencies, 95)) if latencies.size else np.nan,
+      latencyMaximumSec=float(latencies.max()) if latencies.size else np.nan,
+      ageSec=float(now - arrivalTimes[-1]))
+
+  def summaries(self, now):
+    """
+    :return: dict of stream name to StreamSummary
+    """
+    return {streamName: self.summary(streamName, now) for streamName in self._streams}
+
+  def histogram(self, streamName, quantity, binEdges):
+    """
+    :param quantity: LATENCY or INTERVAL
+    :param binEdges: increasing bin edges in seconds
+    :return: number of samples in each bin
+    """
+    return np.histogram(self._values(streamName, quantity), bins=binEdges)[0]
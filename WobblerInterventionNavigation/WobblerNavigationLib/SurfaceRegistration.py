@@ -0,0 +1,122 @@
+import collections
+import re
+
+import numpy as np
+
+from .Registration import RIGID, landmarkRegistration
+from .Transforms import transformPoints
+
+#
+# Surface based registration
+#
+
+IterativeClosestPointResult = collections.namedtuple('IterativeClosestPointResult', [
+  'matrix',  # (4, 4) transform from the moving points to the surface
+  'rootMeanSquareError',  # distance of the inlier points to the surface in mm
+  'numberOfInliers',  # points used in the last iteration
+  'numberOfIterations',
+  'converged',  # False if maximumIterations was reached first
+  ])
+
+# The KD-tree queries use the workers and return_sorted arguments added in SciPy 1.6
+MINIMUM_SCIPY_VERSION = (1, 6)
+
+
+def requireSciPy():
+  """
+  SciPy is not bundled with Slicer, it is only imported here so the other modules only need NumPy.
+  :return: the SciPy KD-tree class
+  :raise ImportError: with installation instructions if SciPy is missing or too old
+  """
+  requirement = "Surface registration needs SciPy {0}.{1} or later. In Slicer, install it from the Python console with " \
+                "slicer.util.pip_install('scipy>={0}.{1}')".format(*MINIMUM_SCIPY_VERSION)
+  try:
+    import scipy
+    from scipy.spatial import cKDTree
+  except ImportError:
+    raise ImportError(requirement)
+  version = tuple(int(part) for part in re.findall(r'\d+', scipy.__version__)[:2])
+  if version < MINIMUM_SCIPY_VERSION:
+    raise ImportError("{0}, found SciPy {1}".format(requirement, scipy.__version__))
+  return cKDTree
+
+
+class ClosestPointIndex(object):
+  """
+  KD-tree of the points of a surface, e.g. the vertices of a liver model segmented from CT.
+
+  The tree is built once, so the closest point queries of every ICP iteration and of repeated
+  registrations during the procedure are logarithmic in the number of surface points.
+  """
+
+  def __init__(self, surfacePoints, leafSize=16):
+    """
+    :param surfacePoints: (M, 3) array
+    """
+    cKDTree = requireSciPy()
+    self.points = np.ascontiguousarray(surfacePoints, dtype=np.float64)
+    if self.points.ndim != 2 or self.points.shape[1] != 3 or self.points.shape[0] == 0:
+      raise ValueError("Surface points must be a non-empty (M, 3) array")
+    self._tree = cKDTree(self.points, leafsize=leafSize, balanced_tree=False)
+
+  def closestPoints(self, points):
+    """
+    :param points: (N, 3) array
+    :return: (N,) distances and (N,) indices of the closest surface points
+    """
+    return self._tree.query(np.asarray(points, dtype=np.float64), k=1, workers=-1)
+
+  def pointsWithinDistance(self, points, distanceMm):
+    """
+    :param points: (N, 3) array
+    :return: sorted indices of the surface points closer than distanceMm to any of the points
+    """
+    neighbors = self._tree.query_ball_point(np.asarray(points, dtype=np.float64), distanceMm, workers=-1,
+                                            return_sorted=False)
+    return np.unique(np.concatenate([np.asarray(indices, dtype=np.intp) for indices in neighbors]))
+
+
+def iterativeClosestPoint(movingPoints, closestPointIndex, initialMatrix=None, mode=RIGID, inlierFraction=0.9,
+                          maximumIterations=100, toleranceMm=1e-3):
+  """
+  Register points sampled on a surface, e.g. with a tracked stylus or from ultrasound, to the
+  surface. Every iteration pairs all points with their closest surface points in one query,
+  drops the pairs farthest apart and solves the registration of the rest in closed form.
+  :param movingPoints: (N, 3) array of sampled points
+  :param closestPointIndex: ClosestPointIndex of the surface
+  :param initialMatrix: (4, 4) initial transform from the moving points to the surface, e.g. from
+    a fiducial registration, identity if None. ICP only finds the nearest local optimum.
+  :param mode: Registration.RIGID or SIMILARITY
+  :param inlierFraction: fraction of the pairs closest to the surface used in each iteration,
+    so points sampled off the segmented surface do not pull the registration
+  :param toleranceMm: stop when no point moves more than this in an iteration
+  :return: IterativeClosestPointResult
+  """
+  movingPoints = np.asarray(movingPoints, dtype=np.float64)
+  if not 0.0 < inlierFraction <= 1.0:
+    raise ValueError("Inlier fraction must be in (0, 1]")
+  numberOfInliers = max(int(round(inlierFraction * movingPoints.shape[0])), 3)
+  if movingPoints.shape[0] < numberOfInliers:
+    raise ValueError("At least 3 inlier points are needed for surface registration")
+  matrix = np.eye(4) if initialMatrix is None else np.array(initialMatrix, dtype=np.float64)
+
+  transformedPoints = transformPoints(matrix, movingPoints)
+  converged = False
+  iteration = 0
+  while iteration < maximumIterations and not converged:
+    iteration += 1
+    distances, surfaceIndices = closestPointIndex.closestPoints(transformedPoints)
+    inliers = np.argpartition(distances, numberOfInliers - 1)[:numberOfInliers]
+    matrix, _ = landmarkRegistration(movingPoints[inliers], closestPointIndex.points[surfaceIndices[inliers]], mode)
+    previousPoints = transformedPoints
+    transformedPoints = transformPoints(matrix, movingPoints)
+    converged = np.max(np.abs(transformedPoints - previousPoints)) < toleranceMm
+
+  distances, _ = closestPointIndex.closestPoints(transformedPoints)
+  inlierDistances = np.partition(distances, numberOfInliers - 1)[:numberOfInliers]
+  return IterativeClosestPointResult(
+    matrix=matrix,
+    rootMeanSquareError=float(np.sqrt(np.mean(inlierDistances ** 2))),
+    numberOfInliers=numberOfInliers,
+    numberOfIterations=iteration,
+    converged=bool(converged))
@@ -0,0 +1,105 @@
+import numpy as np
+
+#
+# Time offset between the tracker and the ultrasound image stream
+#
+
+
+def positionSignal(poseMatrices):
+  """
+  Position of a tool along its main direction of motion, e.g. the probe moved up and down.
+  :param poseMatrices: (N, 4, 4) tracked poses
+  :return: (N,) positions in mm
+  """
+  translations = np.asarray(poseMatrices, dtype=np.float64)[:, :3, 3]
+  translations = translations - translations.mean(axis=0)
+  # First principal direction of the translations
+  _, _, directions = np.linalg.svd(translations, full_matrices=False)
+  return np.dot(translations, directions[0])
+
+
+def imageFeatureSignal(frames):
+  """
+  Intensity weighted mean row of each frame, e.g. the depth of the bottom of a water tank that the
+  probe is moved towards and away from.
+  :param frames: (N, rows, columns) images
+  :return: (N,) rows
+  """
+  rowIntensities = np.asarray(frames).sum(axis=2, dtype=np.float64)
+  totals = rowIntensities.sum(axis=1)
+  return np.dot(rowIntensities, np.arange(rowIntensities.shape[1])) / np.where(totals > 0, totals, 1.0)
+
+
+def _normalized(signal):
+  signal = signal - signal.mean()
+  deviation = signal.std()
+  return signal / deviation if deviation > 0 else signal
+
+
+def _sliceSums(signal, starts, stops):
+  # Sums and sums of squares of signal[start:stop] for many slices at once
+  prefixSums = np.concatenate([[0.0], np.cumsum(signal)])
+  prefixSquareSums = np.concatenate([[0.0], np.cumsum(signal * signal)])
+  return prefixSums[stops] - prefixSums[starts], prefixSquareSums[stops] - prefixSquareSums[starts]
+
+
+def estimateTimeOffset(trackerTimestamps, trackerSignal, imageTimestamps, imageSignal, maximumOffsetSec=0.5,
+                       sampleRateHz=None):
+  """
+  Find the time offset between two recordings of the same motion by FFT cross-correlation.
+
+  Both signals are resampled at sampleRateHz over the time range they have in common and
+  normalized. The offset is the lag of the strongest correlation, positive or negative, since an
+  image feature may move opposite to the probe, refined to a fraction of a sample by fitting a
+  parabola to the peak. The motion must not be periodic with a period shorter than twice
+  maximumOffsetSec, otherwise whole periods can not be told apart.
+  :param trackerTimestamps: (N,) increasing times in seconds
+  :param imageTimestamps: (M,) increasing times in seconds
+  :param maximumOffsetSec: largest offset searched for, in both directions
+  :param sampleRateHz: resampling rate, by default the rate of the faster stream
+  :return: offset in seconds, the image recorded at time t shows the tracker state at time t + offset,
+    and the correlation coefficient at the offset, close to 1 for a reliable estimate
+  """
+  trackerTimestamps = np.asarray(trackerTimestamps, dtype=np.float64)
+  imageTimestamps = np.asarray(imageTimestamps, dtype=np.float64)
+  if trackerTimestamps.size < 4 or imageTimestamps.size < 4:
+    raise ValueError("Temporal calibration needs at least four samples of each stream")
+  if sampleRateHz is None:
+    sampleRateHz = 1.0 / min(np.median(np.diff(trackerTimestamps)), np.median(np.diff(imageTimestamps)))
+  startTime = max(trackerTimestamps[0], imageTimestamps[0])
+  stopTime = min(trackerTimestamps[-1], imageTimestamps[-1])
+  numberOfSamples = int((stopTime - startTime) * sampleRateHz) + 1
+  if numberOfSamples < 4:
+    raise ValueError("The tracker and image recordings do not overlap in time")
+
+  sampleTimes = startTime + np.arange(numberOfSamples) / sampleRateHz
+  tracker = _normalized(np.interp(sampleTimes, trackerTimestamps, trackerSignal))
+  image = _normalized(np.interp(sampleTimes, imageTimestamps, imageSignal))
+
+  # Zero padding to twice the length, so the circular correlation does not wrap around
+  fftSize = 2 ** int(np.ceil(np.log2(2 * numberOfSamples)))
+  productSums = np.fft.irfft(np.conj(np.fft.rfft(image, fftSize)) * np.fft.rfft(tracker, fftSize), fftSize)
+  maximumLag = min(int(round(maximumOffsetSec * sampleRateHz)), numberOfSamples // 2)
+  lags = np.arange(-maximumLag, maximumLag + 1)
+  productSums = productSums[lags % fftSize]
+
+  # Pearson correlation of the overlapping parts at each lag, from prefix sums. Normalizing over
+  # the whole recording instead would pull the peak towards the lag with the most signal energy.
+  imageSlices = (np.maximum(-lags, 0), numberOfSamples - np.maximum(lags, 0))
+  trackerSlices = (np.maximum(lags, 0), numberOfSamples + np.minimum(lags, 0))
+  overlaps = numberOfSamples - np.abs(lags)
+
+  imageSums, imageSquareSums = _sliceSums(image, *imageSlices)
+  trackerSums, trackerSquareSums = _sliceSums(tracker, *trackerSlices)
+  covariances = productSums - imageSums * trackerSums / overlaps
+  variances = (imageSquareSums - imageSums ** 2 / overlaps) * (trackerSquareSums - trackerSums ** 2 / overlaps)
+  correlations = covariances / np.sqrt(np.maximum(variances, 1e-12))
+
+  peak = int(np.argmax(np.abs(correlations)))
+  lag = float(lags[peak])
+  if 0 < peak < lags.size - 1:
+    before, at, after = np.abs(correlations[peak - 1:peak + 2])
+    curvature = before - 2.0 * at + after
+    if curvature < 0:
+      lag += 0.5 * (before - after) / curvature
+  return float(lag / sampleRateHz), float(abs(correlations[peak]))
@@ -0,0 +1,246 @@
+import numpy as np
+
+from .Transforms import quaternionsFromMatrices
+
+#
+# Tracked tool calibration
+#
+
+
+class IncrementalPivotCalibration(object):
+  """
+  Streaming least squares pivot calibration.
+
+  Every ToolToReference pose (R, p) of a tool pivoting about a fixed point gives the equation
+  R * toolTip + p = pivotPoint. Instead of storing the poses, the 6x6 normal equations of these
+  equations are accumulated, so adding a pose and re-solving costs the same no matter how many
+  poses were recorded.
+  """
+
+  def __init__(self, minimumNumberOfPoses=50, convergenceToleranceMm=0.05, convergenceWindow=25, minimumConditioning=0.01):
+    """
+    :param minimumNumberOfPoses: poses needed before the calibration can be considered converged
+    :param convergenceToleranceMm: maximum tip displacement over the last convergenceWindow poses
+    :param convergenceWindow: number of poses between two convergence checks
+    :param minimumConditioning: smallest eigenvalue of the per-pose normal matrix, grows with the
+      amount of pivoting. Below this value the tip position is not reliably observable.
+    """
+    self.minimumNumberOfPoses = minimumNumberOfPoses
+    self.convergenceToleranceMm = convergenceToleranceMm
+    self.convergenceWindow = convergenceWindow
+    self.minimumConditioning = minimumConditioning
+    self.reset()
+
+  def reset(self):
+    self.numberOfPoses = 0
+    self._sumRotations = np.zeros((3, 3))
+    self._sumRotatedTranslations = np.zeros(3)  # sum of R^T p
+    self._sumTranslations = np.zeros(3)
+    self._sumSquaredTranslations = 0.0
+    self.toolTipPosition = None  # tool tip in the tool coordinate system
+    self.pivotPosition = None  # pivot point in the reference coordinate system
+    self.rootMeanSquareError = float('inf')
+    self.conditioning = 0.0
+    self._normalMatrix = None
+    self.converged = False
+    self._lastCheckedToolTipPosition = None
+    self._posesSinceLastCheck = 0
+
+  def addPose(self, toolToReferenceMatrix):
+    """
+    Add one ToolToReference pose and update the estimate.
+    :param toolToReferenceMatrix: (4, 4) array
+    :return: True if the estimate has converged
+    """
+    return self.addPoses(np.asarray(toolToReferenceMatrix, dtype=np.float64)[np.newaxis])
+
+  def addPoses(self, toolToReferenceMatrices):
+    """
+    Add a batch of ToolToReference poses and update the estimate.
+    :param toolToReferenceMatrices: (K, 4, 4) array
+    :return: True if the estimate has converged
+    """
+    toolToReferenceMatrices = np.asarray(toolToReferenceMatrices, dtype=np.float64)
+    rotations = toolToReferenceMatrices[:, :3, :3]
+    translations = toolToReferenceMatrices[:, :3, 3]
+
+    self.numberOfPoses += toolToReferenceMatrices.shape[0]
+    self._sumRotations += rotations.sum(axis=0)
+    self._sumRotatedTranslations += np.einsum('kji,kj->i', rotations, translations)
+    self._sumTranslations += translations.sum(axis=0)
+    self._sumSquaredTranslations += np.einsum('ki,ki->', translations, translations)
+    self._posesSinceLastCheck += toolToReferenceMatrices.shape[0]
+
+    self._solve()
+    return self.converged
+
+  def _solve(self):
+    # Unknowns x = [toolTip, pivot], per pose equation [R, -I] x = -p
+    n = float(self.numberOfPoses)
+    normalMatrix = np.empty((6, 6))
+    normalMatrix[:3, :3] = n * np.eye(3)
+    normalMatrix[:3, 3:] = -self._sumRotations.T
+    normalMatrix[3:, :3] = -self._sumRotations
+    normalMatrix[3:, 3:] = n * np.eye(3)
+    normalVector = np.concatenate([-self._sumRotatedTranslations, self._sumTranslations])
+
+    self._normalMatrix = normalMatrix
+    try:
+      solution = np.linalg.solve(normalMatrix, normalVector)
+    except np.linalg.LinAlgError:
+      return
+    self.toolTipPosition = solution[:3]
+    self.pivotPosition = solution[3:]
+
+    residualSumOfSquares = (np.dot(solution, np.dot(normalMatrix, solution)) - 2.0 * np.dot(solution, normalVector)
+                            + self._sumSquaredTranslations)
+    self.rootMeanSquareError = float(np.sqrt(max(residualSumOfSquares, 0.0) / n))
+
+    if self._posesSinceLastCheck < self.convergenceWindow:
+      return
+    self._posesSinceLastCheck = 0
+    self._updateConditioning()
+    if self._lastCheckedToolTipPosition is not None:
+      displacement = np.linalg.norm(self.toolTipPosition - self._lastCheckedToolTipPosition)
+      self.converged = (self.numberOfPoses >= self.minimumNumberOfPoses
+                        and self.conditioning >= self.minimumConditioning
+                        and displacement <= self.convergenceToleranceMm)
+    self._lastCheckedToolTipPosition = self.toolTipPosition.copy()
+
+  def _updateConditioning(self):
+    self.conditioning = float(np.linalg.eigvalsh(self._normalMatrix / self.numberOfPoses)[0])
+
+  def isWellConditioned(self):
+    """
+    True if the recorded poses contain enough pivoting to determine the tool tip.
+    """
+    if self.numberOfPoses == 0:
+      return False
+    self._updateConditioning()
+    return self.conditioning >= self.minimumConditioning
+
+  def toolTipToToolMatrix(self, orientation=None):
+    """
+    :param orientation: optional (3, 3) rotation of the tool tip coordinate system, e.g. from a previous spin calibration
+    :return: (4, 4) ToolTipToTool matrix
+    """
+    toolTipToToolMatrix = np.eye(4)
+    if orientation is not None:
+      toolTipToToolMatrix[:3, :3] = orientation
+    toolTipToToolMatrix[:3, 3] = self.toolTipPosition
+    return toolTipToToolMatrix
+
+
+class IncrementalSpinCalibration(object):
+  """
+  Streaming estimate of the shaft direction of a tool spun around its own axis.
+
+  When the tool spins around its shaft, the shaft direction s (in tool coordinates) is mapped
+  by every ToolToReference rotation R onto the same reference direction a. The pair (a, s) that
+  maximizes sum(a . R s) is the leading singular vector pair of the sum of the rotations, so only
+  a 3x3 sum, a reference orientation and a fixed size histogram of the covered spin angles are kept.
+  """
+
+  NUMBER_OF_COVERAGE_BINS = 36
+
+  def __init__(self, minimumNumberOfPoses=50, minimumCoverageDeg=180.0, targetErrorDeg=1.0):
+    """
+    :param minimumNumberOfPoses: poses needed before the calibration can be considered converged
+    :param minimumCoverageDeg: spin angle range around the shaft that has to be covered
+    :param targetErrorDeg: RMS deviation of the shaft direction needed for convergence
+    """
+    self.minimumNumberOfPoses = minimumNumberOfPoses
+    self.minimumCoverageDeg = minimumCoverageDeg
+    self.targetErrorDeg = targetErrorDeg
+    self.reset()
+
+  def reset(self):
+    self.numberOfPoses = 0
+    self._sumRotations = np.zeros((3, 3))
+    self._firstRotationInverse = None
+    self._coveredBins = np.zeros(self.NUMBER_OF_COVERAGE_BINS, dtype=bool)
+    self.shaftDirection = None  # unit shaft direction in the tool coordinate system
+    self.referenceShaftDirection = None  # unit shaft direction in the reference coordinate system
+    self.rootMeanSquareErrorDeg = float('inf')
+    self.coverageDeg = 0.0
+    self.converged = False
+
+  def addPose(self, toolToReferenceMatrix):
+    """
+    Add one ToolToReference pose and update the estimate.
+    :param toolToReferenceMatrix: (4, 4) array
+    :return: True if the estimate has converged
+    """
+    return self.addPoses(np.asarray(toolToReferenceMatrix, dtype=np.float64)[np.newaxis])
+
+  def addPoses(self, toolToReferenceMatrices):
+    """
+    Add a batch of ToolToReference poses and update the estimate.
+    :param toolToReferenceMatrices: (K, 4, 4) array
+    :return: True if the estimate has converged
+    """
+    rotations = np.asarray(toolToReferenceMatrices, dtype=np.float64)[:, :3, :3]
+    if self._firstRotationInverse is None:
+      self._firstRotationInverse = rotations[0].T
+
+    self.numberOfPoses += rotations.shape[0]
+    self._sumRotations += rotations.sum(axis=0)
+
+    U, singularValues, Vt = np.linalg.svd(self._sumRotations)
+    shaftDirection = Vt[0]
+    referenceShaftDirection = U[:, 0]
+    if self.shaftDirection is not None and np.dot(shaftDirection, self.shaftDirection) < 0:
+      # Keep the sign of the axis stable between updates
+      shaftDirection = -shaftDirection
+      referenceShaftDirection = -referenceShaftDirection
+    self.shaftDirection = shaftDirection
+    self.referenceShaftDirection = referenceShaftDirection
+
+    # sum |R s - a|^2 = 2 n - 2 a . (sum R) s, the chord length per pose is converted to an angle
+    meanSquaredChord = max(2.0 - 2.0 * singularValues[0] / self.numberOfPoses, 0.0)
+    self.rootMeanSquareErrorDeg = float(np.degrees(2.0 * np.arcsin(min(np.sqrt(meanSquaredChord) / 2.0, 1.0))))
+
+    # Signed spin angle of each pose relative to the first pose, around the current shaft estimate
+    relativeQuaternions = quaternionsFromMatrices(np.matmul(self._firstRotationInverse, rotations))
+    # q and -q are the same rotation, a non-negative w keeps the angles within [-180, 180] degrees
+    relativeQuaternions[relativeQuaternions[:, 0] < 0] *= -1.0
+    spinAngles = 2.0 * np.arctan2(np.dot(relativeQuaternions[:, 1:], shaftDirection), relativeQuaternions[:, 0])
+    bins = np.floor((spinAngles + np.pi) / (2.0 * np.pi) * self.NUMBER_OF_COVERAGE_BINS).astype(int)
+    self._coveredBins[np.clip(bins, 0, self.NUMBER_OF_COVERAGE_BINS - 1)] = True
+    self.coverageDeg = 360.0 * np.count_nonzero(self._coveredBins) / self.NUMBER_OF_COVERAGE_BINS
+
+    self.converged = (self.numberOfPoses >= self.minimumNumberOfPoses
+                      and self.coverageDeg >= self.minimumCoverageDeg
+                      and self.rootMeanSquareErrorDeg <= self.targetErrorDeg)
+    return self.converged
+
+  def toolTipOrientation(self, currentOrientation=None, toolTipPosition=None):
+    """
+    Rotation of the tool tip coordinate system whose Z axis is aligned with the shaft.
+    The smallest rotation that aligns the Z axis of currentOrientation with the shaft is used,
+    so the rest of the current orientation is preserved.
+    :param currentOrientation: (3, 3) current ToolTipToTool rotation, identity if not given
+    :param toolTipPosition: tool tip in tool coordinates. If given, Z points from the tip towards the tool origin.
+    :return: (3, 3) ToolTipToTool rotation
+    """
+    if currentOrientation is None:
+      currentOrientation = np.eye(3)
+    shaftDirection = self.shaftDirection
+    if toolTipPosition is not None and np.dot(shaftDirection, toolTipPosition) > 0:
+      shaftDirection = -shaftDirection
+
+    currentAxis = currentOrientation[:, 2]
+    rotationAxis = np.cross(currentAxis, shaftDirection)
+    sinAngle = np.linalg.norm(rotationAxis)
+    cosAngle = np.dot(currentAxis, shaftDirection)
+    if sinAngle < 1e-12:
+      if cosAngle > 0:
+        return currentOrientation.copy()
+      # Opposite directions, turn 180 degrees around the X axis of the current orientation
+      return np.dot(currentOrientation, np.diag([1.0, -1.0, -1.0]))
+    rotationAxis /= sinAngle
+    crossProductMatrix = np.array([[0.0, -rotationAxis[2], rotationAxis[1]],
+                                   [rotationAxis[2], 0.0, -rotationAxis[0]],
+                                   [-rotationAxis[1], rotationAxis[0], 0.0]])
+    alignment = np.eye(3) + sinAngle * crossProductMatrix + (1.0 - cosAngle) * np.dot(crossProductMatrix, crossProductMatrix)
+    return np.dot(alignment, currentOrientation)
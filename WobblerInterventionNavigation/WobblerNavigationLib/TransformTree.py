@@ -0,0 +1,172 @@
+import numpy as np
+
+from .Transforms import transformPoints
+
+#
+# Cached transform hierarchy
+#
+
+
+class TransformTree(object):
+  """
+  Mirror of a transform hierarchy that caches composed matrices.
+
+  Every transform stores its matrix to its parent. The matrix to world of each transform and the
+  matrices between pairs of transforms are composed on first use and cached. Changing a transform
+  only invalidates the cached world matrices of the transform and its descendants, so repeated
+  queries between tracker updates are dictionary lookups.
+
+  Returned matrices are read-only views of the cache, copy them before modifying.
+  """
+
+  def __init__(self):
+    self._parents = {}
+    self._children = {}
+    self._matricesToParent = {}
+    self._matricesToWorld = {}
+    self._matricesFromWorld = {}
+    self._worldVersions = {}
+    self._matricesBetweenTransforms = {}
+
+  def __contains__(self, name):
+    return name in self._parents
+
+  def addTransform(self, name, parentName=None, matrixToParent=None):
+    """
+    :param name: unique key of the transform, e.g. the MRML node ID
+    :param parentName: key of the parent transform, None if the parent is the world
+    :param matrixToParent: (4, 4) array, identity if not given
+    """
+    if name in self._parents:
+      raise ValueError("Transform {0} is already in the tree".format(name))
+    self._parents[name] = None
+    self._children[name] = []
+    self._matricesToParent[name] = np.eye(4)
+    self._worldVersions[name] = 0
+    self.setParent(name, parentName)
+    if matrixToParent is not None:
+      self.setMatrixToParent(name, matrixToParent)
+
+  def removeTransform(self, name):
+    for childName in list(self._children[name]):
+      self.setParent(childName, None)
+    self.setParent(name, None)
+    for cache in (self._parents, self._children, self._matricesToParent, self._matricesToWorld,
+                  self._matricesFromWorld, self._worldVersions):
+      cache.pop(name, None)
+    for key in [key for key in self._matricesBetweenTransforms if name in key]:
+      del self._matricesBetweenTransforms[key]
+
+  def parent(self, name):
+    return self._parents[name]
+
+  def setParent(self, name, parentName):
+    if parentName is not None:
+      if parentName not in self._parents:
+        raise ValueError("Parent transform {0} is not in the tree".format(parentName))
+      ancestorName = parentName
+      while ancestorName is not None:
+        if ancestorName == name:
+          raise ValueError("Setting {0} as parent of {1} would create a cycle".format(parentName, name))
+        ancestorName = self._parents[ancestorName]
+
+    oldParentName = self._parents[name]
+    if oldParentName == parentName:
+      return
+    if oldParentName is not None:
+      self._children[oldParentName].remove(name)
+    if parentName is not None:
+      self._children[parentName].append(name)
+    self._parents[name] = parentName
+    self.invalidate(name)
+
+  def setMatrixToParent(self, name, matrixToParent):
+    """
+    Update the matrix of a transform. The cache is only invalidated if the matrix has changed.
+    :return: True if the matrix has changed
+    """
+    matrixToParent = np.array(matrixToParent, dtype=np.float64)
+    if np.array_equal(matrixToParent, self._matricesToParent[name]):
+      return False
+    self._matricesToParent[name] = matrixToParent
+    self.invalidate(name)
+    return True
+
+  def invalidate(self, name):
+    """
+    Drop the cached world matrices of a transform and all its descendants.
+    """
+    transformsToVisit = [name]
+    while transformsToVisit:
+      currentName = transformsToVisit.pop()
+      if currentName not in self._matricesToWorld:
+        # A descendant can only be cached if all its ancestors are, so this subtree is already invalid
+        continue
+      del self._matricesToWorld[currentName]
+      self._matricesFromWorld.pop(currentName, None)
+      self._worldVersions[currentName] += 1
+      transformsToVisit.extend(self._children[currentName])
+
+  def matrixToWorld(self, name):
+    """
+    :return: (4, 4) matrix from the coordinate system of the transform to world
+    """
+    matrixToWorld = self._matricesToWorld.get(name)
+    if matrixToWorld is not None:
+      return matrixToWorld
+
+    parentName = self._parents[name]
+    if parentName is None:
+      matrixToWorld = self._matricesToParent[name].copy()
+    else:
+      matrixToWorld = np.dot(self.matrixToWorld(parentName), self._matricesToParent[name])
+    matrixToWorld.flags.writeable = False
+    self._matricesToWorld[name] = matrixToWorld
+    return matrixToWorld
+
+  def matrixFromWorld(self, name):
+    """
+    :return: (4, 4) matrix from world to the coordinate system of the transform
+    """
+    matrixFromWorld = self._matricesFromWorld.get(name)
+    if matrixFromWorld is not None:
+      return matrixFromWorld
+
+    matrixFromWorld = np.linalg.inv(self.matrixToWorld(name))
+    matrixFromWorld.flags.writeable = False
+    self._matricesFromWorld[name] = matrixFromWorld
+    return matrixFromWorld
+
+  def matrixToTransform(self, fromName, toName):
+    """
+    :return: (4, 4) matrix from the coordinate system of fromName to the coordinate system of toName
+    """
+    key = (fromName, toName)
+    fromVersion = self._worldVersions[fromName]
+    toVersion = self._worldVersions[toName]
+    cachedEntry = self._matricesBetweenTransforms.get(key)
+    if cachedEntry is not None and cachedEntry[1] == fromVersion and cachedEntry[2] == toVersion:
+      return cachedEntry[0]
+
+    fromToMatrix = np.dot(self.matrixFromWorld(toName), self.matrixToWorld(fromName))
+    fromToMatrix.flags.writeable = False
+    self._matricesBetweenTransforms[key] = (fromToMatrix, fromVersion, toVersion)
+    return fromToMatrix
+
+  def transformPointsToTransform(self, fromName, toName, points):
+    """
+    Map points between the coordinate systems of two transforms of the tree in one call.
+    :param fromName: transform whose coordinate system the points are given in, None for world
+    :param toName: transform whose coordinate system the points are mapped to, None for world
+    :param points: (N, 3) array
+    :return: (N, 3) array of mapped points and the (4, 4) matrix that was applied
+    """
+    if fromName is None and toName is None:
+      fromToMatrix = np.eye(4)
+    elif toName is None:
+      fromToMatrix = self.matrixToWorld(fromName)
+    elif fromName is None:
+      fromToMatrix = self.matrixFromWorld(toName)
+    else:
+      fromToMatrix = self.matrixToTransform(fromName, toName)
+    return transformPoints(fromToMatrix, points), fromToMatrix
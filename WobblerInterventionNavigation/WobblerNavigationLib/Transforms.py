@@ -0,0 +1,83 @@
+import numpy as np
+
+#
+# Homogeneous transform helpers
+#
+
+
+def transformPoints(transformMatrix, points):
+  """
+  Apply a 4x4 homogeneous transform to all points at once.
+  :param transformMatrix: (4, 4) array
+  :param points: (N, 3) array
+  :return: (N, 3) array of transformed points
+  """
+  transformMatrix = np.asarray(transformMatrix, dtype=np.float64)
+  points = np.asarray(points, dtype=np.float64)
+  return np.dot(points, transformMatrix[:3, :3].T) + transformMatrix[:3, 3]
+
+
+def quaternionsFromMatrices(matrices):
+  """
+  Convert rotation matrices to unit quaternions using Shepperd's method, which picks the
+  numerically best of the four conversion formulas for each matrix.
+  :param matrices: (..., 3, 3) or (..., 4, 4) array, only the upper left 3x3 block is used
+  :return: (..., 4) array of quaternions in (w, x, y, z) order
+  """
+  matrices = np.asarray(matrices, dtype=np.float64)[..., :3, :3]
+  m00, m01, m02 = matrices[..., 0, 0], matrices[..., 0, 1], matrices[..., 0, 2]
+  m10, m11, m12 = matrices[..., 1, 0], matrices[..., 1, 1], matrices[..., 1, 2]
+  m20, m21, m22 = matrices[..., 2, 0], matrices[..., 2, 1], matrices[..., 2, 2]
+  trace = m00 + m11 + m22
+
+  candidates = np.stack([
+    np.stack([1.0 + trace, m21 - m12, m02 - m20, m10 - m01], axis=-1),
+    np.stack([m21 - m12, 1.0 + 2.0 * m00 - trace, m01 + m10, m02 + m20], axis=-1),
+    np.stack([m02 - m20, m01 + m10, 1.0 + 2.0 * m11 - trace, m12 + m21], axis=-1),
+    np.stack([m10 - m01, m02 + m20, m12 + m21, 1.0 + 2.0 * m22 - trace], axis=-1),
+    ], axis=-2)
+  choice = np.argmax(np.stack([trace, m00, m11, m22], axis=-1), axis=-1)
+  quaternions = np.take_along_axis(candidates, choice[..., np.newaxis, np.newaxis], axis=-2)[..., 0, :]
+  return quaternions / np.linalg.norm(quaternions, axis=-1, keepdims=True)
+
+
+def matricesFromQuaternions(quaternions):
+  """
+  Convert unit quaternions to rotation matrices.
+  :param quaternions: (..., 4) array in (w, x, y, z) order
+  :return: (..., 3, 3) array
+  """
+  quaternions = np.asarray(quaternions, dtype=np.float64)
+  w, x, y, z = quaternions[..., 0], quaternions[..., 1], quaternions[..., 2], quaternions[..., 3]
+  return np.stack([
+    np.stack([1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y - w * z), 2.0 * (x * z + w * y)], axis=-1),
+    np.stack([2.0 * (x * y + w * z), 1.0 - 2.0 * (x * x + z * z), 2.0 * (y * z - w * x)], axis=-1),
+    np.stack([2.0 * (x * z - w * y), 2.0 * (y * z + w * x), 1.0 - 2.0 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+
+def slerp(startQuaternions, endQuaternions, fractions):
+  """
+  Spherical linear interpolation of many pairs of unit quaternions at once, along the shorter arc.
+  :param startQuaternions: (..., 4) array in (w, x, y, z) order
+  :param endQuaternions: (..., 4) array
+  :param fractions: (...) array, 0 gives the start and 1 the end quaternion
+  :return: (..., 4) array of unit quaternions
+  """
+  startQuaternions = np.asarray(startQuaternions, dtype=np.float64)
+  endQuaternions = np.asarray(endQuaternions, dtype=np.float64)
+  fractions = np.asarray(fractions, dtype=np.float64)[..., np.newaxis]
+  cosAngles = np.sum(startQuaternions * endQuaternions, axis=-1, keepdims=True)
+  # q and -q are the same rotation, interpolate towards the closer one
+  endQuaternions = np.where(cosAngles < 0.0, -endQuaternions, endQuaternions)
+  cosAngles = np.abs(cosAngles)
+
+  angles = np.arccos(np.clip(cosAngles, -1.0, 1.0))
+  sinAngles = np.sin(angles)
+  # Nearly equal rotations are interpolated linearly, the SLERP weights are 0/0 there
+  nearlyEqual = sinAngles < 1e-6
+  safeSinAngles = np.where(nearlyEqual, 1.0, sinAngles)
+  startWeights = np.where(nearlyEqual, 1.0 - fractions, np.sin((1.0 - fractions) * angles) / safeSinAngles)
+  endWeights = np.where(nearlyEqual, fractions, np.sin(fractions * angles) / safeSinAngles)
+  quaternions = startWeights * startQuaternions + endWeights * endQuaternions
+  return quaternions / np.linalg.norm(quaternions, axis=-1, keepdims=True)
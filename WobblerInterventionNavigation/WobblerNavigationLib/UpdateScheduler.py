@@ -0,0 +1,78 @@
+import collections
+
+#
+# Coalescing of high rate updates
+#
+
+
+class UpdateScheduler(object):
+  """
+  Coalesces update requests into at most one run per tick.
+
+  Work that depends on tracked poses, e.g. reslicing or distance readouts, is registered under a
+  key. Tracker updates only request the work, which is cheap, and runPendingUpdates, called from a
+  timer at the display rate, runs each requested callback once with the newest poses. However
+  many updates arrive between two ticks, the work is done at most maximumRateHz times per second.
+  """
+
+  def __init__(self, maximumRateHz=30.0):
+    self.maximumRateHz = maximumRateHz
+    self._callbacks = collections.OrderedDict()
+    self._pendingKeys = set()
+    self._updateRequested = False
+    self._lastRunTime = None
+    self.numberOfRequests = 0
+    self.numberOfRuns = 0
+
+  def register(self, key, callback):
+    """
+    :param callback: function without arguments, run once per tick while its key is requested
+    """
+    self._callbacks[key] = callback
+
+  def unregister(self, key):
+    self._callbacks.pop(key, None)
+    self._pendingKeys.discard(key)
+
+  def requestUpdate(self, key=None):
+    """
+    :param key: registered callback to run on the next tick, None for all of them
+    """
+    self.numberOfRequests += 1
+    self._updateRequested = True
+    if key is None:
+      self._pendingKeys.update(self._callbacks)
+    else:
+      self._pendingKeys.add(key)
+
+  def hasPendingUpdates(self):
+    return self._updateRequested
+
+  def runPendingUpdates(self, now):
+    """
+    Run the requested callbacks in registration order, unless the last run was less than one
+    period of maximumRateHz ago.
+    :return: True if the requested updates were run
+    """
+    if not self._updateRequested:
+      return False
+    # Timers fire slightly early at times, a tick that is a little short of the period is not skipped
+    if self._lastRunTime is not None and now - self._lastRunTime < 0.9 / self.maximumRateHz:
+      return False
+
+    # Callbacks may request new updates, those run on the next tick
+    pendingKeys = self._pendingKeys
+    self._pendingKeys = set()
+    self._updateRequested = False
+    for key, callback in list(self._callbacks.items()):
+      if key in pendingKeys:
+        callback()
+    self._lastRunTime = now
+    self.numberOfRuns += 1
+    return True
+
+  def coalescingRatio(self):
+    """
+    :return: average number of update requests served by one run
+    """
+    return self.numberOfRequests / float(max(self.numberOfRuns, 1))
@@ -0,0 +1,381 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+#
+# Tracked ultrasound volume reconstruction
+#
+
+
+def volumeGeometryAroundFrame(frameShape, pixelToWorldMatrix, spacingMm, marginMm):
+  """
+  Axis aligned reconstruction grid that contains a frame and a margin around it, e.g. the
+  out-of-plane extent of a wobbler sweep.
+  :param frameShape: (rows, columns) of the frames
+  :param pixelToWorldMatrix: (4, 4) matrix from (column, row, 0) pixel indices to world
+  :param spacingMm: isotropic voxel size
+  :param marginMm: distance added around the frame on all sides
+  :return: (slices, rows, columns) dimensions and the (4, 4) voxelToWorld matrix of the grid
+  """
+  rows, columns = frameShape
+  corners = np.array([[0, 0, 0], [columns - 1, 0, 0], [0, rows - 1, 0], [columns - 1, rows - 1, 0]], dtype=np.float64)
+  worldCorners = np.dot(corners, np.asarray(pixelToWorldMatrix)[:3, :3].T) + np.asarray(pixelToWorldMatrix)[:3, 3]
+  minimum = worldCorners.min(axis=0) - marginMm
+  maximum = worldCorners.max(axis=0) + marginMm
+  numberOfVoxels = np.ceil((maximum - minimum) / spacingMm).astype(int) + 1
+  voxelToWorldMatrix = np.diag([spacingMm, spacingMm, spacingMm, 1.0])
+  voxelToWorldMatrix[:3, 3] = minimum
+  return tuple(int(n) for n in numberOfVoxels[::-1]), voxelToWorldMatrix
+
+
+AVERAGE = 'average'
+MAXIMUM = 'maximum'
+
+COMPOUNDING_MODES = (AVERAGE, MAXIMUM)
+
+
+class VolumeReconstructor(object):
+  """
+  Compounds tracked 2D frames or scan converted sweeps into a preallocated voxel grid.
+
+  Every sample is scattered to its nearest voxel. Hit counts and either the sum or the maximum
+  of the intensities are accumulated in preallocated arrays, so a voxel hit by several samples
+  or sweeps holds their average or their maximum. The samples of a frame are grouped by voxel
+  with a single sort instead of a Python loop.
+
+  The grid is divided into bricks. Bricks that received samples are marked dirty, and
+  updateBricks recomputes the output only for those, so the cost of an update is proportional
+  to the size of the new frames or sweep and not to the size of the volume.
+  """
+
+  def __init__(self, dimensions, voxelToWorldMatrix, compoundingMode=AVERAGE, brickSize=16, fillHoles=True, holeFillingRadius=1):
+    """
+    :param dimensions: (slices, rows, columns) of the grid, the order of Slicer volume arrays
+    :param voxelToWorldMatrix: (4, 4) matrix from (column, row, slice) voxel indices to world, e.g. IJKToRAS
+    :param compoundingMode: AVERAGE or MAXIMUM of the samples that hit a voxel
+    :param brickSize: edge length of the bricks in voxels
+    :param fillHoles: voxels that no sample was scattered to get the average of the filled voxels
+      within holeFillingRadius, if there are any
+    :param holeFillingRadius: half edge length of the neighborhood in voxels, smaller than brickSize
+    """
+    if compoundingMode not in COMPOUNDING_MODES:
+      raise ValueError("Unknown compounding mode: {0}".format(compoundingMode))
+    if fillHoles and holeFillingRadius >= brickSize:
+      raise ValueError("Hole filling radius must be smaller than the brick size")
+    self.dimensions = tuple(int(n) for n in dimensions)
+    self.voxelToWorldMatrix = np.array(voxelToWorldMatrix, dtype=np.float64)
+    self.worldToVoxelMatrix = np.linalg.inv(self.voxelToWorldMatrix)
+    self.compoundingMode = compoundingMode
+    self.brickSize = int(brickSize)
+    self.fillHoles = fillHoles
+    self.holeFillingRadius = holeFillingRadius
+    # Sums of the samples in AVERAGE mode, maximums in MAXIMUM mode
+    self._accumulated = np.zeros(self.dimensions, dtype=np.float32)
+    self._counts = np.zeros(self.dimensions, dtype=np.uint32)
+    self._dirtyBricks = np.zeros([-(-n // self.brickSize) for n in self.dimensions], dtype=bool)
+    self._pixelIndexShape = None
+    self._pixelIndices = None
+    self.numberOfFrames = 0
+
+  def reset(self):
+    self._accumulated.fill(0)
+    self._counts.fill(0)
+    self._dirtyBricks.fill(True)
+    self.numberOfFrames = 0
+
+  def _homogeneousPixelIndices(self, frameShape):
+    # Pixel index grid is the same for all frames of a stream, compute it once
+    if self._pixelIndexShape != frameShape:
+      rows, columns = np.indices(frameShape)
+      self._pixelIndices = np.stack([columns.ravel(), rows.ravel(), np.zeros(rows.size), np.ones(rows.size)]).astype(np.float64)
+      self._pixelIndexShape = frameShape
+    return self._pixelIndices
+
+  def voxelIndicesOfPoints(self, homogeneousPoints, pointsToWorldMatrix):
+    """
+    :param homogeneousPoints: (4, N) array of points in the coordinate system of pointsToWorldMatrix
+    :return: flat index of the nearest voxel of each point inside the grid and the indices of those points
+    """
+    pointsToVoxelMatrix = np.dot(self.worldToVoxelMatrix, pointsToWorldMatrix)
+    voxelIndices = np.rint(np.dot(pointsToVoxelMatrix[:3], homogeneousPoints)).astype(np.intp)
+
+    slices, rows, columns = self.dimensions
+    inside = ((voxelIndices[0] >= 0) & (voxelIndices[0] < columns) & (voxelIndices[1] >= 0) & (voxelIndices[1] < rows)
+              & (voxelIndices[2] >= 0) & (voxelIndices[2] < slices))
+    flatVoxelIndices = (voxelIndices[2, inside] * rows + voxelIndices[1, inside]) * columns + voxelIndices[0, inside]
+    return flatVoxelIndices, np.flatnonzero(inside)
+
+  def addFrame(self, frame, pixelToWorldMatrix, mask=None):
+    """
+    Scatter one tracked frame into the grid.
+    :param frame: (rows, columns) image
+    :param pixelToWorldMatrix: (4, 4) matrix from (column, row, 0) pixel indices to world,
+      e.g. the image IJKToRAS composed with ImageToProbe and ProbeToReference
+    :param mask: optional (rows, columns) boolean array of the pixels to use, e.g. the ultrasound fan
+    :return: flat indices of the voxels that were updated
+    """
+    frame = np.asarray(frame)
+    pixelIndices = self._homogeneousPixelIndices(frame.shape)
+    pixelValues = frame.reshape(-1)
+    if mask is not None:
+      pixelNumbers = np.flatnonzero(mask)
+      pixelIndices = pixelIndices[:, pixelNumbers]
+      pixelValues = pixelValues[pixelNumbers]
+    flatVoxelIndices, insidePixels = self.voxelIndicesOfPoints(pixelIndices, pixelToWorldMatrix)
+    updatedVoxels = self.addSamples(flatVoxelIndices, pixelValues[insidePixels])
+    self.numberOfFrames += 1
+    return updatedVoxels
+
+  def addSweep(self, scanConversionTable, sweep, probeToWorldMatrix):
+    """
+    Scan convert a wobbler sweep and scatter the converted voxels into the grid.
+    :param scanConversionTable: ScanConversion.ScanConversionTable of the probe
+    :param sweep: (frames, lines, samples) raw sweep
+    :param probeToWorldMatrix: (4, 4) tracked pose of the probe during the sweep
+    :return: flat indices of the voxels that were updated
+    """
+    sweepVoxelIndices = np.unravel_index(scanConversionTable.voxelNumbers, scanConversionTable.dimensions)
+    homogeneousPoints = np.stack([sweepVoxelIndices[2], sweepVoxelIndices[1], sweepVoxelIndices[0],
+                                  np.ones(scanConversionTable.voxelNumbers.size, dtype=np.intp)]).astype(np.float64)
+    sweepToWorldMatrix = np.dot(probeToWorldMatrix, scanConversionTable.voxelToProbeMatrix)
+    flatVoxelIndices, insidePoints = self.voxelIndicesOfPoints(homogeneousPoints, sweepToWorldMatrix)
+    updatedVoxels = self.addSamples(flatVoxelIndices, scanConversionTable.convertedValues(sweep)[insidePoints])
+    self.numberOfFrames += len(scanConversionTable.geometry.motorAnglesDeg)
+    return updatedVoxels
+
+  def addSamples(self, flatVoxelIndices, values):
+    """
+    Accumulate intensity samples at flat voxel indices, several samples may hit the same voxel.
+    :return: flat indices of the voxels that were updated
+    """
+    if flatVoxelIndices.size == 0:
+      return flatVoxelIndices
+    order = np.argsort(flatVoxelIndices, kind='mergesort')
+    sortedVoxelIndices = flatVoxelIndices[order]
+    groupStarts = np.concatenate([[0], np.flatnonzero(np.diff(sortedVoxelIndices)) + 1])
+    updatedVoxels = sortedVoxelIndices[groupStarts]
+    sortedValues = np.asarray(values, dtype=np.float32)[order]
+    groupCounts = np.diff(np.append(groupStarts, sortedVoxelIndices.size))
+
+    accumulated = self._accumulated.reshape(-1)
+    counts = self._counts.reshape(-1)
+    if self.compoundingMode == AVERAGE:
+      accumulated[updatedVoxels] += np.add.reduceat(sortedValues, groupStarts)
+    else:
+      groupMaximums = np.maximum.reduceat(sortedValues, groupStarts)
+      previousMaximums = accumulated[updatedVoxels]
+      accumulated[updatedVoxels] = np.where(counts[updatedVoxels] > 0, np.maximum(previousMaximums, groupMaximums), groupMaximums)
+    counts[updatedVoxels] += groupCounts.astype(np.uint32)
+    self._markDirty(updatedVoxels)
+    return updatedVoxels
+
+  def _markDirty(self, flatVoxelIndices):
+    # Hole filling reads the neighbors within the radius, so bricks within the radius of an updated voxel change too.
+    # The radius is smaller than a brick, so a voxel reaches at most the two bricks of its low and high neighbor per axis.
+    voxelIndices = np.unravel_index(flatVoxelIndices, self.dimensions)
+    radius = self.holeFillingRadius if self.fillHoles else 0
+    lowBricks = [np.maximum(axisIndices - radius, 0) // self.brickSize for axisIndices in voxelIndices]
+    highBricks = [np.minimum(axisIndices + radius, size - 1) // self.brickSize
+                  for axisIndices, size in zip(voxelIndices, self.dimensions)]
+    for k in (lowBricks[0], highBricks[0]):
+      for j in (lowBricks[1], highBricks[1]):
+        for i in (lowBricks[2], highBricks[2]):
+          self._dirtyBricks[k, j, i] = True
+
+  def brickRegion(self, brick):
+    """
+    :param brick: (k, j, i) index of a brick
+    :return: tuple of slices of the brick in the (slices, rows, columns) grid
+    """
+    return tuple(slice(index * self.brickSize, min((index + 1) * self.brickSize, size))
+                 for index, size in zip(brick, self.dimensions))
+
+  def updateBricks(self):
+    """
+    Recompute the output of the bricks that changed since the last call.
+    :return: dict of (k, j, i) brick index to the float32 output values of the brick
+    """
+    updatedBricks = {}
+    radius = self.holeFillingRadius if self.fillHoles else 0
+    for brick in zip(*np.nonzero(self._dirtyBricks)):
+      brick = tuple(int(index) for index in brick)
+      region = self.brickRegion(brick)
+      # Hole filling needs a halo of radius voxels around the brick
+      haloRegion = tuple(slice(max(axisRegion.start - radius, 0), min(axisRegion.stop + radius, size))
+                         for axisRegion, size in zip(region, self.dimensions))
+      haloValues = self._compoundedValues(haloRegion)
+      updatedBricks[brick] = haloValues[tuple(slice(axisRegion.start - haloAxisRegion.start, axisRegion.stop - haloAxisRegion.start)
+                                              for axisRegion, haloAxisRegion in zip(region, haloRegion))]
+    self._dirtyBricks.fill(False)
+    return updatedBricks
+
+  def _compoundedValues(self, region):
+    counts = self._counts[region]
+    filled = counts > 0
+    values = np.zeros(counts.shape, dtype=np.float32)
+    if self.compoundingMode == AVERAGE:
+      np.divide(self._accumulated[region], counts, out=values, where=filled)
+    else:
+      values[filled] = self._accumulated[region][filled]
+    if self.fillHoles:
+      fillVolumeHoles(values, filled, self.holeFillingRadius)
+    return values
+
+  def volume(self):
+    """
+    :return: (slices, rows, columns) float32 array of the whole grid, empty voxels are 0
+    """
+    return self._compoundedValues(tuple(slice(0, size) for size in self.dimensions))
+
+
+def reconstructFrames(frames, pixelToWorldMatrices, volume, voxelToWorldMatrix, compoundingMode=AVERAGE):
+  """
+  Compound a recorded sweep of tracked frames in one go, e.g. in a worker process.
+  :param frames: (K, rows, columns) images
+  :param pixelToWorldMatrices: (K, 4, 4) pose of each frame, from (column, row, 0) pixel indices to world
+  :param volume: (slices, rows, columns) output array, overwritten, e.g. a shared array
+  :param voxelToWorldMatrix: (4, 4) matrix from (column, row, slice) voxel indices to world
+  :return: number of frames compounded
+  """
+  reconstructor = VolumeReconstructor(volume.shape, voxelToWorldMatrix, compoundingMode)
+  for frame, pixelToWorldMatrix in zip(frames, pixelToWorldMatrices):
+    reconstructor.addFrame(frame, pixelToWorldMatrix)
+  volume[...] = reconstructor.volume()
+  return reconstructor.numberOfFrames
+
+
+def fillVolumeHoles(volume, filled, radius=1):
+  """
+  Replace empty voxels in place by the mean of the filled voxels in the surrounding cube of
+  (2 * radius + 1) voxels. Voxels without any filled neighbor stay empty.
+  :param volume: (slices, rows, columns) array
+  :param filled: boolean array of the same shape, True where volume holds a value
+  """
+  filledIndices = np.nonzero(filled)
+  if filledIndices[0].size == 0:
+    return
+  # Only the bounding box of the filled voxels, grown by the radius, can contain fillable holes
+  region = tuple(slice(max(indices.min() - radius, 0), indices.max() + radius + 1) for indices in filledIndices)
+  regionFilled = filled[region]
+  neighborSums = _boxSum(np.where(regionFilled, volume[region], 0).astype(np.float32), radius)
+  neighborCounts = _boxSum(regionFilled.astype(np.float32), radius)
+  holes = ~regionFilled & (neighborCounts > 0)
+  volume[region][holes] = neighborSums[holes] / neighborCounts[holes]
+
+
+def _boxSum(array, radius):
+  # Separable box filter from cumulative sums of the zero padded array
+  width = 2 * radius + 1
+  for axis in range(array.ndim):
+    padding = [(0, 0)] * array.ndim
+    padding[axis] = (radius + 1, radius)
+    cumulative = np.cumsum(np.pad(array, padding, mode='constant'), axis=axis)
+    upper = [slice(None)] * array.ndim
+    lower = [slice(None)] * array.ndim
+    upper[axis] = slice(width, None)
+    lower[axis] = slice(None, -width)
+    array = cumulative[tuple(upper)] - cumulative[tuple(lower)]
+  return array
+
+
+class ReconstructionThread(object):
+  """
+  Runs a VolumeReconstructor on a worker thread. Frames are queued by the caller, e.g. from an
+  image modified observer on the main thread, and scattered in the background. The output of the
+  changed bricks, including hole filling, is also computed on the worker, whenever the queue is
+  empty and at most every volumeUpdateIntervalSec. NumPy releases the GIL in the heavy array
+  operations, so the caller stays responsive.
+
+  If the worker falls behind, the oldest queued frames are dropped instead of adding latency.
+  """
+
+  def __init__(self, reconstructor, maximumQueuedFrames=8, volumeUpdateIntervalSec=0.5):
+    self.reconstructor = reconstructor
+    self.volumeUpdateIntervalSec = volumeUpdateIntervalSec
+    self.numberOfDroppedFrames = 0
+    self._frames = queue.Queue(maximumQueuedFrames)
+    self._lock = threading.Lock()
+    self._thread = None
+    self._updatedBricks = {}
+
+  def start(self):
+    if self._thread is not None:
+      return
+    self._thread = threading.Thread(target=self._run, name='VolumeReconstruction')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """
+    Process the frames that are already queued, update the changed bricks and stop the worker.
+    """
+    if self._thread is None:
+      return
+    self._frames.put(None)
+    self._thread.join()
+    self._thread = None
+
+  def isRunning(self):
+    return self._thread is not None
+
+  def addFrame(self, frame, pixelToWorldMatrix, mask=None):
+    """
+    Queue a frame. The frame is copied, so the caller can reuse its buffer.
+    """
+    self._put((self.reconstructor.addFrame, np.array(frame, copy=True), np.array(pixelToWorldMatrix, dtype=np.float64), mask))
+
+  def addSweep(self, scanConversionTable, sweep, probeToWorldMatrix):
+    """
+    Queue a raw wobbler sweep. The sweep is copied, so the caller can reuse its buffer.
+    """
+    self._put((self.reconstructor.addSweep, scanConversionTable, np.array(sweep, copy=True),
+               np.array(probeToWorldMatrix, dtype=np.float64)))
+
+  def _put(self, item):
+    while True:
+      try:
+        self._frames.put_nowait(item)
+        return
+      except queue.Full:
+        try:
+          self._frames.get_nowait()
+          self.numberOfDroppedFrames += 1
+        except queue.Empty:
+          pass
+
+  def _run(self):
+    modified = False
+    lastUpdateTime = 0.0
+    while True:
+      try:
+        item = self._frames.get(timeout=self.volumeUpdateIntervalSec)
+      except queue.Empty:
+        item = False
+      if item is None:
+        break
+      if item is not False:
+        addFunction = item[0]
+        addFunction(*item[1:])
+        modified = True
+      if modified and self._frames.empty() and time.perf_counter() - lastUpdateTime >= self.volumeUpdateIntervalSec:
+        self._updateBricks()
+        modified = False
+        lastUpdateTime = time.perf_counter()
+    if modified:
+      self._updateBricks()
+
+  def _updateBricks(self):
+    updatedBricks = self.reconstructor.updateBricks()
+    with self._lock:
+      self._updatedBricks.update(updatedBricks)
+
+  def takeUpdatedBricks(self):
+    """
+    :return: dict of (k, j, i) brick index to output values of the bricks updated since the last call
+    """
+    with self._lock:
+      updatedBricks = self._updatedBricks
+      self._updatedBricks = {}
+    return updatedBricks
@@ -0,0 +1,207 @@
+import itertools
+import multiprocessing
+import queue
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+#
+# Heavy processing in a separate process
+#
+
+
+class SharedArray(object):
+  """
+  NumPy array in shared memory, e.g. frames, poses or an output volume, that a worker process
+  reads and writes without copying it through a pipe.
+
+  The process that creates the array owns the memory and releases it with close. Other
+  processes attach to it by its descriptor and only detach on close.
+  """
+
+  def __init__(self, shape, dtype, name=None):
+    """
+    :param name: name of existing shared memory to attach to, None to allocate new memory
+    """
+    self.shape = tuple(int(n) for n in shape)
+    self.dtype = np.dtype(dtype)
+    self._owner = name is None
+    if self._owner:
+      numberOfBytes = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+      self._memory = shared_memory.SharedMemory(create=True, size=numberOfBytes)
+    else:
+      self._memory = _attachSharedMemory(name)
+    self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._memory.buf)
+
+  @classmethod
+  def fromArray(cls, array):
+    """
+    :return: new SharedArray holding a copy of array
+    """
+    array = np.asarray(array)
+    sharedArray = cls(array.shape, array.dtype)
+    sharedArray.array[...] = array
+    return sharedArray
+
+  def descriptor(self):
+    """
+    :return: (name, shape, dtype) to attach to the array from another process
+    """
+    return self._memory.name, self.shape, self.dtype.str
+
+  def close(self):
+    if self._memory is None:
+      return
+    # The memory can only be unmapped once no array refers to it
+    self.array = None
+    self._memory.close()
+    if self._owner:
+      self._memory.unlink()
+    self._memory = None
+
+
+def _attachSharedMemory(name):
+  try:
+    return shared_memory.SharedMemory(name=name, track=False)
+  except TypeError:
+    # Before Python 3.13 attaching also registers the memory with the resource tracker. The worker
+    # shares the tracker of the process that started it, so the registration is a no-op.
+    return shared_memory.SharedMemory(name=name)
+
+
+def _workerMain(tasks, results):
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    taskId, function, args, keywordArguments, descriptors = task
+    sharedArrays = {}
+    arrays = None
+    result = None
+    errorMessage = None
+    try:
+      sharedArrays = {keyword: SharedArray(shape, dtype, name) for keyword, (name, shape, dtype) in descriptors.items()}
+      arrays = {keyword: sharedArray.array for keyword, sharedArray in sharedArrays.items()}
+      arrays.update(keywordArguments)
+      result = function(*args, **arrays)
+    except Exception:
+      errorMessage = traceback.format_exc()
+    finally:
+      # Results must not be views of the shared arrays, those are detached here
+      arrays = None
+      for sharedArray in sharedArrays.values():
+        sharedArray.close()
+    results.put((taskId, result, errorMessage))
+
+
+class WorkerProcess(object):
+  """
+  Runs heavy functions, e.g. reconstruction or registration, in a separate Python process, so
+  they neither block the main thread nor compete with it for the GIL.
+
+  Large inputs and outputs are passed as SharedArray, everything else is pickled. Finished
+  tasks are handed back by poll, which is called periodically on the main thread, e.g. from a
+  timer, so the callbacks can safely update the MRML scene.
+  """
+
+  def __init__(self, executable=None):
+    """
+    :param executable: Python interpreter of the worker, the current one if None
+    """
+    self.executable = executable
+    self._process = None
+    self._tasks = None
+    self._results = None
+    self._pendingTasks = {}
+    self._taskIds = itertools.count()
+
+  def start(self):
+    if self._process is not None:
+      return
+    # A forked copy of a GUI application is not safe, the worker starts a fresh interpreter
+    context = multiprocessing.get_context('spawn')
+    if self.executable is not None:
+      context.set_executable(self.executable)
+    self._tasks = context.Queue()
+    self._results = context.Queue()
+    self._process = context.Process(target=_workerMain, args=(self._tasks, self._results), name='WobblerNavigationWorker')
+    self._process.daemon = True
+    self._process.start()
+
+  def stop(self, timeoutSec=5.0):
+    """
+    Finish the queued tasks and stop the worker, it is terminated if it does not stop in time.
+    Every pending callback is called before stop returns, with an error message for the tasks
+    whose results were not received, so the caller can release their shared arrays.
+    """
+    if self._process is None:
+      return
+    self._tasks.put(None)
+    self._process.join(timeoutSec)
+    if self._process.is_alive():
+      self._process.terminate()
+      self._process.join()
+    else:
+      # The worker put the results of all finished tasks into the queue before it exited
+      self._handBackResults()
+    self._process = None
+    self._failPendingTasks("The worker process was stopped before the task finished")
+
+  def isRunning(self):
+    return self._process is not None
+
+  def numberOfPendingTasks(self):
+    return len(self._pendingTasks)
+
+  def submit(self, function, args=(), keywordArguments=None, sharedArrays=None, callback=None):
+    """
+    Queue a call of function(*args, **keywordArguments, **sharedArrays) in the worker.
+    :param function: module level function, it is pickled by name and imported by the worker
+    :param sharedArrays: dict of keyword to SharedArray, passed to function as NumPy arrays.
+      Outputs are written into them in place. The caller closes them, e.g. in the callback.
+    :param callback: called by poll on the calling thread as callback(result, errorMessage),
+      errorMessage is the traceback if function raised and None otherwise
+    :return: task id
+    """
+    if self._process is None:
+      raise ValueError("The worker process is not running")
+    taskId = next(self._taskIds)
+    descriptors = {keyword: sharedArray.descriptor() for keyword, sharedArray in (sharedArrays or {}).items()}
+    self._pendingTasks[taskId] = callback
+    self._tasks.put((taskId, function, tuple(args), keywordArguments or {}, descriptors))
+    return taskId
+
+  def poll(self):
+    """
+    Hand the results of finished tasks to their callbacks. Never blocks.
+    :return: number of tasks that finished
+    """
+    if self._process is None:
+      return 0
+    numberOfFinishedTasks = self._handBackResults()
+
+    if not self._process.is_alive() and self._pendingTasks:
+      # The worker crashed, e.g. ran out of memory, the remaining tasks are lost
+      self._process = None
+      self._failPendingTasks("The worker process exited unexpectedly")
+    return numberOfFinishedTasks
+
+  def _handBackResults(self):
+    numberOfFinishedTasks = 0
+    while True:
+      try:
+        taskId, result, errorMessage = self._results.get_nowait()
+      except queue.Empty:
+        return numberOfFinishedTasks
+      numberOfFinishedTasks += 1
+      callback = self._pendingTasks.pop(taskId, None)
+      if callback is not None:
+        callback(result, errorMessage)
+
+  def _failPendingTasks(self, errorMessage):
+    pendingTasks = self._pendingTasks
+    self._pendingTasks = {}
+    for callback in pendingTasks.values():
+      if callback is not None:
+        callback(None, errorMessage)
@@ -0,0 +1,46 @@
+"""
+Numerical core shared by the wobbler intervention navigation modules.
+
+The package only depends on NumPy, and SciPy 1.6 or later for the KD-tree of SurfaceRegistration,
+so it can be used from batch jobs, worker processes and benchmarks without starting Slicer.
+Slicer does not bundle SciPy, see SurfaceRegistration.requireSciPy.
+Submodules are imported on first access, importing the package itself does not load any of them.
+"""
+
+import importlib
+
+__all__ = [
+  'Accuracy',
+  'CineBuffer',
+  'NavigationMetrics',
+  'OpenIGTLink',
+  'PlusConnection',
+  'PoseBuffer',
+  'Registration',
+  'RegistrationError',
+  'ScanConversion',
+  'SessionRecording',
+  'StreamStatistics',
+  'SurfaceRegistration',
+  'TemporalCalibration',
+  'ToolCalibration',
+  'Transforms',
+  'TransformTree',
+  'UpdateScheduler',
+  'VolumeReconstruction',
+  'WorkerProcess',
+  ]
+
+
+def __getattr__(name):
+  # Module level __getattr__ (PEP 562) is only called for attributes that are not set yet.
+  # "from WobblerNavigationLib import Registration" imports the submodule on older Python versions too.
+  if name in __all__:
+    module = importlib.import_module('.' + name, __name__)
+    globals()[name] = module
+    return module
+  raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,541 @@
+"""
+MRML glue shared by the logic classes of the navigation modules.
+
+WobblerNavigationLib does the numerical work without Slicer, NavigationLogic connects it to the
+scene: the transform tree cache, landmark registration of markups, tool calibration from a
+tracked transform node, the supervised OpenIGTLink connection to PLUS, the cine loop of the
+live ultrasound image and the coalescing of updates driven by the tracker.
+"""
+
+import logging
+import time
+
+import numpy as np
+import vtk, qt, slicer
+from slicer.ScriptedLoadableModule import ScriptedLoadableModuleLogic
+from vtk.util import numpy_support
+from WobblerNavigationLib import (CineBuffer, PlusConnection, Registration, RegistrationError, ToolCalibration, TransformTree,
+                                  UpdateScheduler)
+
+
+class NavigationLogic(ScriptedLoadableModuleLogic):
+  """
+  Base class of the navigation module logics.
+  Uses ScriptedLoadableModuleLogic base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.registrationErrorStatistics = None
+    self.rejectedFiducialIndices = []
+    self.pivotCalibrationSolver = ToolCalibration.IncrementalPivotCalibration()
+    self.spinCalibrationSolver = ToolCalibration.IncrementalSpinCalibration()
+    self.toolToReferenceNode = None
+    self.toolToReferenceObserverTag = None
+    self.transformTree = TransformTree.TransformTree()
+    self.transformTreeObservations = []
+    self.plusConnectionSupervisor = None
+    self.plusIncomingNodeObservations = {}
+    self.cineUltrasoundVolumeNode = None
+    self.cineObserverTag = None
+    self.cineBuffer = None
+    self.cineBufferCapacity = 300
+    self.frozenVolumeNode = None
+    self.updateScheduler = UpdateScheduler.UpdateScheduler()
+    self.updateTimer = None
+    self.coalescedUpdateObservations = []
+    self.pausedViews = []
+
+  def toolCalibration(self, transformNodeToolToReference, qtTimer):
+    """
+    Feed every ToolToReference update into the incremental pivot and spin calibration solvers.
+    The running estimates are available in self.pivotCalibrationSolver and self.spinCalibrationSolver.
+    """
+    logging.debug('toolCalibration')
+
+    self.pivotCalibrationSolver.reset()
+    self.spinCalibrationSolver.reset()
+    self.stopObservingToolToReference()
+    self.toolToReferenceNode = transformNodeToolToReference
+    self.toolToReferenceObserverTag = transformNodeToolToReference.AddObserver(
+      slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onToolToReferenceModified)
+
+    qtTimer.start()
+
+  def onToolToReferenceModified(self, caller, event):
+    toolToReferenceMatrix = slicer.util.arrayFromTransformMatrix(caller)
+    self.pivotCalibrationSolver.addPose(toolToReferenceMatrix)
+    self.spinCalibrationSolver.addPose(toolToReferenceMatrix)
+
+  def stopObservingToolToReference(self):
+    if self.toolToReferenceObserverTag is not None:
+      self.toolToReferenceNode.RemoveObserver(self.toolToReferenceObserverTag)
+    self.toolToReferenceNode = None
+    self.toolToReferenceObserverTag = None
+
+  def pivotCalibration(self, calibrationErrorThresholdMm, toolCalibrationResultNode, toolCalibrationToolBaseNode=None):
+    """
+    :param toolCalibrationToolBaseNode: the tool length is measured from the tip to the origin of this
+      transform node, e.g. the end of a stylus. If None, it is measured to the tool marker.
+    :return: status, error message and tool length in mm
+    """
+    logging.debug('pivotCalibration')
+
+    self.stopObservingToolToReference()
+
+    pivotCalibrationSolver = self.pivotCalibrationSolver
+    if pivotCalibrationSolver.toolTipPosition is None or not pivotCalibrationSolver.isWellConditioned():
+      return "Calibration failed: ", "Not enough pivoting, rotate the tool more around its tip", 0
+    if (pivotCalibrationSolver.rootMeanSquareError >= float(calibrationErrorThresholdMm)):
+      return "Calibration failed:", "Error = {0:.2f} mm".format(pivotCalibrationSolver.rootMeanSquareError), 0
+
+    # Pivot calibration only determines the tip position, keep the orientation of the current calibration
+    toolTipOrientation = slicer.util.arrayFromTransformMatrix(toolCalibrationResultNode)[:3, :3]
+    toolTipToToolMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(toolTipToToolMatrix, pivotCalibrationSolver.toolTipToToolMatrix(toolTipOrientation))
+    toolCalibrationResultNode.SetMatrixTransformToParent(toolTipToToolMatrix)
+
+    toolLength = int(np.linalg.norm(pivotCalibrationSolver.toolTipPosition))
+    if toolCalibrationToolBaseNode is not None:
+      toolTipToToolBaseTransform = vtk.vtkMatrix4x4()
+      toolCalibrationResultNode.GetMatrixTransformToNode(toolCalibrationToolBaseNode, toolTipToToolBaseTransform)
+      toolLength = int(np.linalg.norm([toolTipToToolBaseTransform.GetElement(row, 3) for row in range(3)]))
+
+    return "Calibration completed", "Error = {0:.2f} mm".format(pivotCalibrationSolver.rootMeanSquareError), toolLength
+
+  def spinCalibration(self, calibrationErrorThresholdDeg, toolCalibrationResultNode):
+    logging.debug('spinCalibration')
+
+    self.stopObservingToolToReference()
+
+    spinCalibrationSolver = self.spinCalibrationSolver
+    if spinCalibrationSolver.shaftDirection is None or spinCalibrationSolver.coverageDeg < spinCalibrationSolver.minimumCoverageDeg:
+      return "Calibration failed: ", "Not enough spinning, rotate the tool further around its shaft"
+    if (spinCalibrationSolver.rootMeanSquareErrorDeg >= float(calibrationErrorThresholdDeg)):
+      return "Calibration failed:", "Error = {0:.2f} deg".format(spinCalibrationSolver.rootMeanSquareErrorDeg)
+
+    # Spin calibration only determines the shaft orientation, keep the calibrated tip position
+    toolTipToToolArray = slicer.util.arrayFromTransformMatrix(toolCalibrationResultNode)
+    toolTipToToolArray[:3, :3] = spinCalibrationSolver.toolTipOrientation(toolTipToToolArray[:3, :3], toolTipToToolArray[:3, 3])
+    toolTipToToolMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(toolTipToToolMatrix, toolTipToToolArray)
+    toolCalibrationResultNode.SetMatrixTransformToParent(toolTipToToolMatrix)
+
+    return "Calibration completed", "Error = {0:.2f} deg".format(spinCalibrationSolver.rootMeanSquareErrorDeg)
+
+  def setupTransformTreeCache(self, transformNodes):
+    """
+    Mirror the hierarchy of the given transform nodes and all their ancestors in a TransformTree.
+    The tree is kept up to date through TransformModifiedEvent observations, so composed matrices
+    are only recomputed for the subtree below a transform that actually changed.
+    """
+    logging.debug('setupTransformTreeCache')
+
+    self.removeTransformTreeCache()
+    for transformNode in transformNodes:
+      self.addToTransformTreeCache(transformNode)
+
+  def addToTransformTreeCache(self, transformNode):
+    if transformNode.GetID() in self.transformTree:
+      return
+
+    parentTransformNode = transformNode.GetParentTransformNode()
+    parentTransformNodeID = None
+    if parentTransformNode is not None:
+      self.addToTransformTreeCache(parentTransformNode)
+      parentTransformNodeID = parentTransformNode.GetID()
+
+    self.transformTree.addTransform(transformNode.GetID(), parentTransformNodeID, slicer.util.arrayFromTransformMatrix(transformNode))
+    observerTag = transformNode.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onCachedTransformModified)
+    self.transformTreeObservations.append((transformNode, observerTag))
+
+  def onCachedTransformModified(self, caller, event):
+    # The event is also invoked when an ancestor changes, the tree ignores matrices that did not change
+    parentTransformNode = caller.GetParentTransformNode()
+    parentTransformNodeID = None
+    if parentTransformNode is not None:
+      self.addToTransformTreeCache(parentTransformNode)
+      parentTransformNodeID = parentTransformNode.GetID()
+
+    self.transformTree.setParent(caller.GetID(), parentTransformNodeID)
+    self.transformTree.setMatrixToParent(caller.GetID(), slicer.util.arrayFromTransformMatrix(caller))
+
+  def removeTransformTreeCache(self):
+    for transformNode, observerTag in self.transformTreeObservations:
+      transformNode.RemoveObserver(observerTag)
+    self.transformTreeObservations = []
+    self.transformTree = TransformTree.TransformTree()
+
+  def getMatrixToWorld(self, transformNode):
+    """
+    :return: cached (4, 4) matrix from the coordinate system of transformNode to world. Read-only.
+    """
+    self.addToTransformTreeCache(transformNode)
+    return self.transformTree.matrixToWorld(transformNode.GetID())
+
+  def getMatrixToNode(self, fromTransformNode, toTransformNode):
+    """
+    Cached equivalent of fromTransformNode.GetMatrixTransformToNode(toTransformNode).
+    :return: (4, 4) matrix from the coordinate system of fromTransformNode to that of toTransformNode. Read-only.
+    """
+    self.addToTransformTreeCache(fromTransformNode)
+    self.addToTransformTreeCache(toTransformNode)
+    return self.transformTree.matrixToTransform(fromTransformNode.GetID(), toTransformNode.GetID())
+
+  def transformPointsBetweenNodes(self, points, fromTransformNode, toTransformNode):
+    """
+    Map an array of points between the coordinate systems of two transform nodes, e.g. from CT through
+    CTToReference, ProbeToReference and USToProbe to US. The path through the transform hierarchy is
+    resolved by the transform tree cache and applied to all points at once.
+    :param points: (N, 3) array of points in the coordinate system of fromTransformNode
+    :param fromTransformNode: source coordinate system, None for world (RAS)
+    :param toTransformNode: target coordinate system, None for world (RAS)
+    :return: (N, 3) array of points in the coordinate system of toTransformNode and the (4, 4) fromTo matrix
+    """
+    logging.debug('transformPointsBetweenNodes')
+
+    fromTransformNodeID = None
+    if fromTransformNode is not None:
+      self.addToTransformTreeCache(fromTransformNode)
+      fromTransformNodeID = fromTransformNode.GetID()
+    toTransformNodeID = None
+    if toTransformNode is not None:
+      self.addToTransformTreeCache(toTransformNode)
+      toTransformNodeID = toTransformNode.GetID()
+
+    return self.transformTree.transformPointsToTransform(fromTransformNodeID, toTransformNodeID, points)
+
+  def getImageToWorldMatrix(self, volumeNode):
+    """
+    :return: (4, 4) matrix from (column, row, slice) voxel indices of volumeNode to world
+    """
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRasMatrix)
+    imageToWorldMatrix = slicer.util.arrayFromVTKMatrix(ijkToRasMatrix)
+    parentTransformNode = volumeNode.GetParentTransformNode()
+    if parentTransformNode is not None:
+      imageToWorldMatrix = np.dot(self.getMatrixToWorld(parentTransformNode), imageToWorldMatrix)
+    return imageToWorldMatrix
+
+  def landmarkRegistration(self, fromMarkupsNode, toMarkupsNode, outputTransformNode, mode=Registration.SIMILARITY,
+                           inlierThresholdMm=None):
+    """
+    Register the control points of fromMarkupsNode to those of toMarkupsNode.
+    The full error analysis of the last successful registration is kept in self.registrationErrorStatistics,
+    the indices of the points rejected by the robust registration in self.rejectedFiducialIndices.
+    :param outputTransformNode: receives the fromTo transform, if None the registration is only evaluated
+    :param inlierThresholdMm: if set, misplaced point pairs farther apart than this after registration
+      are found by RANSAC and left out, otherwise all points are used
+    """
+    logging.debug('landmarkRegistration')
+
+    nFromPoints = fromMarkupsNode.GetNumberOfFiducials()
+    nToPoints = toMarkupsNode.GetNumberOfFiducials()
+
+    if nFromPoints != nToPoints:
+      return 'Number of points in markups nodes are not equal. Error {0:.2f}', 1
+
+    if nFromPoints < 3:
+      return 'Insufficient number of points in markups nodes. Error {0:.2f}', 2
+
+    fromPoints = slicer.util.arrayFromMarkupsControlPoints(fromMarkupsNode, world=True)
+    toPoints = slicer.util.arrayFromMarkupsControlPoints(toMarkupsNode, world=True)
+
+    try:
+      if inlierThresholdMm is None:
+        fromToMatrix, _ = Registration.landmarkRegistration(fromPoints, toPoints, mode)
+        inliers = np.ones(nFromPoints, dtype=bool)
+      else:
+        fromToMatrix, inliers = Registration.robustLandmarkRegistration(fromPoints, toPoints, mode, inlierThresholdMm)
+    except ValueError:
+      return 'Unstable registration. Check input for collinear points. Error {0:.2f}', 3
+
+    resultsMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(resultsMatrix, fromToMatrix)
+
+    det = resultsMatrix.Determinant()
+    if det < 1e-8:
+      return 'Unstable registration. Check input for collinear points. Error {0:.2f}', 3
+
+    if outputTransformNode is not None:
+      outputTransformNode.SetMatrixTransformToParent(resultsMatrix)
+
+    self.registrationErrorStatistics = self.calculateRMSE(fromPoints[inliers], toPoints[inliers], fromToMatrix, mode)
+    self.rejectedFiducialIndices = [int(index) for index in np.flatnonzero(~inliers)]
+
+    if self.rejectedFiducialIndices:
+      rejectedLabels = ', '.join(toMarkupsNode.GetNthFiducialLabel(index) for index in self.rejectedFiducialIndices)
+      return ("Success. Error = {0:.2f} mm, rejected " + rejectedLabels.replace('{', '{{').replace('}', '}}'),
+              self.registrationErrorStatistics.rootMeanSquareError)
+    return "Success. Error = {0:.2f} mm", self.registrationErrorStatistics.rootMeanSquareError
+
+  def batchLandmarkRegistration(self, fromPointSets, toPointSets, mode=Registration.SIMILARITY):
+    """
+    Register K point set pairs in one vectorized call, e.g. the FromProbeToUS/ToProbeToUS
+    fiducials of many recorded calibration sessions. Nothing is written to the MRML scene.
+    :param fromPointSets: (K, N, 3) array of points in the "from" coordinate system
+    :param toPointSets: (K, N, 3) array of the corresponding points in the "to" coordinate system
+    :param mode: one of Registration.RIGID, Registration.SIMILARITY or Registration.AFFINE
+    :return: (K, 4, 4) array of fromToTo matrices and (K,) array of RMSE values (NaN for degenerate sets)
+    """
+    logging.debug('batchLandmarkRegistration')
+
+    return Registration.batchLandmarkRegistration(fromPointSets, toPointSets, mode)
+
+  def calculateRMSE(self, fromPoints, toPoints, transformMatrix, mode=Registration.SIMILARITY):
+    """
+    Vectorized error analysis of a point based registration.
+    :param fromPoints: (N, 3) array
+    :param toPoints: (N, 3) array
+    :param transformMatrix: fromTo transform as a (4, 4) array or vtkMatrix4x4
+    :param mode: registration mode used for the leave-one-out error
+    :return: RegistrationError.RegistrationErrorStatistics with the per-point residuals, RMSE,
+      maximum and percentile errors and the leave-one-out fiducial errors
+    """
+    logging.debug('calculateRMSE')
+
+    if isinstance(transformMatrix, vtk.vtkMatrix4x4):
+      transformMatrix = slicer.util.arrayFromVTKMatrix(transformMatrix)
+
+    return RegistrationError.registrationErrorStatistics(fromPoints, toPoints, transformMatrix, mode)
+
+  def calculateSubtransform(self, AToCTransformNode, BToCTransformNode, outputTransformNode):
+    logging.debug('calculateSubtransform')
+    # In a transform hierarchy with A -> B -> C
+    # This function calculates the transform A -> B given the transforms B -> C and A -> C
+    AToBMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(AToBMatrix, self.getMatrixToNode(AToCTransformNode, BToCTransformNode))
+
+    outputTransformNode.SetMatrixTransformToParent(AToBMatrix)
+    return
+
+  def connectPlus(self, hostAndPort):
+    """
+    Connect an OpenIGTLink client to a PLUS server and keep the connection up. The connector
+    receives on its own thread, call pollPlusConnection periodically from the main thread to
+    reconnect with increasing delays after a failed attempt or a lost connection.
+    :param hostAndPort: "host:port", the default PLUS port is used if there is no port
+    """
+    logging.debug('connectPlus')
+
+    host, port = PlusConnection.parseHostAndPort(hostAndPort)
+    self.disconnectPlus()
+    connectorNode = slicer.util.getFirstNodeByName('PlusConnector', className='vtkMRMLIGTLConnectorNode')
+    if connectorNode is None:
+      connectorNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLIGTLConnectorNode', 'PlusConnector')
+    connectorNode.SetTypeClient(host, port)
+    self.plusConnectionSupervisor = PlusConnection.ConnectionSupervisor(
+      connectorNode, slicer.vtkMRMLIGTLConnectorNode.StateConnected)
+    self.plusConnectionSupervisor.start(time.time())
+
+  def pollPlusConnection(self):
+    """
+    Check the connection without blocking and restart it if needed.
+    :return: PlusConnection state and dict of incoming stream name to messages per second
+    """
+    if self.plusConnectionSupervisor is None:
+      return PlusConnection.OFF, {}
+    self.observePlusIncomingNodes()
+    now = time.time()
+    return self.plusConnectionSupervisor.poll(now), self.plusConnectionSupervisor.streamRates(now)
+
+  def observePlusIncomingNodes(self):
+    # The connector creates a node for each device when its first message arrives
+    connectorNode = self.plusConnectionSupervisor.connector
+    for nodeIndex in range(connectorNode.GetNumberOfIncomingMRMLNodes()):
+      node = connectorNode.GetIncomingMRMLNode(nodeIndex)
+      if node is None or node.GetID() in self.plusIncomingNodeObservations:
+        continue
+      if node.IsA('vtkMRMLTransformNode'):
+        event = slicer.vtkMRMLTransformNode.TransformModifiedEvent
+      elif node.IsA('vtkMRMLVolumeNode'):
+        event = slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent
+      else:
+        event = vtk.vtkCommand.ModifiedEvent
+      self.plusIncomingNodeObservations[node.GetID()] = (node, node.AddObserver(event, self.onPlusMessageReceived))
+
+  def onPlusMessageReceived(self, caller, event):
+    # Stamp the arrival first, before any other work delays it
+    self.plusMessageReceived(caller, time.time())
+
+  def plusMessageReceived(self, node, arrivalTime):
+    """
+    Called for every message received from PLUS, override to process the incoming node.
+    :param arrivalTime: time.time() when the message arrived
+    """
+    if self.plusConnectionSupervisor is not None:
+      self.plusConnectionSupervisor.messageReceived(node.GetName(), arrivalTime)
+
+  def disconnectPlus(self):
+    for node, tag in self.plusIncomingNodeObservations.values():
+      node.RemoveObserver(tag)
+    self.plusIncomingNodeObservations = {}
+    if self.plusConnectionSupervisor is not None:
+      self.plusConnectionSupervisor.stop()
+      self.plusConnectionSupervisor = None
+
+  def startCineRecording(self, ultrasoundVolumeNode, capacity=300):
+    """
+    Keep the last frames of ultrasoundVolumeNode and their poses in a preallocated ring buffer
+    for freezing and cine review.
+    :param capacity: number of frames kept, e.g. the frame rate times the reviewable duration
+    """
+    logging.debug('startCineRecording')
+
+    self.stopCineRecording()
+    self.cineUltrasoundVolumeNode = ultrasoundVolumeNode
+    self.cineBufferCapacity = capacity
+    self.cineObserverTag = ultrasoundVolumeNode.AddObserver(
+      slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onCineImageModified)
+
+  def onCineImageModified(self, caller, event):
+    if self.cineBuffer is not None and self.cineBuffer.frozen:
+      return
+    frame = slicer.util.arrayFromVolume(caller)
+    if frame.shape[0] != 1:
+      return
+    if self.cineBuffer is None or self.cineBuffer.frameShape != frame.shape[1:] or self.cineBuffer.dtype != frame.dtype:
+      # The buffer is only reallocated if the image size or type changes, e.g. with a new depth setting
+      self.cineBuffer = CineBuffer.CineBuffer(frame.shape[1:], frame.dtype, self.cineBufferCapacity)
+    self.cineBuffer.addFrame(frame[0], self.getImageToWorldMatrix(caller), time.time())
+
+  def stopCineRecording(self):
+    if self.cineObserverTag is not None:
+      self.cineUltrasoundVolumeNode.RemoveObserver(self.cineObserverTag)
+    self.cineUltrasoundVolumeNode = None
+    self.cineObserverTag = None
+    self.unfreezeUltrasound()
+    self.cineBuffer = None
+
+  def freezeUltrasound(self, frozenVolumeNode):
+    """
+    Stop recording and show the latest buffered frame in frozenVolumeNode. The node shows the
+    frame directly from the cine buffer memory, nothing is copied.
+    :return: number of frames available for cine review
+    """
+    logging.debug('freezeUltrasound')
+
+    if self.cineBuffer is None or self.cineBuffer.numberOfFrames == 0:
+      return 0
+    self.cineBuffer.freeze()
+    self.frozenVolumeNode = frozenVolumeNode
+    self.showCineFrame(0)
+    return self.cineBuffer.numberOfFrames
+
+  def showCineFrame(self, age):
+    """
+    :param age: 0 for the frame at the time of freezing, 1 for the one before it and so on
+    """
+    if self.frozenVolumeNode is None:
+      return
+    frame, pixelToWorldMatrix, _ = self.cineBuffer.frame(age)
+
+    imageData = self.frozenVolumeNode.GetImageData()
+    if imageData is None or imageData.GetDimensions() != (frame.shape[1], frame.shape[0], 1):
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(frame.shape[1], frame.shape[0], 1)
+      self.frozenVolumeNode.SetAndObserveImageData(imageData)
+    # The scalars wrap the buffer slot, the buffer does not write while frozen
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(frame.reshape(-1), deep=False))
+    imageData.Modified()
+
+    # The frame keeps the pose it was acquired at, the node is not under any transform
+    ijkToRasMatrix = vtk.vtkMatrix4x4()
+    slicer.util.updateVTKMatrixFromArray(ijkToRasMatrix, pixelToWorldMatrix)
+    self.frozenVolumeNode.SetIJKToRASMatrix(ijkToRasMatrix)
+
+  def unfreezeUltrasound(self):
+    """
+    Resume recording. The frozen node keeps a copy of the frame it shows, the buffer slot is overwritten.
+    """
+    if self.frozenVolumeNode is not None:
+      imageData = self.frozenVolumeNode.GetImageData()
+      if imageData is not None and imageData.GetPointData().GetScalars() is not None:
+        scalars = imageData.GetPointData().GetScalars().NewInstance()
+        scalars.DeepCopy(imageData.GetPointData().GetScalars())
+        imageData.GetPointData().SetScalars(scalars)
+      self.frozenVolumeNode = None
+    if self.cineBuffer is not None:
+      self.cineBuffer.unfreeze()
+
+  def startCoalescedUpdates(self, trackedTransformNodes, maximumRateHz=30.0, views=()):
+    """
+    Render and run the registered pose dependent updates at most maximumRateHz times per second,
+    however often the tracked transforms change. Rendering of views is paused between ticks, so all
+    modifications since the last tick are shown with one render of each view.
+    :param trackedTransformNodes: transforms updated by the tracker, e.g. StylusToReference
+    :param views: views of the module layout, see setCoalescedRenderViews
+    """
+    logging.debug('startCoalescedUpdates')
+
+    self.stopCoalescedUpdates()
+    self.updateScheduler.maximumRateHz = maximumRateHz
+    for transformNode in trackedTransformNodes:
+      self.coalescedUpdateObservations.append((transformNode, transformNode.AddObserver(
+        slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onTrackedTransformModified)))
+    self.updateTimer = qt.QTimer()
+    self.updateTimer.setInterval(int(round(1000.0 / maximumRateHz)))
+    self.updateTimer.connect('timeout()', self.onUpdateTick)
+    self.setCoalescedRenderViews(views)
+    self.updateTimer.start()
+
+  def setCoalescedRenderViews(self, views):
+    """
+    Render views only once per tick while coalesced updates run. Views of other modules and
+    windows keep rendering as usual.
+    :param views: ctkVTKAbstractView objects, e.g. the slice views of the layout
+    """
+    for view in self.pausedViews:
+      view.resumeRender()
+    self.pausedViews = []
+    if self.updateTimer is None:
+      return
+    for view in views:
+      view.pauseRender()
+      self.pausedViews.append(view)
+
+  def registerTrackedUpdate(self, key, callback):
+    """
+    Run callback once per tick after any tracked transform has changed, with the newest poses.
+    """
+    self.updateScheduler.register(key, callback)
+
+  def unregisterTrackedUpdate(self, key):
+    self.updateScheduler.unregister(key)
+
+  def onTrackedTransformModified(self, caller, event):
+    self.updateScheduler.requestUpdate()
+
+  def onUpdateTick(self):
+    try:
+      self.updateScheduler.runPendingUpdates(time.time())
+    except Exception:
+      # The timer keeps ticking, a failing update must not freeze the views
+      logging.exception('Coalesced update failed')
+    finally:
+      # Views that requested a render since the last tick render once now, with the newest poses
+      for view in self.pausedViews:
+        view.resumeRender()
+        view.pauseRender()
+
+  def stopCoalescedUpdates(self):
+    for transformNode, observerTag in self.coalescedUpdateObservations:
+      transformNode.RemoveObserver(observerTag)
+    self.coalescedUpdateObservations = []
+    if self.updateTimer is not None:
+      self.updateTimer.stop()
+      self.updateTimer = None
+    self.setCoalescedRenderViews([])
+
+  def getLayoutViews(self):
+    """
+    :return: slice and 3D views of the current layout, e.g. to render once per coalesced update
+    """
+    layoutManager = slicer.app.layoutManager()
+    views = []
+    for sliceViewName in layoutManager.sliceViewNames():
+      views.append(layoutManager.sliceWidget(sliceViewName).sliceView())
+    for threeDViewIndex in range(layoutManager.threeDViewCount):
+      views.append(layoutManager.threeDWidget(threeDViewIndex).threeDView())
+    return views
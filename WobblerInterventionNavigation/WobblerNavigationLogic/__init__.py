@@ -0,0 +1,5 @@
+"""
+Slicer side of the wobbler intervention navigation modules.
+
+Unlike WobblerNavigationLib, this package imports slicer and can only be used inside Slicer.
+"""